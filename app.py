@@ -1,12 +1,37 @@
-import os, pdb
+import os, pdb, time
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, abort, render_template, stream_template, request, flash, redirect, session, g, jsonify
 from flask_login import login_user
 # from flask_debugtoolbar import DebugToolbarExtension
+from sqlalchemy import func, literal, select
 from sqlalchemy.exc import IntegrityError
 
+from assets import assets
 from forms import UserAddForm, LoginForm, MessageForm, EditProfileForm
+import bulk_load
+import caching
+from compression import compression
+import counters
+from hashing import HasherBusy, passwords
+from instrumentation import instrumentation
+from jobs import jobs
+from metrics import metrics
+import migrations
 from models import db, connect_db, User, Message, Likes, Follows
+from pagination import (Page, before_key, encode_cursor, make_page, message_key,
+                        next_page_url, page_size, paginate_messages,
+                        paginate_users, streaming, user_key)
+import query_plans
+from ratelimit import limiter
+from read_models import message_views, to_views, views_by_ids
+from recommendations import recommendations
+from search import message_search, user_search
+import tasks
+from timeline import timelines
+from trending import trending
+from user_cache import user_cache
 
 CURR_USER_KEY = "curr_user"
 
@@ -21,21 +46,49 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 # app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['PAGE_SIZE'] = 100
+# Long lists render as they are read from the database; see pagination.py
+app.config['STREAM_LISTS'] = True
 # toolbar = DebugToolbarExtension(app)
 
+# Materialized home timelines are opt-in; see timeline.py
+app.config['TIMELINE_STORE_ENABLED'] = (
+    os.environ.get('TIMELINE_STORE_ENABLED', '') == '1')
+
+# Who runs background jobs; see jobs.py
+app.config['JOBS_MODE'] = os.environ.get('JOBS_MODE', 'thread')
+
 connect_db(app)
+instrumentation.init_app(app)
+metrics.init_app(app)
+timelines.init_app(app)
+user_search.init_app(app)
+message_search.init_app(app)
+user_cache.init_app(app)
+passwords.init_app(app)
+caching.init_app(app)
+jobs.init_app(app)
+recommendations.init_app(app)
+trending.init_app(app)
+limiter.init_app(app)
+assets.init_app(app)
+compression.init_app(app)
 
 app.app_context().push()
+app.add_template_global(next_page_url)
 ##############################################################################
 # User signup/login/logout
 
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    Handlers should use g.user rather than querying for the user again.
+    """
     # pdb.set_trace()
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = user_cache.get(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -54,7 +107,44 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def followed_ids(users):
+    """Ids among `users` that the logged-in user follows, in one query."""
+
+    if not g.user:
+        return set()
+
+    return g.user.followed_user_ids([user.id for user in users])
+
+
+def timeline_author_ids(user_id):
+    """Select of the ids whose messages are on `user_id`'s home timeline.
+
+    A single IN over a UNION, rather than `id = x OR id IN (...)`, lets
+    Postgres probe the indexes once per author instead of scanning.
+    """
+
+    return (select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == user_id)
+            .union_all(select(literal(user_id))))
+
+
+def render_list(template, fragment, stream=False, **context):
+    """Render a paginated page, or only its items for a `?fragment=1` request.
+
+    With `stream` (and STREAM_LISTS on) the page is sent as it renders.
+    """
+
+    if request.args.get('fragment'):
+        template = fragment
+
+    if stream and streaming():
+        return stream_template(template, **context)
+
+    return render_template(template, **context)
+
+
 @app.route('/signup', methods=["GET", "POST"])
+@limiter.limit('5/minute', per='ip')
 def signup():
     """Handle user signup.
 
@@ -84,6 +174,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except HasherBusy:
+            flash("Too many signups right now, please try again.", 'danger')
+            return render_template('users/signup.html', form=form), 503
+
         do_login(user)
 
         return redirect("/")
@@ -93,16 +187,23 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@limiter.limit('10/minute', per='ip')
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except HasherBusy:
+            flash("Too many logins right now, please try again.", 'danger')
+            return render_template('users/login.html', form=form), 503
 
         if user:
+            # authenticate() may have upgraded the password hash
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             session['username']=user.username
@@ -130,20 +231,62 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username;
+    matches are ranked and capped at USER_SEARCH_LIMIT.
     """
 
     search = request.args.get('q')
 
+    following_ids = set()
     if not search:
-        users = User.query.all()
+        users = paginate_users(User.query, on_batch=lambda rows: following_ids.update(followed_ids(rows)),
+                               stream=True)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = user_search.load(user_search.search(search))
+        users = make_page(users, len(users), user_key)
+        following_ids = followed_ids(users)
+
+    return render_list('users/index.html', 'users/_cards.html', stream=True, users=users,
+                       following_ids=following_ids)
+
 
-    return render_template('users/index.html', users=users)
+@app.route('/users/autocomplete')
+def users_autocomplete():
+    """JSON list of users whose username starts with the 'q' param."""
+
+    prefix = request.args.get('q', '')
+    users = user_search.load(user_search.autocomplete(prefix)) if prefix else []
+
+    return jsonify(users=[dict(id=user.id,
+                               username=user.username,
+                               image_url=user.image_url)
+                          for user in users])
+
+
+@app.route('/users/suggestions')
+def users_suggestions():
+    """JSON list of users the logged-in user might follow."""
+
+    if not g.user:
+        return jsonify(error="login required"), 401
+
+    return jsonify(users=[dict(id=user.id,
+                               username=user.username,
+                               image_url=user.image_url,
+                               mutuals=mutuals)
+                          for user, mutuals in recommendations.for_user(g.user.id)])
+
+
+def profile_version(user_id):
+    """Data version of a profile page: the user's update stamp."""
+
+    updated_at = db.session.execute(
+        select(User.updated_at).where(User.id == user_id)).scalar()
+    return (user_id, updated_at) if updated_at else None
 
 
 @app.route('/users/<int:user_id>')
+@caching.conditional(profile_version)
 def users_show(user_id):
     """Show user profile."""
     if not g.user:
@@ -157,13 +300,10 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages, location=location, bio=bio, header_image_url=header_image_url)
+    messages = paginate_messages(message_views().filter(Message.user_id == user_id),
+                                 convert=to_views)
+    suggestions = recommendations.for_user(user_id) if g.user.id == user_id else []
+    return render_list('users/show.html', 'users/_message_items.html', user=user, messages=messages, location=location, bio=bio, header_image_url=header_image_url, suggestions=suggestions)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -175,7 +315,14 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following_ids = set()
+    users = paginate_users(User.query
+                           .join(Follows, Follows.user_being_followed_id == User.id)
+                           .filter(Follows.user_following_id == user_id),
+                           on_batch=lambda rows: following_ids.update(followed_ids(rows)),
+                           stream=True)
+    return render_list('users/following.html', 'users/_cards.html', stream=True, user=user, users=users,
+                       following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -187,7 +334,14 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    following_ids = set()
+    users = paginate_users(User.query
+                           .join(Follows, Follows.user_following_id == User.id)
+                           .filter(Follows.user_being_followed_id == user_id),
+                           on_batch=lambda rows: following_ids.update(followed_ids(rows)),
+                           stream=True)
+    return render_list('users/followers.html', 'users/_cards.html', stream=True, user=user, users=users,
+                       following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/likes', methods=["GET", "POST"])
@@ -198,11 +352,15 @@ def users_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    liked_msg=Message.query.join(Likes).filter(Likes.user_id==user.id)
-    return render_template('users/likes.html', user=user, liked_msg=liked_msg)
+    liked_msg = paginate_messages(message_views(g.user.id)
+                                  .join(Likes, Likes.message_id == Message.id)
+                                  .filter(Likes.user_id==user.id),
+                                  stream=True, convert=to_views)
+    return render_list('users/likes.html', 'messages/_items.html', stream=True, user=user, messages=liked_msg)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@limiter.limit('60/minute')
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -211,8 +369,17 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    if not g.user.is_following(followed_user):
+        db.session.add(Follows(user_being_followed_id=followed_user.id,
+                               user_following_id=g.user.id))
+        counters.adjust(g.user.id, following_count=1)
+        counters.adjust(followed_user.id, followers_count=1)
+        if timelines.enabled:
+            jobs.enqueue('backfill_timeline', follower_id=g.user.id,
+                         followed_id=followed_user.id)
+        jobs.enqueue('refresh_suggestions', user_ids=[g.user.id])
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -226,8 +393,15 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    follow = db.session.get(Follows, (followed_user.id, g.user.id))
+
+    if follow:
+        db.session.delete(follow)
+        counters.adjust(g.user.id, following_count=-1)
+        counters.adjust(followed_user.id, followers_count=-1)
+        timelines.unfollow(g.user.id, followed_user.id)
+        jobs.enqueue('refresh_suggestions', user_ids=[g.user.id])
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -273,7 +447,9 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Deleting everything a busy user owns takes a while; see tasks.py
+    jobs.enqueue('delete_user', key=f'delete_user:{g.user.id}',
+                 user_id=g.user.id)
     db.session.commit()
 
     return redirect("/signup")
@@ -285,6 +461,7 @@ def delete_user():
 
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@limiter.limit('30/minute')
 def messages_add():
     """Add a message:
 
@@ -300,14 +477,70 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        counters.adjust(g.user.id, messages_count=1)
+        db.session.flush()
+        if timelines.enabled:
+            jobs.enqueue('fan_out', key=f'fan_out:{msg.id}', message_id=msg.id)
         db.session.commit()
+        trending.record_message(msg)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+def search_messages():
+    """Page of messages matching the 'q' param, best match first."""
+
+    query = request.args.get('q', '')
+    if not query.strip():
+        return Page([], None)
+
+    limit = page_size()
+    rows = message_search.search(query, limit + 1, before_key((float, int)))
+    ids = [message_id for _, message_id in rows[:limit]]
+
+    messages = views_by_ids(ids, g.user.id if g.user else None)
+    next_cursor = encode_cursor(*rows[limit - 1]) if len(rows) > limit else None
+    return Page(messages, next_cursor)
+
+
+@app.route('/messages/search')
+def messages_search():
+    """Search messages by text."""
+
+    messages = search_messages()
+    return render_list('messages/search.html', 'messages/_items.html',
+                       messages=messages,
+                       query=request.args.get('q', ''))
+
+
+@app.route('/api/messages/search')
+def messages_search_json():
+    """Search messages by text, as JSON."""
+
+    messages = search_messages()
+    return jsonify(
+        messages=[dict(id=msg.id,
+                       text=msg.text,
+                       timestamp=msg.timestamp.isoformat(),
+                       user=dict(id=msg.user.id, username=msg.user.username))
+                  for msg in messages],
+        next=messages.next_cursor)
+
+
+def message_version(message_id):
+    """Data version of a message page: the message and its author's stamp."""
+
+    row = db.session.execute(
+        select(Message.id, User.updated_at)
+        .join(User, User.id == Message.user_id)
+        .where(Message.id == message_id)).first()
+    return tuple(row) if row else None
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@caching.conditional(message_version)
 def messages_show(message_id):
     """Show a message."""
 
@@ -324,25 +557,31 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    counters.message_deleted(msg)
+    timelines.remove_message(msg.id)
     db.session.delete(msg)
     db.session.commit()
+    trending.forget_message(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
 @app.route("/users/add_like/<int:msg_id>", methods=['POST'])
+@limiter.limit('120/minute')
 def add_like(msg_id):
-    msg=Message.query.get_or_404(msg_id)
-    user=User.query.get_or_404(g.user.id)
-    existing_like=Likes.query.filter_by(user_id=user.id, message_id=msg.id).first()
-
-    if not existing_like:
-        new_like=Likes(user_id=user.id, message_id=msg.id)
-        db.session.add(new_like)
-    else: 
-        db.session.delete(existing_like)
-        
+    """Like or unlike a message for the currently-logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    delta = counters.toggle_like(g.user.id, msg_id)
+    if delta is None:
+        abort(404)
+
     db.session.commit()
+    if delta:
+        trending.record_like(msg_id, delta)
     return redirect('/')
 
 
@@ -350,25 +589,50 @@ def add_like(msg_id):
 # Homepage and error pages
 
 
+def timeline_version():
+    """Data version of the homepage: newest stamp of the viewer and followed
+    users, and the trending panel.
+
+    New and deleted messages bump their author's stamp through counters.
+    """
+
+    if not g.user:
+        return ('anon', trending.version())
+
+    newest = db.session.execute(
+        select(func.max(User.updated_at))
+        .where(User.id.in_(timeline_author_ids(g.user.id)))).scalar()
+    return (newest, trending.version())
+
+
 @app.route('/')
+@caching.conditional(timeline_version)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
+
+    Reads the materialized timeline when the timeline store is enabled.
     """
 
     if g.user:
-        username=g.user.username
-        user=User.query.filter_by(username=username).first()
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_([user.id]+[follow.id for follow in user.following]))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        user = g.user
+        if timelines.ensure_built(user.id):
+            # Kept, so the next visit reads it and fan-out reaches it
+            db.session.commit()
+
+        message_ids = timelines.message_ids(user.id, page_size() + 1,
+                                            before_key((datetime, int)))
+
+        if message_ids is None:
+            messages = paginate_messages(message_views(user.id).filter(
+                Message.user_id.in_(timeline_author_ids(user.id))), convert=to_views)
+        else:
+            messages = make_page(views_by_ids(message_ids, user.id),
+                                 page_size(), message_key)
 
-        return render_template('home.html', messages=messages, user=user)
+        return render_list('home.html', 'messages/_items.html', messages=messages, user=user)
 
     else:
         return render_template('home-anon.html')
@@ -377,18 +641,124 @@ def homepage():
     
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands (run like: flask reconcile-counters)
+
+
+@app.cli.command('reconcile-counters')
+@click.option('--background', is_flag=True,
+              help='Queue a job instead of running it here.')
+def reconcile_counters(background):
+    """Recompute every user's message/follow/like counters."""
+
+    if background:
+        jobs.enqueue('reconcile_counters')
+    else:
+        counters.reconcile()
+    db.session.commit()
+
+
+@app.cli.command('refresh-suggestions')
+@click.option('--background', is_flag=True,
+              help='Queue a job instead of running it here.')
+def refresh_suggestions(background):
+    """Recompute everyone's "who to follow" suggestions."""
+
+    if background:
+        jobs.enqueue('refresh_suggestions')
+        db.session.commit()
+    else:
+        recommendations.refresh()
+
+
+@app.cli.command('rebuild-trending')
+def rebuild_trending():
+    """Replay recent messages and likes into the trending counts, and show them.
+
+    Web processes replay on their own; this checks what they will see.
+    """
+
+    trending.rebuild()
+    for window, lists in trending.panel().items():
+        print(f"{window}:")
+        print("  " + "  ".join(f"#{tag} ({count})" for tag, count in lists['hashtags']))
+        for message, likes in lists['messages']:
+            print(f"  {likes:>5}  @{message['username']}: {message['text']}")
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress static/ into ASSETS_DIRECTORY."""
+
+    assets.build()
+
+
+@app.cli.command('reindex-messages')
+def reindex_messages():
+    """Rebuild the message full-text index from the messages table."""
+
+    message_search.reindex()
+
+
+@app.cli.command('create-search-indexes')
+def create_search_indexes():
+    """Install pg_trgm and the username search indexes (Postgres)."""
+
+    user_search.create_indexes()
+
+
+@app.cli.command('bulk-load')
+@click.option('--directory', default='generator', show_default=True,
+              help='Directory of <table>.csv files.')
+@click.option('--chunk-size', default=bulk_load.CHUNK_SIZE, show_default=True,
+              help='Rows per transaction.')
+@click.option('--restart', is_flag=True,
+              help='Ignore a checkpoint left by a failed load.')
+def bulk_load_csvs(directory, chunk_size, restart):
+    """Drop and reload every table from CSVs, resuming a failed load."""
+
+    bulk_load.load(directory, chunk_size, restart)
+
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help='List pending migrations only.')
+def migrate(status):
+    """Apply pending schema migrations (see migrations/)."""
+
+    if status:
+        for version, module in migrations.pending():
+            print(version)
+    else:
+        migrations.upgrade()
+
+
+@app.cli.command('check-query-plans')
+def check_query_plans():
+    """EXPLAIN the hot routes' queries; fail on sequential scans (Postgres)."""
+
+    problems = query_plans.check(app, CURR_USER_KEY)
+    for url, table, statement in problems:
+        print(f"{url}: Seq Scan on {table}\n    {' '.join(statement.split())}")
+    if problems:
+        raise SystemExit(1)
+    print("no sequential scans on large tables")
+
+
+@app.cli.command('run-jobs')
+@click.option('--workers', default=1, show_default=True,
+              help='Worker threads.')
+@click.option('--once', is_flag=True,
+              help='Run the jobs due now, then exit.')
+def run_jobs(workers, once):
+    """Run background jobs (see jobs.py) until interrupted."""
+
+    if once:
+        print(f"ran {jobs.run_pending()} jobs")
+        return
+
+    jobs.workers = workers
+    jobs.start_workers()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        jobs.stop_workers()
@@ -0,0 +1,198 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file under static/ to static/dist/
+with a content hash in its name (style.css -> style.1a2b3c4d5e6f.css),
+rewrites /static/ URLs inside stylesheets to the hashed names, and writes
+`.gz` and `.br` (with the optional `brotli` package) variants of text
+assets where they are smaller. manifest.json maps each original path to
+its hashed one.
+
+Templates link assets through `asset_url()`, also a filter for stored
+URLs such as `user.image_url`. With a manifest it returns
+/assets/<hashed name>, served with a one-year immutable Cache-Control
+and the best encoding the client accepts. Without one (a checkout that
+hasn't been built) it returns /static/<path>?v=<hash>, so the immutable
+static caching still never serves a stale file.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+
+from flask import abort, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE = {'.css', '.js', '.svg', '.txt', '.json', '.html', '.ico'}
+
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+STATIC_URL = re.compile(r'/static/([\w./-]+)')
+
+
+class Assets:
+    """Resolves asset paths to fingerprinted URLs and serves them."""
+
+    def __init__(self):
+        self.source = None
+        self.directory = None
+        self.manifest = {}
+        self._hashes = {}
+
+    def init_app(self, app):
+        """Read ASSETS_* settings, load the manifest and add the /assets route."""
+
+        self.source = app.static_folder
+        self.directory = app.config.setdefault(
+            'ASSETS_DIRECTORY', os.path.join(app.static_folder, 'dist'))
+        self.manifest = _load_manifest(self.directory)
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.serve)
+        app.add_template_global(self.url, 'asset_url')
+        app.add_template_filter(self.url, 'asset_url')
+        app.extensions['assets'] = self
+
+    def build(self, report=print):
+        """Build static/ into ASSETS_DIRECTORY and start linking to it."""
+
+        self.manifest = build(self.source, self.directory, report)
+
+    def url(self, path):
+        """The fingerprinted URL of a static file.
+
+        `path` is relative to static/ or a /static/ URL; anything else (such
+        as an image on another host) is returned unchanged.
+        """
+
+        if not path:
+            return path
+        if path.startswith('/static/'):
+            path = path[len('/static/'):]
+        elif '://' in path or path.startswith('/'):
+            return path
+
+        hashed = self.manifest.get(path)
+        if hashed:
+            return f'/assets/{hashed}'
+
+        digest = self._source_hash(path)
+        return f'/static/{path}?v={digest}' if digest else f'/static/{path}'
+
+    def serve(self, filename):
+        """Send a built asset in the best encoding `Accept-Encoding` allows."""
+
+        path = safe_join(self.directory, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+
+        encoding = None
+        for name, suffix in ENCODINGS:
+            if request.accept_encodings[name] and os.path.isfile(path + suffix):
+                encoding, path = name, path + suffix
+                break
+
+        response = send_file(path, mimetype=mimetypes.guess_type(filename)[0],
+                             conditional=True, max_age=31536000)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def _source_hash(self, path):
+        """Content hash of an unbuilt static file, recomputed when it changes."""
+
+        full = safe_join(self.source, path)
+        try:
+            mtime = os.stat(full).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+
+        cached = self._hashes.get(path)
+        if cached is None or cached[0] != mtime:
+            with open(full, 'rb') as f:
+                cached = self._hashes[path] = (mtime, _digest(f.read()))
+        return cached[1]
+
+
+def build(source, directory, report=print):
+    """Fingerprint and precompress every file under `source` into `directory`.
+
+    Files from earlier builds are kept, so pages rendered before a deploy
+    still find their assets. Returns the manifest.
+    """
+
+    paths = sorted(os.path.relpath(os.path.join(root, name), source)
+                   for root, dirs, files in os.walk(source)
+                   if not os.path.abspath(root).startswith(os.path.abspath(directory))
+                   for name in files if not name.startswith('.'))
+
+    # Stylesheets last, so the URLs they contain can be rewritten
+    manifest = {}
+    for path in sorted(paths, key=lambda path: path.endswith('.css')):
+        with open(os.path.join(source, path), 'rb') as f:
+            content = f.read()
+        if path.endswith('.css'):
+            content = STATIC_URL.sub(
+                lambda match: (f'/assets/{manifest[match.group(1)]}'
+                               if match.group(1) in manifest else match.group(0)),
+                content.decode()).encode()
+
+        stem, ext = os.path.splitext(path)
+        hashed = f'{stem}.{_digest(content)}{ext}'
+        _write(os.path.join(directory, hashed), content)
+        manifest[path] = hashed
+
+        sizes = _precompress(os.path.join(directory, hashed), content, ext)
+        report(f"{path} -> {hashed} ({len(content)} bytes"
+               + ''.join(f", {name} {size}" for name, size in sizes) + ")")
+
+    path = os.path.join(directory, 'manifest.json')
+    _write(path + '.tmp', json.dumps(manifest, indent=2, sort_keys=True).encode())
+    os.replace(path + '.tmp', path)
+    return manifest
+
+
+def _precompress(path, content, ext):
+    """Write the .gz and .br variants that are smaller; returns their sizes."""
+
+    if ext not in COMPRESSIBLE:
+        return []
+
+    variants = [('gzip', '.gz', gzip.compress(content, 9, mtime=0))]
+    if brotli is not None:
+        variants.append(('br', '.br', brotli.compress(content, quality=11)))
+
+    sizes = []
+    for name, suffix, compressed in variants:
+        if len(compressed) < len(content):
+            _write(path + suffix, compressed)
+            sizes.append((name, len(compressed)))
+    return sizes
+
+
+def _load_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _digest(content):
+    return hashlib.sha256(content).hexdigest()[:12]
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+assets = Assets()
@@ -0,0 +1,17 @@
+"""Benchmarks for Warbler.
+
+Run them from the repo root as modules (python -m benchmarks.<name>) against
+a scratch database; most of them create and delete their own data.
+"""
+
+from metrics import percentile
+
+
+def latency_summary(samples, elapsed):
+    """Count, throughput and p50/p95/p99 (in ms) of latency samples in seconds."""
+
+    return dict(count=len(samples),
+                throughput=round(len(samples) / elapsed, 1) if elapsed else 0.0,
+                p50_ms=round(percentile(samples, 50) * 1000, 2),
+                p95_ms=round(percentile(samples, 95) * 1000, 2),
+                p99_ms=round(percentile(samples, 99) * 1000, 2))
@@ -0,0 +1,99 @@
+"""Login latency under concurrent load.
+
+Drives POST /login from many simulated clients at once while one more
+client keeps loading a cheap page, and reports p50/p95/p99 for both. Run
+it with a few BCRYPT_WORKERS settings to see the pool cap login CPU while
+the other traffic stays fast:
+
+    DATABASE_URL=postgresql:///warbler-bench \
+        python -m benchmarks.login --concurrency 32 --logins 10 --workers 2
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from benchmarks import latency_summary
+
+USERNAME = 'bench-login'
+PASSWORD = 'bench-password'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='simultaneous logging-in clients')
+    parser.add_argument('--logins', type=int, default=10,
+                        help='logins per client')
+    parser.add_argument('--rounds', type=int, default=12,
+                        help='bcrypt work factor')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='bcrypt pool size (default: CPU count)')
+    args = parser.parse_args()
+
+    from app import app
+    from hashing import passwords
+    from models import db, User
+    from ratelimit import limiter
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    # Measure the routes, not the throttle in front of them
+    limiter.enabled = False
+    passwords.rounds = args.rounds
+    if args.workers:
+        passwords.workers = args.workers
+        passwords.max_pending = 4 * args.workers
+
+    db.create_all()
+    User.query.filter_by(username=USERNAME).delete()
+    User.signup(username=USERNAME, email=f'{USERNAME}@example.com',
+                password=PASSWORD, image_url=None)
+    db.session.commit()
+
+    logins, pages = [], []
+    done = threading.Event()
+
+    def log_in():
+        client = app.test_client()
+        for _ in range(args.logins):
+            started = time.perf_counter()
+            resp = client.post('/login', data=dict(username=USERNAME,
+                                                   password=PASSWORD))
+            logins.append(time.perf_counter() - started)
+            assert resp.status_code in (302, 503), resp.status_code
+
+    def browse():
+        client = app.test_client()
+        while not done.is_set():
+            started = time.perf_counter()
+            client.get('/login')
+            pages.append(time.perf_counter() - started)
+
+    browser = threading.Thread(target=browse)
+    clients = [threading.Thread(target=log_in) for _ in range(args.concurrency)]
+
+    started = time.perf_counter()
+    browser.start()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    done.set()
+    browser.join()
+
+    User.query.filter_by(username=USERNAME).delete()
+    db.session.commit()
+
+    print(json.dumps(dict(settings=dict(concurrency=args.concurrency,
+                                        rounds=passwords.rounds,
+                                        workers=passwords.workers),
+                          login=latency_summary(logins, elapsed),
+                          other_page=latency_summary(pages, elapsed),
+                          hasher=passwords.stats.summary()),
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
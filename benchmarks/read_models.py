@@ -0,0 +1,170 @@
+"""Memory and throughput of a 100-message timeline: ORM entities vs read models.
+
+Seeds a reader following a few authors, then builds and renders their home
+timeline page both ways:
+
+- orm: Message entities with authors selectin-loaded, plus a query for
+  which of them the reader likes (how the page was built before
+  read_models.py)
+- views: read_models.message_views() rows turned into MessageViews
+
+and reports pages per second, the memory the page's objects hold once
+built, and the peak allocated while rendering it:
+
+    DATABASE_URL=postgresql:///warbler-bench \\
+        python -m benchmarks.read_models --messages 100 --rounds 200
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+
+PREFIX = 'bench-views'
+
+
+def seed(authors, messages):
+    """Create a reader following `authors` users with `messages` messages."""
+
+    from models import db, Follows, Likes, Message, User
+
+    cleanup()
+    reader = User(username=PREFIX, email=f'{PREFIX}@test.com', password='-')
+    writers = [User(username=f'{PREFIX}-{n}', email=f'{PREFIX}-{n}@test.com',
+                    password='-', image_url='/static/images/default-pic.png')
+               for n in range(authors)]
+    db.session.add_all([reader, *writers])
+    db.session.flush()
+    db.session.add_all([Follows(user_following_id=reader.id,
+                                user_being_followed_id=writer.id)
+                        for writer in writers])
+
+    rows = [Message(text=f'benchmark warble {n} ' + 'x' * 80,
+                    user_id=writers[n % authors].id, like_count=1)
+            for n in range(messages)]
+    db.session.add_all(rows)
+    db.session.flush()
+    db.session.add_all([Likes(user_id=reader.id, message_id=msg.id)
+                        for msg in rows[::3]])
+    db.session.commit()
+    return reader.id
+
+
+def cleanup():
+    from models import db, User
+
+    User.query.filter(User.username.startswith(PREFIX)).delete(
+        synchronize_session=False)
+    db.session.commit()
+
+
+def orm_page(reader_id, limit):
+    from sqlalchemy.orm import selectinload
+
+    from app import timeline_author_ids
+    from models import db, Message, User
+
+    messages = (Message.query
+                .options(selectinload(Message.user))
+                .filter(Message.user_id.in_(timeline_author_ids(reader_id)))
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(limit)
+                .all())
+    reader = db.session.get(User, reader_id)
+    liked_ids = reader.liked_message_ids([msg.id for msg in messages])
+    for msg in messages:
+        # What the template now reads
+        msg.liked = msg.id in liked_ids
+    return messages
+
+
+def views_page(reader_id, limit):
+    from app import timeline_author_ids
+    from models import Message
+    from read_models import message_views, to_views
+
+    return to_views(message_views(reader_id)
+                    .filter(Message.user_id.in_(timeline_author_ids(reader_id)))
+                    .order_by(Message.timestamp.desc(), Message.id.desc())
+                    .limit(limit))
+
+
+def run(build, reader_id, limit, rounds):
+    """Pages per second of `build` + rendering, bytes held and render peak."""
+
+    from flask import render_template
+
+    from app import app
+    from models import db
+    from pagination import Page
+
+    def page():
+        messages = build(reader_id, limit)
+        render_template('messages/_items.html', messages=Page(messages, None))
+        return messages
+
+    with app.test_request_context('/'):
+        db.session.remove()
+        page()
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            # A fresh session each time, as each request gets
+            db.session.remove()
+            page()
+        elapsed = time.perf_counter() - started
+
+        db.session.remove()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        messages = build(reader_id, limit)
+        held = sum(stat.size_diff for stat in
+                   tracemalloc.take_snapshot().compare_to(before, 'filename'))
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        render_template('messages/_items.html', messages=Page(messages, None))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        db.session.remove()
+
+    return dict(messages=len(messages),
+                pages_per_second=round(rounds / elapsed, 1),
+                ms_per_page=round(elapsed / rounds * 1000, 2),
+                held_kb=round(held / 1024, 1),
+                render_peak_kb=round((peak - baseline) / 1024, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--authors', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=100,
+                        help='messages on the timeline page')
+    parser.add_argument('--rounds', type=int, default=200)
+    args = parser.parse_args()
+
+    # Importing the app connects the models and pushes an app context
+    import app  # noqa: F401
+    from ratelimit import limiter
+
+    limiter.enabled = False
+
+    reader_id = seed(args.authors, args.messages)
+    try:
+        results = dict(
+            orm=run(orm_page, reader_id, args.messages, args.rounds),
+            views=run(views_page, reader_id, args.messages, args.rounds))
+    finally:
+        cleanup()
+
+    results['speedup'] = round(results['views']['pages_per_second']
+                               / results['orm']['pages_per_second'], 2)
+    results['memory_ratio'] = round(results['orm']['held_kb']
+                                    / max(0.1, results['views']['held_kb']), 1)
+    print(json.dumps(results, indent=2))
+    print(f"views: {results['speedup']}x pages/s, "
+          f"{results['memory_ratio']}x less memory held", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Throughput, latency and SQL statements per request for the main routes.
+
+Seeds a generated dataset of the chosen size (generator/create_csvs.py +
+bulk_load.py), then runs simulated logged-in sessions concurrently, each
+picking routes from a weighted mix, through the Flask test client. Results
+are printed and saved as JSON; pass an earlier result as --baseline to see
+the change per route:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.routes \\
+        --users 10000 --messages 200000 --follows 300000 --sessions 16
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.routes \\
+        --no-seed --baseline benchmarks/results/routes-<commit>.json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from benchmarks import latency_summary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# endpoint: (weight, method, url template)
+MIX = {
+    'homepage': (40, 'GET', '/'),
+    'users_show': (20, 'GET', '/users/{user_id}'),
+    'list_users': (10, 'GET', '/users'),
+    'users_likes': (10, 'GET', '/users/{user_id}/likes'),
+    'add_like': (10, 'POST', '/users/add_like/{message_id}'),
+    'add_follow': (5, 'POST', '/users/follow/{user_id}'),
+    'messages_add': (5, 'POST', '/messages/new'),
+}
+
+
+def seed(args):
+    """Generate and bulk-load a dataset of the requested size."""
+
+    import bulk_load
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+             '--users', str(args.users), '--messages', str(args.messages),
+             '--follows', str(args.follows), '--seed', str(args.seed),
+             '--out', directory],
+            check=True)
+        bulk_load.load(directory, restart=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline):
+    """Per-route p50/p95 and statement ratios against a baseline result."""
+
+    changes = {}
+    for endpoint, now in results['routes'].items():
+        before = baseline['routes'].get(endpoint)
+        if not before:
+            continue
+        changes[endpoint] = {
+            key: round(now[key] / before[key], 2) if before[key] else None
+            for key in ('throughput', 'p50_ms', 'p95_ms', 'statements')}
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=30000)
+    parser.add_argument('--no-seed', action='store_true',
+                        help='reuse the data already in the database')
+    parser.add_argument('--sessions', type=int, default=8,
+                        help='concurrent logged-in sessions')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per session')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None,
+                        help='JSON path (default: benchmarks/results/'
+                             'routes-<commit>.json)')
+    parser.add_argument('--baseline', default=None,
+                        help='earlier JSON result to compare against')
+    args = parser.parse_args()
+
+    from sqlalchemy import event, func, select
+
+    from app import app, CURR_USER_KEY
+    from models import db, Message, User
+    from ratelimit import limiter
+
+    app.config['WTF_CSRF_ENABLED'] = False
+    # Measure the routes, not the throttle in front of them
+    limiter.enabled = False
+
+    if not args.no_seed:
+        seed(args)
+
+    user_count = db.session.execute(select(func.max(User.id))).scalar()
+    message_count = db.session.execute(select(func.max(Message.id))).scalar()
+    db.session.commit()
+
+    # Statements are counted per thread; each session runs on its own thread
+    counts = threading.local()
+
+    @event.listens_for(db.engine, 'before_cursor_execute')
+    def count_statement(*args):
+        counts.statements = getattr(counts, 'statements', 0) + 1
+
+    latencies = defaultdict(list)
+    statements = defaultdict(list)
+    errors = defaultdict(int)
+    endpoints = list(MIX)
+    weights = [MIX[endpoint][0] for endpoint in endpoints]
+
+    def session(number):
+        rng = random.Random(args.seed + number)
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = rng.randint(1, user_count)
+
+        for endpoint in rng.choices(endpoints, weights, k=args.requests):
+            _, method, url = MIX[endpoint]
+            url = url.format(user_id=rng.randint(1, user_count),
+                             message_id=rng.randint(1, message_count))
+            data = ({'text': f'benchmark {rng.random()}'}
+                    if endpoint == 'messages_add' else None)
+
+            counts.statements = 0
+            started = time.perf_counter()
+            resp = client.open(url, method=method, data=data)
+            # Streamed lists render and query while their body is read
+            resp.get_data()
+            resp.close()
+            latencies[endpoint].append(time.perf_counter() - started)
+            statements[endpoint].append(counts.statements)
+            if resp.status_code >= 400:
+                errors[endpoint] += 1
+
+    threads = [threading.Thread(target=session, args=(n,))
+               for n in range(args.sessions)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    routes = {}
+    for endpoint in endpoints:
+        routes[endpoint] = latency_summary(latencies[endpoint], elapsed)
+        routes[endpoint]['statements'] = round(
+            sum(statements[endpoint]) / max(1, len(statements[endpoint])), 1)
+        routes[endpoint]['errors'] = errors[endpoint]
+
+    everything = [sample for samples in latencies.values() for sample in samples]
+    results = dict(commit=git_commit(),
+                   date=datetime.now().isoformat(timespec='seconds'),
+                   settings=dict(users=user_count, messages=message_count,
+                                 sessions=args.sessions,
+                                 requests=args.requests, seed=args.seed),
+                   overall=latency_summary(everything, elapsed),
+                   routes=routes)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['baseline'] = dict(path=args.baseline,
+                                       ratios=compare(results, json.load(f)))
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"routes-{results['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    print(json.dumps(results, indent=2))
+    print(f"saved to {output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
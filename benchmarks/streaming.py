@@ -0,0 +1,132 @@
+"""Time to first byte and peak memory of a followers page, streamed or not.
+
+Gives one user the largest number of followers asked for, then loads their
+followers page with PAGE_SIZE set to each list size, with STREAM_LISTS on
+and off. Every measurement runs in a fresh process so its peak RSS is its
+own:
+
+    DATABASE_URL=postgresql:///warbler-bench \\
+        python -m benchmarks.streaming --sizes 1000 10000 100000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+PREFIX = 'bench-stream'
+
+
+def seed(count):
+    """Create a user followed by `count` others; returns the user's id."""
+
+    from sqlalchemy import insert
+
+    from models import db, Follows, User
+
+    cleanup()
+    target = User(username=PREFIX, email=f'{PREFIX}@test.com', password='-')
+    db.session.add(target)
+    db.session.flush()
+
+    for start in range(0, count, 10_000):
+        names = [f'{PREFIX}-{n}' for n in range(start, min(count, start + 10_000))]
+        db.session.execute(insert(User), [
+            dict(username=name, email=f'{name}@test.com', password='-',
+                 image_url='/static/images/default-pic.png',
+                 header_image_url='/static/images/warbler-hero.jpg')
+            for name in names])
+        ids = db.session.execute(
+            db.select(User.id).where(User.username.in_(names))).scalars()
+        db.session.execute(insert(Follows), [
+            dict(user_being_followed_id=target.id, user_following_id=user_id)
+            for user_id in ids])
+    db.session.commit()
+    return target.id
+
+
+def cleanup():
+    from models import db, User
+
+    User.query.filter(User.username.startswith(PREFIX)).delete(
+        synchronize_session=False)
+    db.session.commit()
+
+
+def measure(user_id, size, stream):
+    """TTFB, total time and peak RSS growth of one page load, in this process."""
+
+    from app import app, CURR_USER_KEY
+
+    app.config.update(PAGE_SIZE=size, STREAM_LISTS=stream)
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = user_id
+
+    # Warm up imports, templates and the connection on a tiny page
+    app.config['PAGE_SIZE'] = 1
+    client.get(f'/users/{user_id}/followers').close()
+    app.config['PAGE_SIZE'] = size
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    started = time.perf_counter()
+    resp = client.get(f'/users/{user_id}/followers', buffered=False)
+    first, length = None, 0
+    for chunk in resp.response:
+        if first is None and chunk:
+            first = time.perf_counter() - started
+        length += len(chunk)
+    total = time.perf_counter() - started
+    resp.close()
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return dict(size=size, stream=stream, status=resp.status_code,
+                ttfb_ms=round(first * 1000, 1), total_ms=round(total * 1000, 1),
+                bytes=length,
+                # ru_maxrss is in KiB on Linux
+                rss_growth_mb=round((peak - before) / 1024, 1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 100000],
+                        help='followers shown on the page')
+    parser.add_argument('--measure', type=int, nargs=3, default=None,
+                        metavar=('USER_ID', 'SIZE', 'STREAM'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Importing the app connects the models and pushes an app context
+    import app  # noqa: F401
+    from ratelimit import limiter
+
+    limiter.enabled = False
+
+    if args.measure:
+        user_id, size, stream = args.measure
+        print(json.dumps(measure(user_id, size, bool(stream))))
+        return
+
+    user_id = seed(max(args.sizes))
+    try:
+        results = []
+        for size in args.sizes:
+            for stream in (0, 1):
+                out = subprocess.run(
+                    [sys.executable, '-m', 'benchmarks.streaming',
+                     '--measure', str(user_id), str(size), str(stream)],
+                    capture_output=True, text=True, check=True, env=os.environ)
+                results.append(json.loads(out.stdout.splitlines()[-1]))
+                print(json.dumps(results[-1]), file=sys.stderr)
+    finally:
+        cleanup()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
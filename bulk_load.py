@@ -0,0 +1,215 @@
+"""Stream the generator CSVs into the database.
+
+Each `<table>.csv` in the directory is loaded in parent-before-child
+order, CHUNK_SIZE rows per transaction: `COPY ... FROM STDIN` on Postgres,
+a batched executemany everywhere else. Secondary indexes are dropped for
+the load and built once at the end, then id sequences are moved past the
+loaded ids, the counter columns reconciled and migrations applied (which
+builds the search indexes).
+
+Progress is checkpointed after every chunk, so a failed load started
+again picks up at the first uncommitted chunk instead of starting over.
+Run it with `flask bulk-load` (or `python seed.py`).
+"""
+
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import DateTime, Integer, func, select, text
+
+import counters
+import migrations
+from models import db
+
+CHUNK_SIZE = 50000
+CHECKPOINT = '.load_checkpoint.json'
+
+
+def load(directory='generator', chunk_size=CHUNK_SIZE, restart=False,
+         report=print):
+    """Load every `<table>.csv` in `directory`; returns total rows loaded."""
+
+    checkpoint_path = os.path.join(directory, CHECKPOINT)
+    checkpoint = None if restart else _read_checkpoint(checkpoint_path)
+
+    if checkpoint is None:
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+        checkpoint = {}
+        _write_checkpoint(checkpoint_path, checkpoint)
+    else:
+        report(f"resuming from {checkpoint_path}")
+
+    tables = [table for table in db.metadata.sorted_tables
+              if os.path.exists(os.path.join(directory, f'{table.name}.csv'))]
+    _drop_indexes(tables)
+
+    started = time.perf_counter()
+    total = 0
+    for table in tables:
+        if checkpoint.get(table.name) == 'complete':
+            continue
+
+        # Chunks commit atomically, so the rows already in the table are
+        # exactly the ones to skip, even if the last checkpoint write was lost
+        done = db.session.execute(
+            select(func.count()).select_from(table)).scalar()
+
+        path = os.path.join(directory, f'{table.name}.csv')
+        for rows in _load_table(table, path, done, chunk_size):
+            checkpoint[table.name] = done = done + rows
+            _write_checkpoint(checkpoint_path, checkpoint)
+            total += rows
+            elapsed = time.perf_counter() - started
+            report(f"{table.name}: {done} rows "
+                   f"({total / elapsed:,.0f} rows/s overall)")
+
+        checkpoint[table.name] = 'complete'
+        _write_checkpoint(checkpoint_path, checkpoint)
+
+    report("building indexes")
+    _create_indexes(tables)
+    _reset_sequences(tables)
+    counters.reconcile()
+    db.session.commit()
+    migrations.upgrade(report)
+    if _is_postgres():
+        _autocommit("ANALYZE")
+
+    os.remove(checkpoint_path)
+    elapsed = time.perf_counter() - started
+    report(f"loaded {total} rows in {elapsed:.1f}s")
+    return total
+
+
+def _load_table(table, path, skip, chunk_size):
+    """Insert the rows of `path` after the first `skip`, a chunk at a time.
+
+    Yields the row count of each committed chunk.
+    """
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        unknown = set(header) - set(table.columns.keys())
+        if unknown:
+            raise ValueError(f"{path}: no such columns {sorted(unknown)}")
+
+        # CSVs for tables with a serial id leave it out; rows are numbered
+        # here so a retried chunk gets the same ids as the failed attempt
+        numbered = 'id' in table.columns and 'id' not in header
+        columns = ['id', *header] if numbered else header
+        insert = _copy if _is_postgres() else _executemany
+
+        row_id = skip
+        reader = islice(reader, skip, None)
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                return
+
+            if numbered:
+                chunk = [[row_id + n, *row] for n, row in
+                         enumerate(chunk, start=1)]
+                row_id += len(chunk)
+
+            insert(table, columns, chunk)
+            db.session.commit()
+            yield len(chunk)
+
+
+def _copy(table, columns, rows):
+    """COPY `rows` into `table` through the session's connection."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        buffer)
+
+
+def _executemany(table, columns, rows):
+    """INSERT `rows` into `table` with one executemany."""
+
+    convert = [_converter(table.columns[name]) for name in columns]
+    db.session.execute(table.insert(), [
+        {name: fn(value) for name, fn, value in zip(columns, convert, row)}
+        for row in rows])
+
+
+def _converter(column):
+    """Parse CSV text for `column`; empty fields are NULL, as with COPY."""
+
+    if isinstance(column.type, Integer):
+        parse = int
+    elif isinstance(column.type, DateTime):
+        parse = datetime.fromisoformat
+    else:
+        parse = str
+
+    return lambda value: parse(value) if value != '' else None
+
+
+def _drop_indexes(tables):
+    bind = db.session.connection()
+    for table in tables:
+        for index in table.indexes:
+            index.drop(bind, checkfirst=True)
+    db.session.commit()
+
+
+def _create_indexes(tables):
+    bind = db.session.connection()
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+    db.session.commit()
+
+
+def _reset_sequences(tables):
+    """Move each serial id sequence past the largest loaded id (Postgres)."""
+
+    if not _is_postgres():
+        return
+
+    for table in tables:
+        if 'id' not in table.columns:
+            continue
+        largest = db.session.execute(select(func.max(table.c.id))).scalar()
+        if largest is not None:
+            db.session.execute(
+                text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :id)"),
+                {'table': table.name, 'id': largest})
+
+
+def _autocommit(sql):
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(text(sql))
+
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_checkpoint(path, checkpoint):
+    # Write-then-rename so a crash never leaves a torn checkpoint
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,118 @@
+"""HTTP caching policy for Warbler.
+
+Pages wrapped in `conditional()` get a strong ETag and Last-Modified
+computed from a cheap data version (user `updated_at` stamps, message
+ids) before the view runs; a matching If-None-Match / If-Modified-Since
+gets `304 Not Modified` without rendering. Fingerprinted static files
+(built /assets, and /static URLs with a `?v=` content hash; see
+assets.py) are cached for a year as immutable. Other static files are
+cached briefly and then revalidated against their ETag, since the same
+URL gets new content on deploy. Everything else is no-store.
+
+The Cache-Control for any endpoint can be overridden in the CACHE_CONTROL
+setting, e.g. {'messages_show': 'public, max-age=60'}.
+"""
+
+import hashlib
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+
+REVALIDATE = 'private, no-cache'
+NO_STORE = 'no-cache, no-store, must-revalidate'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+STATIC = 'public, max-age=300'
+
+
+def init_app(app):
+    """Install the Cache-Control policy for every response."""
+
+    app.config.setdefault('CACHE_CONTROL', {})
+    app.config.setdefault('STATIC_CACHE_CONTROL', STATIC)
+    app.after_request(apply_policy)
+
+
+def cache_control(endpoint, default):
+    """The Cache-Control for `endpoint`, honouring CACHE_CONTROL overrides."""
+
+    return current_app.config['CACHE_CONTROL'].get(endpoint, default)
+
+
+def apply_policy(response):
+    """Set Cache-Control on responses whose view did not set one."""
+
+    if request.endpoint == 'assets' or (request.endpoint == 'static'
+                                        and 'v' in request.args):
+        default = IMMUTABLE
+    elif request.endpoint == 'static':
+        default = current_app.config['STATIC_CACHE_CONTROL']
+    elif 'Cache-Control' in response.headers and response.headers.get('ETag'):
+        return response
+    else:
+        default = NO_STORE
+        response.headers['Pragma'] = 'no-cache'
+        response.headers['Expires'] = '0'
+
+    response.headers['Cache-Control'] = cache_control(request.endpoint, default)
+    return response
+
+
+def conditional(version):
+    """Decorate a GET view with ETag / Last-Modified revalidation.
+
+    `version(**view_args)` returns a tuple identifying the data the page
+    shows (None for a page that cannot be versioned). datetimes in the
+    tuple also set Last-Modified. The viewer and query string are always
+    part of the ETag.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(**view_args):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(**view_args)
+
+            data = version(**view_args)
+            if data is None:
+                return view(**view_args)
+
+            viewer = (g.user.id, g.user.updated_at) if g.user else None
+            etag = hashlib.sha1(
+                repr((request.full_path, viewer, data)).encode()).hexdigest()
+
+            stamps = [value for value in (*data, *(viewer or ()))
+                      if isinstance(value, datetime)]
+            last_modified = max(stamps).replace(microsecond=0) if stamps else None
+
+            if _not_modified(etag, last_modified):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**view_args))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = cache_control(request.endpoint,
+                                                              REVALIDATE)
+            response.headers['Vary'] = 'Cookie'
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def _not_modified(etag, last_modified):
+    """Does the request's validator match this version of the page?"""
+
+    # Weak comparison: compression.py weakens the ETags of what it compresses
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified:
+        return request.if_modified_since.replace(tzinfo=None) >= last_modified
+
+    return False
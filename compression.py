@@ -0,0 +1,269 @@
+"""gzip / brotli response compression, as WSGI middleware.
+
+Responses whose type is in COMPRESSION_MIMETYPES are compressed with the
+best encoding the client's Accept-Encoding allows: brotli (with the
+optional `brotli` package), then gzip, at the COMPRESSION_LEVELS given.
+Bodies under COMPRESSION_MIN_SIZE bytes, HEAD and range requests, and
+responses that already have a Content-Encoding (the precompressed files
+under /assets) pass through unchanged. Every response of a compressible
+type gets `Vary: Accept-Encoding`, compressed or not.
+
+Buffered responses are compressed in one go and keep a Content-Length.
+Streamed ones (see pagination.StreamedPage) are compressed as they go
+and flushed every COMPRESSION_FLUSH_SIZE bytes of input, so the browser
+still gets the top of the page first. A compressed response's ETag
+becomes weak, since its bytes differ from the uncompressed ones.
+
+Every compressed response adds the ratio and the CPU time it took to the
+request's instrumentation: a `compress` entry in Server-Timing (buffered
+responses only, as a streamed one's headers are gone by the time it is
+known), one JSON line on the `warbler.requests` logger, and metrics.
+"""
+
+import json
+import time
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+from instrumentation import logger
+from metrics import COMPRESSION_CPU, COMPRESSION_RATIO
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript',
+             'application/javascript', 'application/json', 'image/svg+xml'}
+
+LEVELS = {'br': 4, 'gzip': 6}
+
+
+class Compression:
+    """Wraps an app's WSGI callable to compress its responses."""
+
+    def __init__(self):
+        self.enabled = True
+        self.levels = LEVELS
+        self.min_size = 1024
+        self.flush_size = 8192
+        self.mimetypes = MIMETYPES
+        self.wsgi_app = None
+
+    def init_app(self, app):
+        """Read COMPRESSION_* settings and wrap `app.wsgi_app`."""
+
+        self.enabled = app.config.setdefault('COMPRESSION_ENABLED', True)
+        self.levels = app.config.setdefault('COMPRESSION_LEVELS', LEVELS)
+        self.min_size = app.config.setdefault('COMPRESSION_MIN_SIZE', 1024)
+        self.flush_size = app.config.setdefault('COMPRESSION_FLUSH_SIZE', 8192)
+        self.mimetypes = app.config.setdefault('COMPRESSION_MIMETYPES', MIMETYPES)
+        self.wsgi_app = app.wsgi_app
+        app.wsgi_app = self
+        app.extensions['compression'] = self
+
+    def __call__(self, environ, start_response):
+        if not self.enabled:
+            return self.wsgi_app(environ, start_response)
+
+        # Compressible responses vary on Accept-Encoding even when not compressed
+        response = _Response(self, environ, self.negotiate(environ), start_response)
+        body = self.wsgi_app(environ, response.start_response)
+        return response.body(body)
+
+    def negotiate(self, environ):
+        """The encoding to use for this request, or None."""
+
+        if environ['REQUEST_METHOD'] == 'HEAD' or 'HTTP_RANGE' in environ:
+            return None
+
+        accepted = parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding in ('br', 'gzip'):
+            if encoding == 'br' and brotli is None:
+                continue
+            if encoding in self.levels and accepted[encoding]:
+                return encoding
+        return None
+
+    def compressor(self, encoding):
+        """A (compress, flush, finish) triple of callables for `encoding`."""
+
+        level = self.levels[encoding]
+        if encoding == 'br':
+            stream = brotli.Compressor(quality=level)
+            return stream.process, stream.flush, stream.finish
+
+        stream = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return (stream.compress, lambda: stream.flush(zlib.Z_SYNC_FLUSH),
+                lambda: stream.flush(zlib.Z_FINISH))
+
+
+class _Response:
+    """One response on its way through the middleware."""
+
+    def __init__(self, compression, environ, encoding, start_response):
+        self.compression = compression
+        self.path = environ.get('PATH_INFO')
+        self.encoding = encoding
+        self.status = None
+        self.headers = None
+        self.compress = False
+        self.passthrough = False
+        self.bytes_in = self.bytes_out = 0
+        self.cpu = 0.0
+        self._start_response = start_response
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info or self.passthrough:
+            return self._start_response(status, headers, exc_info)
+
+        self.status, self.headers = status, Headers(headers)
+        mimetype = self.headers.get('Content-Type', '').split(';')[0].strip()
+        if mimetype in self.compression.mimetypes:
+            vary = self.headers.get('Vary')
+            if not vary:
+                self.headers['Vary'] = 'Accept-Encoding'
+            elif 'accept-encoding' not in vary.lower():
+                self.headers['Vary'] = f'{vary}, Accept-Encoding'
+            self.compress = (
+                self.encoding is not None
+                and status[:3] not in ('204', '206', '304')
+                and 'Content-Encoding' not in self.headers
+                and 'no-transform' not in self.headers.get('Cache-Control', ''))
+        return self._write_unsupported
+
+    def body(self, body):
+        if self.status is None:
+            # The app will call start_response as its body is iterated
+            self.passthrough = True
+            return body
+
+        length = self.headers.get('Content-Length', type=int)
+        if not self.compress or (length is not None
+                                 and length < self.compression.min_size):
+            self._start_response(self.status, self.headers.to_wsgi_list())
+            return body
+
+        chunks = self._buffered(body) if length is not None else self._streamed(body)
+        return _Body(chunks, body)
+
+    def _buffered(self, body):
+        """Compress a body of known length all at once."""
+
+        content = b''.join(body)
+        compress, _, finish = self.compression.compressor(self.encoding)
+        compressed = self._timed(compress, content) + self._timed(finish)
+        if len(compressed) >= len(content):
+            self._start_response(self.status, self.headers.to_wsgi_list())
+            yield content
+            return
+
+        self.bytes_in, self.bytes_out = len(content), len(compressed)
+        self._compressed_headers()
+        self.headers['Content-Length'] = str(len(compressed))
+        self.headers.add('Server-Timing',
+                         f'compress;dur={self.cpu * 1000:.1f};'
+                         f'desc="{self.encoding} {self._ratio():.1f}x"')
+        self._start_response(self.status, self.headers.to_wsgi_list())
+        self._record(streamed=False)
+        yield compressed
+
+    def _streamed(self, body):
+        """Compress a body of unknown length as it is produced."""
+
+        chunks = iter(body)
+        head, size = [], 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if size >= self.compression.min_size:
+                break
+        else:
+            # All of it was under the threshold
+            content = b''.join(head)
+            self.headers['Content-Length'] = str(len(content))
+            self._start_response(self.status, self.headers.to_wsgi_list())
+            yield content
+            return
+
+        compress, flush, finish = self.compression.compressor(self.encoding)
+        self._compressed_headers()
+        self._start_response(self.status, self.headers.to_wsgi_list())
+
+        # The top of the page goes out at once
+        yield self._out(self._timed(compress, b''.join(head)) + self._timed(flush), size)
+
+        pending = 0
+        for chunk in chunks:
+            data = self._timed(compress, chunk)
+            pending += len(chunk)
+            if pending >= self.compression.flush_size:
+                data += self._timed(flush)
+                pending = 0
+            if data:
+                yield self._out(data, len(chunk))
+            else:
+                self.bytes_in += len(chunk)
+
+        yield self._out(self._timed(finish), 0)
+        self._record(streamed=True)
+
+    def _out(self, data, bytes_in):
+        self.bytes_in += bytes_in
+        self.bytes_out += len(data)
+        return data
+
+    def _timed(self, fn, *args):
+        started = time.thread_time()
+        try:
+            return fn(*args)
+        finally:
+            self.cpu += time.thread_time() - started
+
+    def _ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1.0
+
+    def _compressed_headers(self):
+        self.headers['Content-Encoding'] = self.encoding
+        self.headers.remove('Accept-Ranges')
+        etag = self.headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            self.headers['ETag'] = f'W/{etag}'
+
+    def _record(self, streamed):
+        COMPRESSION_RATIO.observe(self._ratio(), encoding=self.encoding)
+        COMPRESSION_CPU.observe(self.cpu, encoding=self.encoding)
+        logger.info(json.dumps(dict(
+            path=self.path,
+            encoding=self.encoding,
+            streamed=streamed,
+            bytes_in=self.bytes_in,
+            bytes_out=self.bytes_out,
+            ratio=round(self._ratio(), 2),
+            compress_cpu_ms=round(self.cpu * 1000, 2),
+        )))
+
+    @staticmethod
+    def _write_unsupported(data):
+        raise RuntimeError("the compression middleware does not support write()")
+
+
+class _Body:
+    """A response iterable that closes the app's iterable when it is closed."""
+
+    def __init__(self, chunks, body):
+        self.chunks = chunks
+        self.body = body
+
+    def __iter__(self):
+        return self.chunks
+
+    def close(self):
+        self.chunks.close()
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+compression = Compression()
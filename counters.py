@@ -0,0 +1,140 @@
+"""Denormalized engagement counters on User and Message.
+
+Routes call these in the same transaction as the write they count, so the
+counter columns never drift from `follows`, `likes` and `messages` except
+through writes that bypass the routes; `reconcile()` repairs those.
+Every adjustment also bumps `updated_at`, which caching.py uses as the
+user's data version.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import delete, func, insert, select, text, update
+
+from models import db, Follows, Likes, Message, User
+from user_cache import invalidate_on_commit
+
+
+def adjust(user_ids, **deltas):
+    """Add `deltas` (e.g. likes_count=-1) to the counters of `user_ids`.
+
+    `user_ids` is a single id, or a select of ids for bulk adjustments.
+    """
+
+    if isinstance(user_ids, int):
+        condition = User.id == user_ids
+        invalidate_on_commit(user_ids)
+    else:
+        condition = User.id.in_(user_ids)
+        invalidate_on_commit()
+
+    values = {getattr(User, name): getattr(User, name) + delta
+              for name, delta in deltas.items()}
+    values[User.updated_at] = datetime.utcnow()
+    db.session.execute(update(User).where(condition).values(values))
+
+
+# One round trip: delete the like if it exists, else insert it, then move
+# both counters and the author's stamp (their messages' counts changed)
+TOGGLE_LIKE = text("""
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE user_id = :user_id AND message_id = :message_id
+        RETURNING 1
+    ), added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT :user_id, id FROM messages
+        WHERE id = :message_id AND NOT EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT DO NOTHING
+        RETURNING 1
+    ), delta AS (
+        SELECT (SELECT count(*) FROM added) - (SELECT count(*) FROM removed) AS n
+    ), message AS (
+        UPDATE messages SET like_count = like_count + delta.n
+        FROM delta
+        WHERE messages.id = :message_id AND delta.n <> 0
+        RETURNING messages.user_id
+    ), touched AS (
+        UPDATE users
+        SET likes_count = likes_count
+                + CASE WHEN users.id = :user_id THEN delta.n ELSE 0 END,
+            updated_at = :now
+        FROM delta
+        WHERE users.id IN (:user_id, (SELECT user_id FROM message))
+            AND delta.n <> 0
+        RETURNING users.id
+    )
+    SELECT delta.n, (SELECT user_id FROM messages WHERE id = :message_id)
+    FROM delta
+""")
+
+
+def toggle_like(user_id, message_id):
+    """Like the message if `user_id` hasn't, else unlike it.
+
+    Returns the change in likes: 1 or -1, or 0 when a concurrent click
+    got there first and there was nothing left to do. None if the message
+    doesn't exist.
+    """
+
+    if db.session.get_bind().dialect.name == 'postgresql':
+        delta, author_id = db.session.execute(TOGGLE_LIKE, dict(
+            user_id=user_id, message_id=message_id,
+            now=datetime.utcnow())).one()
+    else:
+        author_id = db.session.execute(
+            select(Message.user_id).where(Message.id == message_id)).scalar()
+        removed = db.session.execute(
+            delete(Likes).where(Likes.user_id == user_id,
+                                Likes.message_id == message_id)).rowcount
+        if removed:
+            delta = -1
+        elif author_id is not None:
+            db.session.execute(insert(Likes).values(user_id=user_id,
+                                                    message_id=message_id))
+            delta = 1
+        else:
+            delta = 0
+
+        if delta:
+            db.session.execute(
+                update(Message).where(Message.id == message_id)
+                .values(like_count=Message.like_count + delta))
+            adjust(user_id, likes_count=delta)
+            adjust(author_id)
+
+    if author_id is None:
+        return None
+
+    if delta:
+        invalidate_on_commit(user_id)
+        invalidate_on_commit(author_id)
+    return delta
+
+
+def message_deleted(message):
+    """Adjust counters for a message that is about to be deleted."""
+
+    adjust(message.user_id, messages_count=-1)
+    adjust(select(Likes.user_id).where(Likes.message_id == message.id),
+           likes_count=-1)
+
+
+def reconcile():
+    """Recompute every user's counters from the source tables in one UPDATE."""
+
+    def count(column, ref):
+        return (select(func.count())
+                .where(column == ref)
+                .scalar_subquery())
+
+    db.session.execute(update(User).values(
+        messages_count=count(Message.user_id, User.id),
+        following_count=count(Follows.user_following_id, User.id),
+        followers_count=count(Follows.user_being_followed_id, User.id),
+        likes_count=count(Likes.user_id, User.id),
+        updated_at=datetime.utcnow(),
+    ))
+    db.session.execute(update(Message).values(
+        like_count=count(Likes.message_id, Message.id)))
+    invalidate_on_commit()
@@ -2,15 +2,28 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. a benchmark dataset:
+
+    python generator/create_csvs.py --users 100000 --messages 10000000 \\
+        --follows 5000000 --out /tmp/warbler-big
+
+Everything is sampled offline with NumPy and written a chunk at a time.
+Follower counts and posting activity follow power laws (a few users are
+followed by, and post far more than, everyone else), and message
+timestamps grow toward the present with a daily cycle. Load the result
+with `flask bulk-load --directory <out>`.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from helpers import (CITIES, WORDS, power_law_weights, sentences, timestamps,
+                     unique_pairs)
 
 MAX_WARBLER_LENGTH = 140
 
@@ -18,60 +31,123 @@ USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'heade
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
-
-fake = Faker()
+# bcrypt hash of "password"; hashing per user would dominate the run
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
-
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
-
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+# Header images once fetched from splashbase, kept so generation is offline
+with open(os.path.join(os.path.dirname(__file__), 'header_images.txt')) as f:
+    HEADER_IMAGE_URLS = f.read().split()
+
+
+def write_users(path, count, chunk_size, rng):
+    with open(path, 'w', newline='') as users_csv:
+        writer = csv.writer(users_csv)
+        writer.writerow(USERS_CSV_HEADERS)
+
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            first = rng.integers(0, len(WORDS), size)
+            second = rng.integers(0, len(WORDS), size)
+            # The row number keeps usernames (and so emails) unique
+            usernames = [f"{WORDS[a]}{WORDS[b]}{start + n}" for n, (a, b)
+                         in enumerate(zip(first.tolist(), second.tolist()))]
+
+            writer.writerows(zip(
+                [f"{username}@example.com" for username in usernames],
+                usernames,
+                np.array(IMAGE_URLS)[rng.integers(0, len(IMAGE_URLS), size)],
+                [PASSWORD] * size,
+                sentences(size, 4, 10, 200, rng),
+                np.array(HEADER_IMAGE_URLS)[
+                    rng.integers(0, len(HEADER_IMAGE_URLS), size)],
+                np.array(CITIES)[rng.integers(0, len(CITIES), size)],
+            ))
+
+
+def write_messages(path, count, users, skew, years, chunk_size, rng):
+    """Messages in timestamp order, so ids increase with time."""
+
+    now = datetime.utcnow()
+    stamps = timestamps(count, now - timedelta(days=365 * years), now,
+                        growth=2.0, rng=rng)
+    authors = power_law_weights(users, skew, rng)
+
+    with open(path, 'w', newline='') as messages_csv:
+        writer = csv.writer(messages_csv)
+        writer.writerow(MESSAGES_CSV_HEADERS)
+
+        for start in range(0, count, chunk_size):
+            chunk = stamps[start:start + chunk_size]
+            size = len(chunk)
+            writer.writerows(zip(
+                sentences(size, 3, 30, MAX_WARBLER_LENGTH, rng),
+                np.datetime_as_string(chunk, unit='us'),
+                rng.choice(users, size, p=authors) + 1,
+            ))
+
+
+def write_follows(path, count, users, skew, chunk_size, rng):
+    """Follows whose followed side is power-law distributed."""
+
+    followed, following = unique_pairs(
+        count,
+        power_law_weights(users, skew, rng),
+        power_law_weights(users, skew / 2, rng),
+        rng)
+
+    with open(path, 'w', newline='') as follows_csv:
+        writer = csv.writer(follows_csv)
+        writer.writerow(FOLLOWS_CSV_HEADERS)
+
+        for start in range(0, count, chunk_size):
+            writer.writerows(zip(
+                (followed[start:start + chunk_size] + 1).tolist(),
+                (following[start:start + chunk_size] + 1).tolist()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000)
+    parser.add_argument('--follow-skew', type=float, default=1.1,
+                        help='power-law exponent of follower counts')
+    parser.add_argument('--message-skew', type=float, default=0.8,
+                        help='power-law exponent of messages per user')
+    parser.add_argument('--years', type=float, default=2,
+                        help='how far back message timestamps go')
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--out', default=os.path.dirname(__file__) or '.')
+    args = parser.parse_args(argv)
+    if args.follows > args.users * (args.users - 1):
+        parser.error(f"{args.users} users allow at most "
+                     f"{args.users * (args.users - 1)} follows")
+
+    rng = np.random.default_rng(args.seed)
+    os.makedirs(args.out, exist_ok=True)
+
+    for name, write in [
+        ('users', lambda path: write_users(
+            path, args.users, args.chunk_size, rng)),
+        ('messages', lambda path: write_messages(
+            path, args.messages, args.users, args.message_skew, args.years,
+            args.chunk_size, rng)),
+        ('follows', lambda path: write_follows(
+            path, args.follows, args.users, args.follow_skew,
+            args.chunk_size, rng)),
+    ]:
+        started = time.perf_counter()
+        path = os.path.join(args.out, f'{name}.csv')
+        write(path)
+        print(f"{path}: {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,170 @@
-"""Support functions for CSV generation."""
+"""Vectorized sampling functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import numpy as np
 
+WORDS = """
+    able about above across act add afternoon again against agent air all
+    allow almost alone along already also always among amount analysis and
+    animal another answer anyone anything appear apply area argue arm around
+    arrive art article artist ask attack attention author available avoid
+    away baby back bad bag ball bank bar base beat beautiful because become
+    bed before begin behavior behind believe benefit best better between
+    beyond big bill bird bit black blood blue board boat body book born both
+    box boy break bring brother budget build building business buy call
+    camera campaign car card care career carry case cat catch cause cell
+    center century certain chair chance change character charge check child
+    choice choose church citizen city civil claim class clear close coach
+    coffee cold collection college color come common community company
+    computer concern condition consider contain continue control cost could
+    country couple course court cover create crime cultural culture cup
+    current customer cut dark data daughter day dead deal debate decade
+    decide decision deep degree design despite detail develop difference
+    different dinner direction discover discuss disease doctor dog door down
+    draw dream drive drop drug during each early east easy eat economy edge
+    effect effort eight either election else end energy enjoy enough enter
+    entire environment evening event every evidence exactly example expect
+    experience expert explain eye face fact factor fail fall family far fast
+    father fear federal feel few field fight figure fill film final finally
+    find fine finger finish fire firm first fish five floor fly focus follow
+    food foot force forget form forward four free friend front full fund
+    future game garden gas general generation girl give glass goal good
+    great green ground group grow growth guess gun guy hair half hand happen
+    happy hard head health hear heart heat heavy help here high himself
+    history hit hold home hope hospital hot hotel hour house huge human
+    hundred idea image imagine impact important improve include increase
+    indeed industry information inside instead interest interview into
+    investment issue item itself job join just keep key kid kind kitchen
+    know land language large last late later laugh law lawyer lead leader
+    learn least leave left leg legal less letter level life light like line
+    list listen little live local long look lose loss lot love low machine
+    magazine main maintain major make manage manager many market marriage
+    material matter maybe measure media medical meet meeting member memory
+    mention message method middle might military million mind minute miss
+    mission model modern moment money month more morning most mother mouth
+    move movie much music myself name nation nature near nearly necessary
+    need network never news newspaper next nice night none north note
+    nothing notice number occur off offer office officer official often oil
+    old once only open operation opportunity option order organization
+    other others outside over own owner page pain painting paper parent
+    part participant particular partner party pass past patient pattern pay
+    peace people perform perhaps period person personal phone physical pick
+    picture piece place plan plant play player point police policy
+    political poor popular population position positive possible power
+    practice prepare present president pressure pretty prevent price
+    private probably problem process produce product professional program
+    project property protect prove provide public pull purpose push put
+    quality question quickly quite race radio raise range rate rather reach
+    read ready real reality realize reason receive recent recently record
+    red reduce reflect region relate remain remember remove report represent
+    require research resource respond rest result return reveal rich right
+    rise risk road rock role room rule run safe same save say scene school
+    science score sea season seat second section security see seek seem
+    sell send senior sense series serious serve service set seven several
+    shake share shoot short shot should shoulder show side sign similar
+    simple simply since sing single sister sit site situation six size skill
+    skin small smile social society soldier some someone something sometimes
+    son song soon sort sound source south space speak special specific
+    speech spend sport spring staff stage stand standard star start state
+    station stay step still stock stop store story strategy street strong
+    structure student study stuff style subject success successful suddenly
+    suffer suggest summer support sure surface system table take talk task
+    teach teacher team technology television tell ten tend term test than
+    thank then theory there these thing think third those though thought
+    thousand threat three through throughout throw thus time today together
+    tonight too top total tough toward town trade traditional training
+    travel treat treatment tree trial trip trouble true truth try turn two
+    type under understand unit until upon usually value various very victim
+    view visit voice vote wait walk wall want watch water way weapon wear
+    week weight well west western whatever wheel when where whether which
+    while white whole wide wife will win wind window wish with within without
+    woman wonder word work worker world worry would write writer wrong yard
+    yeah year yes yet young yourself
+""".split()
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+CITIES = """
+    Springfield Riverside Franklin Greenville Bristol Clinton Fairview Salem
+    Madison Georgetown Arlington Ashland Dover Oxford Jackson Burlington
+    Manchester Milton Newport Auburn Dayton Lexington Milford Winchester
+    Hudson Kingston Vernon Oakland Clayton Marion Lebanon Centerville
+""".split()
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
 
-    return datetime.fromtimestamp(random_timestamp)
+def power_law_weights(n, alpha, rng):
+    """Probabilities over `n` items falling off as rank**-alpha.
+
+    Ranks are shuffled so popularity is unrelated to id.
+    """
+
+    ranks = rng.permutation(n) + 1
+    weights = ranks ** -float(alpha)
+    return weights / weights.sum()
+
+
+def unique_pairs(count, left_p, right_p, rng, self_pairs=False):
+    """`count` distinct (left, right) 0-based index pairs, each side drawn
+    from its probability vector, in random order.
+
+    Pairs are drawn in batches and de-duplicated as 64-bit keys, so memory
+    stays proportional to `count` rather than to every possible pair.
+    """
+
+    n_left, n_right = len(left_p), len(right_p)
+    keys = np.empty(0, dtype=np.int64)
+
+    for _ in range(100):
+        need = count - len(keys)
+        if need <= 0:
+            break
+
+        size = int(need * 1.2) + 16
+        left = rng.choice(n_left, size, p=left_p)
+        right = rng.choice(n_right, size, p=right_p)
+        if not self_pairs:
+            keep = left != right
+            left, right = left[keep], right[keep]
+        keys = np.sort(np.concatenate(
+            [keys, left.astype(np.int64) * n_right + right]))
+        keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    else:
+        raise ValueError(f"could not draw {count} distinct pairs; "
+                         f"lower the count or the skew")
+
+    keys = rng.permutation(keys)[:count]
+    return keys // n_right, keys % n_right
+
+
+def timestamps(count, start, end, growth, rng):
+    """`count` sorted datetime64[us] values between `start` and `end`.
+
+    Activity grows exponentially toward `end` (rate `growth` over the whole
+    span) and follows a daily cycle that peaks in the evening.
+    """
+
+    start = np.datetime64(start, 'us')
+    span = (np.datetime64(end, 'us') - start).astype(np.int64)
+    day = 86400 * 10**6
+
+    # Inverse CDF of an exponentially growing density on [0, 1)
+    u = rng.random(count)
+    when = np.log1p(u * np.expm1(growth)) / growth if growth else u
+    days = (when * span // day).astype(np.int64)
+
+    hourly = np.array([2, 1, 1, 1, 1, 2, 3, 5, 6, 6, 6, 7,
+                       8, 7, 6, 6, 7, 8, 9, 10, 10, 9, 7, 4], dtype=float)
+    hours = rng.choice(24, count, p=hourly / hourly.sum())
+    offsets = days * day + hours * 3600 * 10**6 + rng.integers(
+        0, 3600 * 10**6, count)
+
+    return start + np.sort(np.minimum(offsets, span - 1))
+
+
+def sentences(count, min_words, max_words, max_length, rng):
+    """`count` random sentences of vocabulary words, at most `max_length`
+    characters each."""
+
+    words = np.array(WORDS)
+    picks = words[rng.integers(0, len(words), (count, max_words))]
+    lengths = rng.integers(min_words, max_words + 1, count)
+
+    return [(' '.join(row[:length]).capitalize()[:max_length - 1] + '.')
+            for row, length in zip(picks.tolist(), lengths.tolist())]
@@ -0,0 +1,137 @@
+"""Password hashing on a bounded worker pool.
+
+bcrypt is deliberately slow and holds a CPU for the whole hash. Running it
+on a small pool of threads (bcrypt releases the GIL) caps how many hashes
+run at once, so a burst of logins queues behind itself instead of pinning
+every worker. When the queue is full for longer than BCRYPT_QUEUE_TIMEOUT
+seconds, `HasherBusy` is raised so the caller can shed the request.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from metrics import BCRYPT_DURATION, BCRYPT_WAIT, percentile
+
+
+class HasherBusy(Exception):
+    """Raised when too many hashes are already queued."""
+
+
+class HashStats:
+    """Running counts and recent samples of queue waits and hash durations."""
+
+    def __init__(self, samples=1000):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=samples)
+        self.durations = deque(maxlen=samples)
+
+    def record(self, wait, duration):
+        with self.lock:
+            self.count += 1
+            self.waits.append(wait)
+            self.durations.append(duration)
+        BCRYPT_WAIT.observe(wait)
+        BCRYPT_DURATION.observe(duration)
+
+    def summary(self):
+        """Counts plus p50/p99 of recent queue waits and durations, in seconds."""
+
+        with self.lock:
+            return dict(count=self.count,
+                        rejected=self.rejected,
+                        wait_p50=percentile(self.waits, 50),
+                        wait_p99=percentile(self.waits, 99),
+                        duration_p50=percentile(self.durations, 50),
+                        duration_p99=percentile(self.durations, 99))
+
+
+class PasswordHasher:
+    """Hash and check passwords with bcrypt on a bounded thread pool."""
+
+    def __init__(self):
+        self.rounds = 12
+        self.workers = os.cpu_count() or 1
+        self.max_pending = 4 * self.workers
+        self.queue_timeout = 5
+        self.stats = HashStats()
+        self._executor = None
+        self._pid = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read BCRYPT_* settings from the app config."""
+
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.workers = app.config.setdefault('BCRYPT_WORKERS', self.workers)
+        self.max_pending = app.config.setdefault('BCRYPT_MAX_PENDING',
+                                                 4 * self.workers)
+        self.queue_timeout = app.config.setdefault('BCRYPT_QUEUE_TIMEOUT', 5)
+        app.extensions['password_hasher'] = self
+
+    def hash(self, password):
+        """bcrypt hash of `password` at the configured cost."""
+
+        salt = bcrypt.gensalt(self.rounds)
+        hashed = self._run(bcrypt.hashpw, password.encode('UTF-8'), salt)
+        return hashed.decode('UTF-8')
+
+    def check(self, hashed, password):
+        """Does `password` match the bcrypt hash `hashed`?"""
+
+        return self._run(bcrypt.checkpw, password.encode('UTF-8'),
+                         hashed.encode('UTF-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made at a lower cost than the configured one?"""
+
+        try:
+            return int(hashed.split('$')[2]) < self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` on the pool and wait for its result."""
+
+        executor, slots = self._pool()
+        queued = time.perf_counter()
+        if not slots.acquire(timeout=self.queue_timeout):
+            with self.stats.lock:
+                self.stats.rejected += 1
+            raise HasherBusy()
+
+        def timed():
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self.stats.record(started - queued, time.perf_counter() - started)
+
+        try:
+            future = executor.submit(timed)
+        except BaseException:
+            slots.release()
+            raise
+        future.add_done_callback(lambda _: slots.release())
+        return future.result()
+
+    def _pool(self):
+        """The executor for this process, (re)created lazily after a fork."""
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix='bcrypt')
+                self._slots = threading.BoundedSemaphore(self.max_pending)
+                self._pid = os.getpid()
+            return self._executor, self._slots
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,193 @@
+"""Per-request SQL and template timing.
+
+Every request counts its SQL statements, total time in the database, the
+slowest statement and template render time. The numbers go out as a
+`Server-Timing` header (visible in the browser's network panel) and as
+one JSON log line on the `warbler.requests` logger. A request that runs
+the same statement SQL_N_PLUS_ONE_THRESHOLD times or more is logged as a
+warning; that is almost always a relationship loaded once per row.
+
+A streamed response (see pagination.StreamedPage) sends its headers before
+the body is rendered, so its Server-Timing only covers the time to the
+first byte. Its log line waits until the body has been sent and the
+response is closed, and includes the queries and rendering done on the way.
+
+Tests can cap a route's query count:
+
+    with assert_max_queries(3):
+        self.client.get('/')
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import (before_render_template, g, has_app_context, request,
+                   template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.requests')
+
+
+class RequestStats:
+    """What one request spent in SQL and templates."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = Counter()
+        self.db_time = 0.0
+        self.slowest = (0.0, None)
+        self.render_time = 0.0
+        self.render_started = None
+
+    @property
+    def count(self):
+        return sum(self.statements.values())
+
+    def record(self, statement, duration):
+        self.statements[statement] += 1
+        self.db_time += duration
+        if duration > self.slowest[0]:
+            self.slowest = (duration, statement)
+
+    def repeated(self):
+        """The most repeated statement and its count, or (None, 0)."""
+
+        return self.statements.most_common(1)[0] if self.statements else (None, 0)
+
+
+class Instrumentation:
+    """Hooks the request cycle, templates and SQLAlchemy engines together."""
+
+    def __init__(self):
+        self.enabled = True
+        self.threshold = 10
+        self._watchers = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read INSTRUMENTATION_* settings and install the hooks."""
+
+        self.enabled = app.config.setdefault('INSTRUMENTATION_ENABLED', True)
+        self.threshold = app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD', 10)
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        before_render_template.connect(self._render_started, app)
+        template_rendered.connect(self._render_finished, app)
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'handle_error', self._execute_failed)
+        app.extensions['instrumentation'] = self
+
+    @contextmanager
+    def watch(self):
+        """Collect every statement run (on any thread) inside the block."""
+
+        statements = []
+        with self._lock:
+            self._watchers.append(statements)
+        try:
+            yield statements
+        finally:
+            with self._lock:
+                self._watchers.remove(statements)
+
+    def _start(self):
+        if self.enabled:
+            g._request_stats = RequestStats()
+
+    def _finish(self, response):
+        stats = g.get('_request_stats')
+        if stats is None:
+            return response
+
+        total = time.perf_counter() - stats.started
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.count} queries"',
+            f'render;dur={stats.render_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+        request_info = dict(method=request.method, path=request.path,
+                            endpoint=request.endpoint,
+                            status=response.status_code,
+                            streamed=response.is_streamed)
+        if response.is_streamed:
+            # Queries run while the body streams still land in `stats`
+            response.call_on_close(lambda: self._report(stats, request_info))
+        else:
+            g.pop('_request_stats')
+            self._report(stats, request_info)
+        return response
+
+    def _report(self, stats, request_info):
+        """Log what a finished request spent."""
+
+        total = time.perf_counter() - stats.started
+        repeated, times = stats.repeated()
+        logger.info(json.dumps(dict(
+            **request_info,
+            total_ms=round(total * 1000, 2),
+            db_ms=round(stats.db_time * 1000, 2),
+            render_ms=round(stats.render_time * 1000, 2),
+            queries=stats.count,
+            slowest_ms=round(stats.slowest[0] * 1000, 2),
+            slowest=stats.slowest[1],
+        )))
+        if times >= self.threshold:
+            logger.warning("possible N+1 in %s: %d x %s",
+                           request_info['endpoint'], times, repeated)
+
+    def _render_started(self, app, template, context, **extra):
+        stats = g.get('_request_stats') if has_app_context() else None
+        if stats is not None:
+            stats.render_started = time.perf_counter()
+
+    def _render_finished(self, app, template, context, **extra):
+        stats = g.get('_request_stats') if has_app_context() else None
+        if stats is not None and stats.render_started is not None:
+            stats.render_time += time.perf_counter() - stats.render_started
+            stats.render_started = None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context,
+                        executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        duration = time.perf_counter() - conn.info['query_started'].pop()
+
+        if self._watchers:
+            with self._lock:
+                for statements in self._watchers:
+                    statements.append(statement)
+
+        stats = g.get('_request_stats') if has_app_context() else None
+        if stats is not None:
+            stats.record(statement, duration)
+
+    def _execute_failed(self, context):
+        started = context.connection.info.get('query_started') if context.connection else None
+        if started:
+            started.pop()
+
+
+instrumentation = Instrumentation()
+
+
+@contextmanager
+def assert_max_queries(limit):
+    """Fail unless the block runs at most `limit` SQL statements."""
+
+    with instrumentation.watch() as statements:
+        yield statements
+
+    if len(statements) > limit:
+        raise AssertionError(
+            f"{len(statements)} queries, expected at most {limit}:\n"
+            + '\n'.join(statements))
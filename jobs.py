@@ -0,0 +1,263 @@
+"""Database-backed background jobs.
+
+`jobs.enqueue()` adds a row to `jobs` in the caller's transaction, so a job
+exists only if the request that queued it commits. Workers claim due jobs
+one at a time (FOR UPDATE SKIP LOCKED on Postgres), run the registered
+task and mark the job done in the task's transaction. A failed job is
+retried with exponential backoff up to JOBS_MAX_ATTEMPTS times; a worker
+that dies mid-job loses its claim after JOBS_LEASE seconds.
+
+JOBS_MODE picks who runs jobs:
+
+- 'thread' (default): JOBS_WORKERS threads in each web process
+- 'inline': the request that queued them, right after it commits; runs
+  just that request's jobs, for development and tests
+- 'worker': a separate process, `flask run-jobs`
+
+Tasks (see tasks.py) may commit part-way through, and must be safe to run
+again after a failure. Passing an idempotency `key` makes enqueueing the
+same work twice a no-op.
+"""
+
+import logging
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from flask import g, has_request_context
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from metrics import JOB_DURATION, JOB_LATENCY, JOB_RESULTS
+from models import db, Job
+
+logger = logging.getLogger('warbler.jobs')
+
+
+class JobQueue:
+    """Registry of tasks, and the workers that run them."""
+
+    def __init__(self):
+        self.mode = 'thread'
+        self.workers = 2
+        self.max_attempts = 5
+        self.poll_interval = 1.0
+        self.lease = 300
+        self.batch_size = 1000
+        self.retention = timedelta(days=7)
+        self.tasks = {}
+        self._app = None
+        self._pid = None
+        self._stop = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Read JOBS_* settings from the app config."""
+
+        self.mode = app.config.setdefault('JOBS_MODE', 'thread')
+        self.workers = app.config.setdefault('JOBS_WORKERS', 2)
+        self.max_attempts = app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        self.poll_interval = app.config.setdefault('JOBS_POLL_INTERVAL', 1.0)
+        self.lease = app.config.setdefault('JOBS_LEASE', 300)
+        self.batch_size = app.config.setdefault('JOBS_BATCH_SIZE', 1000)
+        self.retention = timedelta(
+            days=app.config.setdefault('JOBS_RETENTION_DAYS', 7))
+        self._app = app
+        app.after_request(self._after_request)
+        app.extensions['jobs'] = self
+
+    def task(self, kind):
+        """Register the decorated function as the handler for `kind` jobs."""
+
+        def register(fn):
+            self.tasks[kind] = fn
+            return fn
+        return register
+
+    ##########################################################################
+    # Queueing
+
+    def enqueue(self, kind, key=None, delay=0, **payload):
+        """Queue a `kind` job with keyword `payload` in the current transaction."""
+
+        if kind not in self.tasks:
+            raise KeyError(f"no task registered for {kind!r}")
+
+        now = datetime.utcnow()
+        values = dict(kind=kind, payload=payload, idempotency_key=key,
+                      status='queued', attempts=0, created_at=now,
+                      run_at=now + timedelta(seconds=delay))
+
+        dialect = db.session.get_bind().dialect.name
+        if key and dialect in ('postgresql', 'sqlite'):
+            dialect_insert = (postgresql if dialect == 'postgresql' else sqlite).insert
+            statement = (dialect_insert(Job).values(values)
+                         .on_conflict_do_nothing(index_elements=['idempotency_key']))
+        else:
+            statement = insert(Job).values(values)
+        # No id when the key was already queued
+        job_id = db.session.execute(statement.returning(Job.id)).scalar()
+
+        if job_id is not None and has_request_context():
+            g.setdefault('_jobs_enqueued', []).append(job_id)
+
+    def backlog(self):
+        """{status: count} of unfinished jobs, and the oldest queued job's age."""
+
+        counts = dict(db.session.execute(
+            select(Job.status, func.count())
+            .where(Job.status.in_(['queued', 'running', 'failed']))
+            .group_by(Job.status)).all())
+        oldest = db.session.execute(
+            select(func.min(Job.run_at)).where(Job.status == 'queued')).scalar()
+        age = max(0.0, (datetime.utcnow() - oldest).total_seconds()) if oldest else 0.0
+        return counts, age
+
+    ##########################################################################
+    # Running
+
+    def run_pending(self, job_ids=None):
+        """Run every job that is due now, in this thread; returns how many.
+
+        `job_ids` limits it to those jobs.
+        """
+
+        ran = 0
+        while self.run_one(job_ids):
+            ran += 1
+        return ran
+
+    def run_one(self, job_ids=None):
+        """Claim and run one due job, of `job_ids` if given; False if none was."""
+
+        job = self._claim(job_ids)
+        if job is None:
+            return False
+
+        self._run(job)
+        return True
+
+    def work(self, stop):
+        """Run jobs until `stop` is set, polling when the queue is empty."""
+
+        pruned = 0.0
+        while not stop.is_set():
+            try:
+                if self.run_one():
+                    continue
+                if time.monotonic() - pruned > 3600:
+                    self.prune()
+                    pruned = time.monotonic()
+            except Exception:
+                logger.exception("job worker error")
+                db.session.rollback()
+            stop.wait(self.poll_interval)
+
+    def start_workers(self):
+        """Start JOBS_WORKERS threads in this process, once per process."""
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stop = threading.Event()
+            self._threads = [threading.Thread(target=self._thread, daemon=True,
+                                              name=f'jobs-{n}')
+                             for n in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+
+    def stop_workers(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        self._pid = None
+
+    def prune(self):
+        """Delete finished jobs older than JOBS_RETENTION_DAYS.
+
+        Their idempotency keys can be reused afterwards.
+        """
+
+        db.session.execute(
+            delete(Job).where(Job.status == 'done',
+                              Job.finished_at < datetime.utcnow() - self.retention))
+        db.session.commit()
+
+    def _thread(self):
+        with self._app.app_context():
+            self.work(self._stop)
+
+    def _after_request(self, response):
+        if self.mode == 'thread':
+            self.start_workers()
+        elif self.mode == 'inline':
+            job_ids = g.pop('_jobs_enqueued', None)
+            if job_ids:
+                # Only jobs the view committed are run
+                db.session.rollback()
+                self.run_pending(job_ids)
+        return response
+
+    def _claim(self, job_ids=None):
+        """Mark the next due job, of `job_ids` if given, running; None if none is."""
+
+        now = datetime.utcnow()
+        due = or_(and_(Job.status == 'queued', Job.run_at <= now),
+                  and_(Job.status == 'running',
+                       Job.locked_at < now - timedelta(seconds=self.lease)))
+        next_id = (select(Job.id).where(due)
+                   .order_by(Job.run_at, Job.id).limit(1))
+        if job_ids is not None:
+            next_id = next_id.where(Job.id.in_(job_ids))
+        if db.session.get_bind().dialect.name == 'postgresql':
+            next_id = next_id.with_for_update(skip_locked=True)
+
+        job_id = db.session.execute(
+            update(Job)
+            .where(Job.id == next_id.scalar_subquery())
+            .where(due)
+            .values(status='running', locked_at=now, attempts=Job.attempts + 1)
+            .returning(Job.id)).scalar()
+        db.session.commit()
+
+        return db.session.get(Job, job_id) if job_id else None
+
+    def _run(self, job):
+        kind, payload = job.kind, dict(job.payload)
+        JOB_LATENCY.observe(
+            (datetime.utcnow() - max(job.created_at, job.run_at)).total_seconds(),
+            kind=kind)
+
+        started = time.perf_counter()
+        try:
+            self.tasks[kind](**payload)
+            db.session.execute(
+                update(Job).where(Job.id == job.id)
+                .values(status='done', finished_at=datetime.utcnow(),
+                        last_error=None))
+            db.session.commit()
+            result = 'done'
+
+        except Exception:
+            db.session.rollback()
+            logger.exception("job %s (%s) failed", job.id, kind)
+            job = db.session.get(Job, job.id)
+            job.last_error = traceback.format_exc()
+            if job.attempts >= self.max_attempts:
+                job.status = result = 'failed'
+                job.finished_at = datetime.utcnow()
+            else:
+                job.status, result = 'queued', 'retry'
+                job.run_at = datetime.utcnow() + timedelta(
+                    seconds=min(3600, 2 ** job.attempts))
+            db.session.commit()
+
+        JOB_DURATION.observe(time.perf_counter() - started, kind=kind)
+        JOB_RESULTS.inc(kind=kind, result=result)
+
+
+jobs = JobQueue()
@@ -0,0 +1,415 @@
+"""Prometheus-style metrics, served as text at /metrics.
+
+Counters, gauges and histograms live in the process that records them.
+With METRICS_DIR set (do this under gunicorn, and empty the directory on
+each deploy), every process also writes its values to `<pid>.json` there
+at most once every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up
+the files of all processes. Counters and histograms from workers that
+have exited still count; gauges only count for live processes.
+
+Without METRICS_DIR, /metrics reports the serving process alone.
+"""
+
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+from flask import g, request
+from sqlalchemy import func, select, text
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Metric:
+    """A named family of samples, one value per label combination."""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            # Per-bucket (not cumulative) counts, then sum and count
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 3))
+            index = next((i for i, bound in enumerate(self.buckets)
+                          if value <= bound), len(self.buckets))
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+
+class Registry:
+    """The metrics of this process, and their combined exposition."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.directory = None
+        self.flush_interval = 1.0
+        self._pid = os.getpid()
+        self._flushed = 0.0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def collector(self, fn):
+        """Register `fn()`, called before each flush and scrape to set gauges."""
+
+        self.collectors.append(fn)
+        return fn
+
+    def reset_after_fork(self):
+        """Forget values inherited from a parent process."""
+
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            for metric in self.metrics.values():
+                with metric.lock:
+                    metric.values.clear()
+
+    def snapshot(self):
+        """{name: [[labels, value], ...]} for this process."""
+
+        self.reset_after_fork()
+        for fn in self.collectors:
+            fn()
+
+        snapshot = {}
+        for metric in self.metrics.values():
+            with metric.lock:
+                snapshot[metric.name] = [[list(key), value] for key, value
+                                         in metric.values.items()]
+        return snapshot
+
+    def flush(self, force=False):
+        """Write this process's values to METRICS_DIR, if set."""
+
+        now = time.monotonic()
+        if not self.directory or (not force and
+                                  now - self._flushed < self.flush_interval):
+            return
+
+        self._flushed = now
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + '.tmp', path)
+
+    def collect(self):
+        """Combined {name: {labels: value}} of every process."""
+
+        if not self.directory:
+            snapshots = [(os.getpid(), self.snapshot())]
+        else:
+            self.flush(force=True)
+            snapshots = list(_read_snapshots(self.directory))
+
+        combined = {name: defaultdict(int) for name in self.metrics}
+        for pid, snapshot in snapshots:
+            live = pid == os.getpid() or _is_alive(pid)
+            for name, samples in snapshot.items():
+                metric = self.metrics.get(name)
+                if metric is None or (metric.kind == 'gauge' and not live):
+                    continue
+                for key, value in samples:
+                    key = tuple(key)
+                    if metric.kind == 'histogram':
+                        previous = combined[name].get(key) or [0] * len(value)
+                        combined[name][key] = [a + b for a, b
+                                               in zip(previous, value)]
+                    else:
+                        combined[name][key] += value
+        return combined
+
+    def exposition(self, combined=None):
+        """Everything in Prometheus text exposition format."""
+
+        combined = self.collect() if combined is None else combined
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.kind}')
+            for key, value in sorted(combined[name].items()):
+                labels = list(zip(metric.labels, key))
+                if metric.kind != 'histogram':
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                    continue
+
+                running = 0
+                bounds = [*map(_number, metric.buckets), '+Inf']
+                for bound, count in zip(bounds, value[:-2]):
+                    running += count
+                    lines.append(f'{name}_bucket'
+                                 f'{_labels(labels + [("le", bound)])} {running}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(value[-2])}')
+                lines.append(f'{name}_count{_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value
+                          in zip(pairs, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _read_snapshots(directory):
+    for filename in os.listdir(directory):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                yield int(filename[:-5]), json.load(f)
+        except (OSError, ValueError):
+            continue
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    'warbler_requests_total', 'HTTP requests handled.',
+    ('endpoint', 'method', 'status')))
+REQUEST_LATENCY = registry.register(Histogram(
+    'warbler_request_duration_seconds', 'Time to handle a request.',
+    ('endpoint',)))
+BCRYPT_DURATION = registry.register(Histogram(
+    'warbler_bcrypt_duration_seconds', 'Time spent hashing one password.',
+    buckets=(.05, .1, .25, .5, 1, 2.5, 5)))
+BCRYPT_WAIT = registry.register(Histogram(
+    'warbler_bcrypt_queue_wait_seconds', 'Time a hash waited for a worker.'))
+POOL_WAIT = registry.register(Histogram(
+    'warbler_db_pool_checkout_seconds', 'Time to check a connection out.',
+    buckets=(.001, .005, .01, .05, .1, .5, 1, 5, 30)))
+POOL_CONNECTIONS = registry.register(Gauge(
+    'warbler_db_pool_connections', 'Pooled connections by state.',
+    ('state',)))
+USER_CACHE = registry.register(Counter(
+    'warbler_user_cache_lookups_total', 'Current-user cache lookups.',
+    ('result',)))
+RATE_LIMITED = registry.register(Counter(
+    'warbler_rate_limited_total', 'Requests refused with 429.', ('endpoint',)))
+JOB_LATENCY = registry.register(Histogram(
+    'warbler_job_queue_latency_seconds', 'Time a job waited after it was due.',
+    ('kind',), buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900, 3600)))
+JOB_DURATION = registry.register(Histogram(
+    'warbler_job_duration_seconds', 'Time to run one job.',
+    ('kind',), buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300)))
+JOB_RESULTS = registry.register(Counter(
+    'warbler_jobs_total', 'Jobs run, by outcome.', ('kind', 'result')))
+COMPRESSION_RATIO = registry.register(Histogram(
+    'warbler_compression_ratio', 'Uncompressed over compressed response size.',
+    ('encoding',), buckets=(1, 1.5, 2, 3, 4, 6, 8, 12, 16, 32)))
+COMPRESSION_CPU = registry.register(Histogram(
+    'warbler_compression_cpu_seconds', 'CPU time spent compressing a response.',
+    ('encoding',), buckets=(.0001, .0005, .001, .005, .01, .05, .1, .5)))
+
+# Set while scraping, from the database or the combined values above; these
+# are never written to METRICS_DIR or summed across processes
+scrape_time = Registry()
+
+USER_CACHE_HIT_RATIO = scrape_time.register(Gauge(
+    'warbler_user_cache_hit_ratio', 'Share of current-user lookups served '
+    'from the cache.'))
+TIMELINES = scrape_time.register(Gauge(
+    'warbler_timelines', 'Materialized home timelines and their entries '
+    '(estimated on Postgres).',
+    ('kind',)))
+JOBS = scrape_time.register(Gauge(
+    'warbler_jobs', 'Unfinished background jobs by status.', ('status',)))
+JOBS_OLDEST = scrape_time.register(Gauge(
+    'warbler_jobs_oldest_queued_seconds', 'Age of the oldest queued job.'))
+
+
+class Metrics:
+    """Times requests and DB checkouts, and serves /metrics."""
+
+    def init_app(self, app):
+        """Read METRICS_* settings, install the hooks and the /metrics route."""
+
+        from models import db
+
+        registry.directory = app.config.setdefault(
+            'METRICS_DIR', os.environ.get('METRICS_DIR'))
+        registry.flush_interval = app.config.setdefault(
+            'METRICS_FLUSH_INTERVAL', 1.0)
+        if registry.directory:
+            os.makedirs(registry.directory, exist_ok=True)
+
+        app.before_request(self._start_timer)
+        app.after_request(self._record_request)
+        with app.app_context():
+            _time_checkouts(db.engine.pool)
+
+        registry.collector(self._pool_connections)
+        registry.collector(self._user_cache_lookups)
+        scrape_time.collector(self._timeline_sizes)
+        scrape_time.collector(self._job_backlog)
+
+        app.add_url_rule('/metrics', 'metrics', self.serve)
+        app.extensions['metrics'] = self
+
+    def serve(self):
+        """The /metrics view: every registered metric, as text."""
+
+        combined = registry.collect()
+        lookups = combined[USER_CACHE.name]
+        total = lookups[('hit',)] + lookups[('miss',)]
+        USER_CACHE_HIT_RATIO.set(lookups[('hit',)] / total if total else 0.0)
+
+        body = registry.exposition(combined) + scrape_time.exposition()
+        return body, 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    ##########################################################################
+    # Request hooks
+
+    def _start_timer(self):
+        g._metrics_started = time.perf_counter()
+
+    def _record_request(self, response):
+        started = g.pop('_metrics_started', None)
+        if started is not None:
+            endpoint = request.endpoint or 'unmatched'
+            REQUESTS.inc(endpoint=endpoint, method=request.method,
+                         status=response.status_code)
+            if response.is_streamed:
+                # A streamed body is rendered after this returns
+                response.call_on_close(lambda: REQUEST_LATENCY.observe(
+                    time.perf_counter() - started, endpoint=endpoint))
+            else:
+                REQUEST_LATENCY.observe(time.perf_counter() - started,
+                                        endpoint=endpoint)
+        registry.flush()
+        return response
+
+    ##########################################################################
+    # Collectors
+
+    def _pool_connections(self):
+        from models import db
+
+        pool = db.engine.pool
+        if hasattr(pool, 'checkedout'):
+            POOL_CONNECTIONS.set(pool.size(), state='size')
+            POOL_CONNECTIONS.set(pool.checkedout(), state='checked_out')
+            POOL_CONNECTIONS.set(pool.checkedin(), state='checked_in')
+            POOL_CONNECTIONS.set(max(0, pool.overflow()), state='overflow')
+
+    def _user_cache_lookups(self):
+        from user_cache import user_cache
+
+        with USER_CACHE.lock:
+            USER_CACHE.values[('hit',)] = user_cache.hits
+            USER_CACHE.values[('miss',)] = user_cache.misses
+
+    def _timeline_sizes(self):
+        """Row counts of the timeline tables.
+
+        On Postgres these are the planner's estimates (pg_class.reltuples,
+        kept by autovacuum), as counting timeline_entries on every scrape
+        would read the whole table.
+        """
+
+        from models import db, Timeline, TimelineEntry
+
+        for kind, model in [('timelines', Timeline), ('entries', TimelineEntry)]:
+            if db.engine.dialect.name == 'postgresql':
+                rows = db.session.execute(
+                    text("SELECT reltuples FROM pg_class "
+                         "WHERE oid = to_regclass(:table)"),
+                    {'table': model.__tablename__}).scalar()
+            else:
+                rows = db.session.execute(
+                    select(func.count()).select_from(model)).scalar()
+            # reltuples is -1 until the table is first analyzed
+            TIMELINES.set(max(0, rows or 0), kind=kind)
+
+    def _job_backlog(self):
+        from jobs import jobs
+
+        counts, oldest = jobs.backlog()
+        for status in ('queued', 'running', 'failed'):
+            JOBS.set(counts.get(status, 0), status=status)
+        JOBS_OLDEST.set(oldest)
+
+
+metrics = Metrics()
+
+
+def _time_checkouts(pool):
+    """Record how long each connection checkout from `pool` waits."""
+
+    connect = pool.connect
+
+    def timed_connect():
+        started = time.perf_counter()
+        try:
+            return connect()
+        finally:
+            POOL_WAIT.observe(time.perf_counter() - started)
+
+    pool.connect = timed_connect
+
+
+def percentile(samples, percent):
+    """The `percent`th percentile of `samples` (nearest rank); 0.0 if empty."""
+
+    if not samples:
+        return 0.0
+
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, math.ceil(len(ordered) * percent / 100) - 1))
+    return ordered[index]
@@ -0,0 +1,12 @@
+"""Create the tables the models define that don't exist yet.
+
+On a database made before migrations existed this only adds the newer
+tables (timelines, schema_migrations); later migrations bring the older
+tables up to date.
+"""
+
+from models import db
+
+
+def upgrade(conn):
+    db.metadata.create_all(conn)
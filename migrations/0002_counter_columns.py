@@ -0,0 +1,44 @@
+"""Add the denormalized counter columns and fill them in."""
+
+from sqlalchemy import inspect, text
+
+COLUMNS = [
+    ('users', 'messages_count', "INTEGER NOT NULL DEFAULT 0"),
+    ('users', 'following_count', "INTEGER NOT NULL DEFAULT 0"),
+    ('users', 'followers_count', "INTEGER NOT NULL DEFAULT 0"),
+    ('users', 'likes_count', "INTEGER NOT NULL DEFAULT 0"),
+    ('users', 'updated_at', "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP"),
+    ('messages', 'like_count', "INTEGER NOT NULL DEFAULT 0"),
+]
+
+
+def upgrade(conn):
+    inspector = inspect(conn)
+    existing = {table: {column['name'] for column in inspector.get_columns(table)}
+                for table in {table for table, _, _ in COLUMNS}}
+
+    added = False
+    for table, column, definition in COLUMNS:
+        if column not in existing[table]:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+            added = True
+
+    if not added:
+        return
+
+    conn.execute(text("""
+        UPDATE users SET
+            messages_count = (SELECT count(*) FROM messages
+                              WHERE messages.user_id = users.id),
+            following_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_following_id = users.id),
+            followers_count = (SELECT count(*) FROM follows
+                               WHERE follows.user_being_followed_id = users.id),
+            likes_count = (SELECT count(*) FROM likes
+                           WHERE likes.user_id = users.id)
+    """))
+    conn.execute(text("""
+        UPDATE messages SET
+            like_count = (SELECT count(*) FROM likes
+                          WHERE likes.message_id = messages.id)
+    """))
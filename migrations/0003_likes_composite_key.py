@@ -0,0 +1,28 @@
+"""Key likes by (user_id, message_id) instead of a surrogate id.
+
+The old table also had a unique constraint on message_id, so only one
+user could like a message. It is rebuilt rather than altered so this
+works the same on SQLite.
+"""
+
+from sqlalchemy import inspect, text
+
+from models import Likes
+
+
+def upgrade(conn):
+    columns = {column['name'] for column in inspect(conn).get_columns('likes')}
+    if 'id' not in columns:
+        return
+
+    conn.execute(text("ALTER TABLE likes RENAME TO likes_old"))
+    if conn.dialect.name == 'postgresql':
+        # Constraint and index names stay with the renamed table
+        conn.execute(text("ALTER TABLE likes_old RENAME CONSTRAINT likes_pkey "
+                          "TO likes_old_pkey"))
+    Likes.__table__.create(conn)
+    conn.execute(text("""
+        INSERT INTO likes (user_id, message_id)
+        SELECT DISTINCT user_id, message_id FROM likes_old
+    """))
+    conn.execute(text("DROP TABLE likes_old"))
@@ -0,0 +1,24 @@
+"""Indexes for the queries app.py runs on every page.
+
+- messages (user_id, timestamp, id): profile pages and the home timeline
+  read a user's messages newest first, with (timestamp, id) keyset paging
+- follows (user_following_id, user_being_followed_id): "who does X
+  follow", the reverse of the primary key
+- likes (message_id): like counts and cascades from messages; the
+  (user_id, message_id) primary key serves a user's likes
+- timeline_entries (message_id): pruning a deleted message from feeds
+"""
+
+from migrations import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    create_index(conn, 'ix_messages_user_timeline', 'messages',
+                 'user_id, timestamp, id')
+    create_index(conn, 'ix_follows_following', 'follows',
+                 'user_following_id, user_being_followed_id')
+    create_index(conn, 'ix_likes_message_id', 'likes', 'message_id')
+    create_index(conn, 'ix_timeline_entries_message_id', 'timeline_entries',
+                 'message_id')
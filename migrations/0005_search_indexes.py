@@ -0,0 +1,31 @@
+"""Postgres indexes for username and message search (see search.py).
+
+The trigram index needs the pg_trgm extension. Where it can't be
+installed it is skipped and username search matches prefixes only,
+through the prefix index; `flask create-search-indexes` adds it later.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from migrations import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    create_index(conn, 'ix_messages_text_fts', 'messages',
+                 "to_tsvector('english', text)", using='gin')
+    create_index(conn, 'ix_users_username_prefix', 'users',
+                 'lower(username) text_pattern_ops')
+
+    try:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except DBAPIError:
+        return
+
+    create_index(conn, 'ix_users_username_trgm', 'users',
+                 'lower(username) gin_trgm_ops', using='gin')
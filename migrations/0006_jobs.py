@@ -0,0 +1,7 @@
+"""Add the `jobs` table behind the background job queue (see jobs.py)."""
+
+from models import Job
+
+
+def upgrade(conn):
+    Job.__table__.create(conn, checkfirst=True)
@@ -0,0 +1,7 @@
+"""Add the `suggestions` table behind "who to follow" (see recommendations.py)."""
+
+from models import Suggestion
+
+
+def upgrade(conn):
+    Suggestion.__table__.create(conn, checkfirst=True)
@@ -0,0 +1,9 @@
+"""Index messages by timestamp, for replaying recent ones into trending.py."""
+
+from migrations import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    create_index(conn, 'ix_messages_timestamp', 'messages', 'timestamp')
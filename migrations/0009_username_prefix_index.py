@@ -0,0 +1,17 @@
+"""Index usernames for prefix search on databases without pg_trgm.
+
+0005 used to skip this index along with the trigram one when pg_trgm
+could not be installed; username search falls back to it there.
+"""
+
+from migrations import create_index
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    create_index(conn, 'ix_users_username_prefix', 'users',
+                 'lower(username) text_pattern_ops')
@@ -0,0 +1,16 @@
+"""Count each materialized timeline's entries, so fan-out trims only long feeds."""
+
+from sqlalchemy import inspect, text
+
+
+def upgrade(conn):
+    columns = {column['name'] for column in inspect(conn).get_columns('timelines')}
+    if 'length' in columns:
+        return
+
+    conn.execute(text(
+        "ALTER TABLE timelines ADD COLUMN length INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text("""
+        UPDATE timelines SET length = (SELECT count(*) FROM timeline_entries
+                                       WHERE timeline_entries.user_id = timelines.user_id)
+    """))
@@ -0,0 +1,27 @@
+"""Store messages' parsed text in a GIN-indexed tsvector column.
+
+Search ranked on to_tsvector(text), which Postgres re-parsed for every
+matching row. Adding the generated column rewrites `messages` under an
+exclusive lock; the index is then built concurrently, and replaces the
+expression index from 0005.
+"""
+
+from sqlalchemy import inspect, text
+
+from migrations import create_index
+from models import SEARCH_VECTOR
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'postgresql':
+        return
+
+    columns = {column['name'] for column in inspect(conn).get_columns('messages')}
+    if 'search_vector' not in columns:
+        conn.execute(text(f"ALTER TABLE messages ADD COLUMN {SEARCH_VECTOR}"))
+
+    create_index(conn, 'ix_messages_search_vector', 'messages', 'search_vector',
+                 using='gin')
+    conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_messages_text_fts"))
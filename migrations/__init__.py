@@ -0,0 +1,114 @@
+"""Versioned schema migrations.
+
+Each `NNNN_name.py` module in this package is one migration with an
+`upgrade(conn)` function. They run in order, once each, and the versions
+applied are recorded in `schema_migrations`. A migration runs in its own
+transaction unless it sets `TRANSACTIONAL = False`, which index builds
+using `create_index()` (CREATE INDEX CONCURRENTLY) must do.
+
+Migrations are written to be safe on a database that `db.create_all()`
+already brought up to date, so a fresh database and an old one end up
+with the same schema. Run them with `flask migrate`.
+"""
+
+import importlib
+import os
+import re
+from datetime import datetime
+
+from sqlalchemy import insert, select, text
+
+from models import db
+
+schema_migrations = db.Table(
+    'schema_migrations',
+    db.Column('version', db.String(100), primary_key=True),
+    db.Column('applied_at', db.DateTime, nullable=False),
+)
+
+# pg_advisory_lock key, so two deploys never migrate at once
+LOCK_ID = 7201401
+
+
+def available():
+    """(version, module) for every migration, oldest first."""
+
+    directory = os.path.dirname(__file__)
+    versions = sorted(name[:-3] for name in os.listdir(directory)
+                      if re.match(r'\d{4}_\w+\.py$', name))
+    return [(version, importlib.import_module(f'{__name__}.{version}'))
+            for version in versions]
+
+
+def applied(conn):
+    schema_migrations.create(conn, checkfirst=True)
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+
+def pending():
+    with db.engine.begin() as conn:
+        done = applied(conn)
+    return [(version, module) for version, module in available()
+            if version not in done]
+
+
+def upgrade(report=print):
+    """Apply every pending migration; returns the versions applied."""
+
+    db.session.commit()
+    ran = []
+    with db.engine.connect() as lock:
+        postgres = lock.dialect.name == 'postgresql'
+        if postgres:
+            lock.execute(text("SELECT pg_advisory_lock(:id)"), {'id': LOCK_ID})
+            lock.commit()
+        try:
+            for version, module in pending():
+                report(f"applying {version}")
+                if getattr(module, 'TRANSACTIONAL', True):
+                    with db.engine.begin() as conn:
+                        module.upgrade(conn)
+                        _record(conn, version)
+                else:
+                    with db.engine.connect() as conn:
+                        module.upgrade(conn.execution_options(
+                            isolation_level='AUTOCOMMIT'))
+                    with db.engine.begin() as conn:
+                        _record(conn, version)
+                ran.append(version)
+        finally:
+            if postgres:
+                lock.execute(text("SELECT pg_advisory_unlock(:id)"),
+                             {'id': LOCK_ID})
+                lock.commit()
+    return ran
+
+
+def _record(conn, version):
+    conn.execute(insert(schema_migrations).values(
+        version=version, applied_at=datetime.utcnow()))
+
+
+def create_index(conn, name, table, columns, using=None):
+    """Build an index without blocking writes, if it isn't there already.
+
+    On Postgres this is CREATE INDEX CONCURRENTLY, so `conn` must be in
+    autocommit mode. An invalid index left by a failed concurrent build is
+    dropped and built again.
+    """
+
+    if conn.dialect.name != 'postgresql':
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+        return
+
+    valid = conn.execute(text(
+        "SELECT i.indisvalid FROM pg_index i "
+        "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"),
+        {'name': name}).scalar()
+    if valid is False:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    using = f"USING {using} " if using else ""
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} "
+                      f"ON {table} {using}({columns})"))
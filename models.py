@@ -2,10 +2,11 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+
+from hashing import passwords
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
 
@@ -26,30 +27,45 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "who does X follow"
+    __table_args__ = (
+        db.Index('ix_follows_following', 'user_following_id',
+                 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
-
-    id = db.Column(
-        db.Integer,
-        primary_key=True
-    )
+    __tablename__ = 'likes'
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade'),nullable=False
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True, nullable=False
+        primary_key=True,
+        index=True,
     )
 
     message = db.relationship('Message', back_populates='likes', overlaps='likes')
 
+    user = db.relationship('User', overlaps='likes')
+
+
+def _follow_exists(follower_id, followed_id):
+    """Is there a follows row for this pair? (one primary-key probe)"""
+
+    follow = (Follows.query
+              .filter_by(user_following_id=follower_id,
+                         user_being_followed_id=followed_id)
+              .exists())
+    return db.session.query(follow).scalar()
+
 
 class User(db.Model):
     """User in the system."""
@@ -96,7 +112,45 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts, kept in step by counters.py
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped by profile edits and counter changes; a version for caching.py
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    messages = db.relationship('Message', cascade='all, delete-orphan', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -125,14 +179,34 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return _follow_exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return _follow_exists(follower_id=self.id, followed_id=other_user.id)
+
+    def followed_user_ids(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set."""
+
+        if not user_ids:
+            return set()
+
+        rows = (db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids)))
+        return {user_id for (user_id,) in rows}
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set."""
+
+        if not message_ids:
+            return set()
+
+        rows = (db.session.query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -143,7 +217,7 @@ class User(db.Model):
         if not username or not email or not password:
             return ("Username, email, and password are required fields")
         
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash(password)
 
         user = User(
             username=username,
@@ -164,13 +238,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at a lower cost than BCRYPT_LOG_ROUNDS is upgraded on
+        the user (not committed) after a successful check.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash(password)
                 return user
 
         return False
@@ -194,7 +273,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -203,11 +282,205 @@ class Message(db.Model):
         nullable=False,
     )
 
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User', overlaps="messages")
 
     # likes=db.relationship('Likes', backref='message', cascade='all, delete-orphan')
     likes = db.relationship('Likes', back_populates='message', cascade='all, delete-orphan',  overlaps='likes')
 
+    # Profile pages and the home timeline read a user's messages newest
+    # first; trending.py replays the last day's messages
+    __table_args__ = (
+        db.Index('ix_messages_user_timeline', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_timestamp', 'timestamp'),
+    )
+
+
+# Message search's parsed text, kept by Postgres itself (see search.py);
+# the ORM never reads or writes it
+SEARCH_VECTOR = ("search_vector tsvector GENERATED ALWAYS AS "
+                 "(to_tsvector('english', text)) STORED")
+
+event.listen(Message.__table__, 'after_create', DDL(
+    f"ALTER TABLE messages ADD COLUMN {SEARCH_VECTOR}"
+).execute_if(dialect='postgresql'))
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_timeline_entries_feed', 'user_id', 'timestamp', 'message_id'),
+    )
+
+
+class Timeline(db.Model):
+    """Marks a user's home timeline as materialized."""
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    built_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # Entries in the feed, near enough: kept exact by builds and trims,
+    # counted up by fan-out, never counted down
+    length = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+
+class Suggestion(db.Model):
+    """A precomputed "who to follow" suggestion; see recommendations.py."""
+
+    __tablename__ = 'suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    suggested_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+        index=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    # How many of the people the user follows follow the suggested user
+    mutuals = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_suggestions_rank', 'user_id', 'score'),
+    )
+
+
+class Job(db.Model):
+    """A unit of background work; see jobs.py."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.String(50),
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # Enqueueing a key that already exists is a no-op
+    idempotency_key = db.Column(
+        db.String(200),
+        unique=True,
+    )
+
+    status = db.Column(
+        db.String(20),
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_due', 'status', 'run_at', 'id'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
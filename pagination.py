@@ -0,0 +1,215 @@
+"""Keyset (cursor) pagination for Warbler lists.
+
+Pages are ordered newest-first and continue from an opaque `?before=` token
+holding the sort key of the last row shown, so every page is an index range
+scan of the same size no matter how deep it is.
+
+With STREAM_LISTS on, the paginate_* helpers called with `stream=True`
+return a StreamedPage instead: its rows come from a server-side cursor
+(`yield_per`) STREAM_BATCH_SIZE at a time while a streamed template
+renders them, so neither the first byte nor peak memory waits on the
+size of the page.
+"""
+
+import base64
+import json
+from datetime import datetime
+from itertools import islice
+
+from flask import abort, current_app, request, url_for
+from sqlalchemy import tuple_
+from sqlalchemy.orm import selectinload
+
+from models import Message, User
+
+
+class Page:
+    """One page of results plus the token for the page after it."""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class StreamedPage(Page):
+    """A page whose rows are fetched in batches as they are iterated.
+
+    `convert(rows)`, if given, turns each batch of result rows into what
+    the page holds. `on_batch(rows)` runs before each batch is handed
+    out, to load what the template needs for those rows. The page can be
+    iterated once, and `next_cursor` is only known after that.
+    """
+
+    def __init__(self, query, limit, key, batch_size, on_batch=None, convert=None):
+        self.next_cursor = None
+        self._peeked = []
+        self._rows = self._stream(query, limit, key, batch_size, on_batch, convert)
+
+    def __iter__(self):
+        peeked, self._peeked = self._peeked, []
+        yield from peeked
+        yield from self._rows
+
+    def __bool__(self):
+        if not self._peeked:
+            self._peeked = list(islice(self._rows, 1))
+        return bool(self._peeked)
+
+    def __len__(self):
+        raise TypeError("a streamed page has no length")
+
+    def _stream(self, query, limit, key, batch_size, on_batch, convert):
+        batch, last = [], None
+        # Fetching limit + 1 rows runs the cursor to its end, so it is closed
+        for count, row in enumerate(query.limit(limit + 1).yield_per(batch_size)):
+            if count == limit:
+                self.next_cursor = encode_cursor(*last)
+                continue
+            # Keyed on the raw row, before any convert
+            last = key(row)
+            batch.append(row)
+            if len(batch) == batch_size:
+                yield from _handed_out(batch, on_batch, convert)
+                batch = []
+
+        if batch:
+            yield from _handed_out(batch, on_batch, convert)
+
+
+def encode_cursor(*key):
+    """Turn a sort key (datetimes and ints) into an opaque URL-safe token."""
+
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in key]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, types):
+    """Turn a token back into a sort key; `types` gives each value's type.
+
+    Aborts with 400 on a malformed token.
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if len(values) != len(types):
+            raise ValueError(token)
+        return tuple(datetime.fromisoformat(value) if kind is datetime
+                     else kind(value)
+                     for kind, value in zip(types, values))
+    except (ValueError, TypeError):
+        abort(400)
+
+
+def page_size():
+    """Rows per page, from the PAGE_SIZE setting."""
+
+    return current_app.config.get('PAGE_SIZE', 100)
+
+
+def streaming():
+    """Whether list pages stream, from the STREAM_LISTS setting."""
+
+    return current_app.config.get('STREAM_LISTS', False)
+
+
+def before_key(types):
+    """The decoded `?before=` key of the current request, or None."""
+
+    token = request.args.get('before')
+    return decode_cursor(token, types) if token else None
+
+
+def message_key(msg):
+    """Sort key of a message: (timestamp, id)."""
+
+    return (msg.timestamp, msg.id)
+
+
+def user_key(user):
+    """Sort key of a user: (id,)."""
+
+    return (user.id,)
+
+
+def paginate_messages(query, limit=None, on_batch=None, stream=False, convert=None):
+    """Page a Message query newest-first on (timestamp, id).
+
+    Authors are loaded for the whole page (or each streamed batch) in one
+    extra query. A query of read_models.message_views() columns is paged
+    the same way with `convert=to_views`. `on_batch(rows)` is called on
+    the page's rows before they are used.
+    """
+
+    limit = limit or page_size()
+    before = before_key((datetime, int))
+    if convert is None:
+        query = query.options(selectinload(Message.user))
+
+    if before:
+        query = query.filter(tuple_(Message.timestamp, Message.id) < before)
+
+    query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+    return _page(query, limit, message_key, on_batch, stream, convert)
+
+
+def paginate_users(query, limit=None, on_batch=None, stream=False):
+    """Page a User query newest-first on id; see paginate_messages."""
+
+    limit = limit or page_size()
+    before = before_key((int,))
+
+    if before:
+        query = query.filter(User.id < before[0])
+
+    return _page(query.order_by(User.id.desc()), limit, user_key, on_batch, stream)
+
+
+def next_page_url(page):
+    """URL of the page after `page` on the current route, or None."""
+
+    if not page.next_cursor:
+        return None
+
+    args = dict(request.view_args or {})
+    args.update(request.args.to_dict())
+    args.pop('fragment', None)
+    args['before'] = page.next_cursor
+    return url_for(request.endpoint, **args)
+
+
+def make_page(rows, limit, key):
+    """Build a Page from up to `limit + 1` rows; `key` gives a row's sort key."""
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return Page(rows, encode_cursor(*key(rows[-1])))
+
+    return Page(rows, None)
+
+
+def _page(query, limit, key, on_batch, stream, convert=None):
+    if stream and streaming():
+        batch_size = current_app.config.get('STREAM_BATCH_SIZE', 500)
+        return StreamedPage(query, limit, key, batch_size, on_batch, convert)
+
+    rows = query.limit(limit + 1).all()
+    page = make_page(convert(rows) if convert else rows, limit, key)
+    _handed_out(page.items, on_batch)
+    return page
+
+
+def _handed_out(rows, on_batch, convert=None):
+    if convert:
+        rows = convert(rows)
+    if rows and on_batch:
+        on_batch(rows)
+    return rows
@@ -0,0 +1,123 @@
+"""Check that the hot routes never sequentially scan a large table.
+
+`check()` drives each route in ROUTES through the test client as a
+logged-in user, captures every statement the route runs, and EXPLAINs it
+with `enable_seqscan = off`. Postgres then uses any index that can
+answer the query, so a Seq Scan left in a plan means no index can, and
+the check reports it whatever the size of the seeded data. Run it against
+a loaded database with `flask check-query-plans` (Postgres only).
+"""
+
+import json
+
+from sqlalchemy import event, func, select
+
+from models import db, Follows, Message, User
+
+LARGE_TABLES = ('users', 'messages', 'follows', 'likes', 'timeline_entries',
+                'suggestions')
+
+# (method, url template); likes and follows are toggled twice so the
+# data ends where it started
+ROUTES = [
+    ('GET', '/'),
+    ('GET', '/users'),
+    ('GET', '/users/{other_id}'),
+    ('GET', '/users/{other_id}/following'),
+    ('GET', '/users/{other_id}/followers'),
+    ('GET', '/users/{user_id}/likes'),
+    ('GET', '/users/suggestions'),
+    ('GET', '/messages/{message_id}'),
+    ('POST', '/users/add_like/{message_id}'),
+    ('POST', '/users/add_like/{message_id}'),
+    ('POST', '/users/stop-following/{other_id}'),
+    ('POST', '/users/follow/{other_id}'),
+]
+
+
+def check(app, user_key):
+    """[(url, table, statement)] for every sequential scan of a large table.
+
+    `user_key` is the session key that logs a user in.
+    """
+
+    if db.engine.dialect.name != 'postgresql':
+        raise RuntimeError("query plans can only be checked on Postgres")
+
+    ids = _sample_ids()
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess[user_key] = ids['user_id']
+
+    problems = []
+    for method, url in ROUTES:
+        url = url.format(**ids)
+        for statement, parameters in _capture(client, method, url):
+            for table in sequential_scans(statement, parameters):
+                problems.append((url, table, statement))
+    return problems
+
+
+def sequential_scans(statement, parameters):
+    """Large tables that `statement` reads with a Seq Scan."""
+
+    if not statement.lstrip().upper().startswith(
+            ('SELECT', 'WITH', 'UPDATE', 'DELETE', 'INSERT')):
+        return []
+
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        plan = conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {statement}",
+                                    parameters).scalar()
+        conn.rollback()
+
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return sorted({node['Relation Name'] for node in _nodes(plan[0]['Plan'])
+                   if node['Node Type'] == 'Seq Scan'
+                   and node.get('Relation Name') in LARGE_TABLES})
+
+
+def _sample_ids():
+    """A well-connected user, someone they follow and one of that user's
+    messages, so every route has rows to read."""
+
+    user_id = db.session.execute(
+        select(User.id).order_by(User.following_count.desc()).limit(1)).scalar()
+    other_id = db.session.execute(
+        select(Follows.user_being_followed_id)
+        .join(User, User.id == Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id)
+        .order_by(User.messages_count.desc()).limit(1)).scalar()
+    message_id = db.session.execute(
+        select(func.max(Message.id))
+        .where(Message.user_id == (other_id or user_id))).scalar()
+    db.session.commit()
+
+    if message_id is None:
+        raise RuntimeError("seed the database first (flask bulk-load)")
+    return dict(user_id=user_id, other_id=other_id or user_id,
+                message_id=message_id)
+
+
+def _capture(client, method, url):
+    """(statement, parameters) for every statement one request runs."""
+
+    captured = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if not executemany:
+            captured.append((statement, parameters))
+
+    event.listen(db.engine, 'before_cursor_execute', listener)
+    try:
+        client.open(url, method=method)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', listener)
+    return captured
+
+
+def _nodes(plan):
+    yield plan
+    for child in plan.get('Plans', ()):
+        yield from _nodes(child)
@@ -0,0 +1,193 @@
+"""Token-bucket rate limits for the write routes and login.
+
+    @app.route('/messages/new', methods=["GET", "POST"])
+    @limiter.limit('30/minute', per='user')
+    def messages_add(): ...
+
+A limit of N/period is a bucket of N tokens that refills at N per period;
+each request takes one, and a request that finds the bucket empty gets a
+429 with Retry-After. `per='user'` keys buckets by the logged-in user
+(falling back to the client address), `per='ip'` by the client address
+alone. Limits apply to POSTs unless `methods` says otherwise, and
+RATELIMITS = {endpoint: [(per, rate), ...]} in the config overrides the
+limits a route declares.
+
+RATELIMIT_STORAGE picks where buckets live:
+
+- 'memory' (default): a dict in each process, so the limits are per
+  worker
+- 'sqlite:///path/to/file': a SQLite file shared by every worker on the
+  host
+
+The client address is `request.remote_addr`; behind a proxy, wrap the
+app in werkzeug's ProxyFix so it is the real client.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from functools import lru_cache, wraps
+
+from flask import g, request
+from werkzeug.exceptions import TooManyRequests
+
+from metrics import RATE_LIMITED
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    """(capacity, tokens per second) of a rate like '30/minute'."""
+
+    count, _, period = rate.partition('/')
+    seconds = PERIODS.get(period.strip().rstrip('s'))
+    if not count.strip().isdigit() or seconds is None:
+        raise ValueError(f"bad rate {rate!r}, expected like '30/minute'")
+    return int(count), int(count) / seconds
+
+
+class MemoryBuckets:
+    """Token buckets in a dict; limits hold within one process."""
+
+    def __init__(self, max_keys=100_000):
+        self.buckets = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate, now):
+        """Take a token; returns seconds to wait, or 0 if one was taken."""
+
+        with self.lock:
+            tokens, stamp = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self.buckets[key] = (tokens, now)
+                wait = (1 - tokens) / rate
+
+            if len(self.buckets) > self.max_keys:
+                # Buckets idle for long enough to have refilled are full
+                # anyway; the oldest half are at least the most refilled
+                stale = sorted(self.buckets, key=lambda k: self.buckets[k][1])
+                for old in stale[:len(stale) // 2]:
+                    del self.buckets[old]
+        return wait
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class SQLiteBuckets:
+    """Token buckets in a SQLite file shared by the processes on one host."""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        conn = self._connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets ("
+                     "key TEXT PRIMARY KEY, tokens REAL, stamp REAL)")
+        conn.close()
+
+    def take(self, key, capacity, rate, now):
+        """Take a token; returns seconds to wait, or 0 if one was taken."""
+
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, stamp FROM buckets WHERE key = ?",
+                               (key,)).fetchone()
+            tokens, stamp = row or (capacity, now)
+            tokens = min(capacity, tokens + (now - stamp) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)",
+                         (key, tokens - 1 if not wait else tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def clear(self):
+        conn = self._connection()
+        conn.execute("DELETE FROM buckets")
+
+    def _connection(self):
+        # sqlite3 connections belong to one thread, and must not cross a fork
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = self.local.conn = self._connect()
+            self.local.pid = os.getpid()
+        return conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        # Losing a moment of bucket state in a crash is harmless
+        conn.execute("PRAGMA synchronous = OFF")
+        return conn
+
+
+class RateLimiter:
+    """Applies per-route token-bucket limits."""
+
+    def __init__(self):
+        self.enabled = True
+        self.overrides = {}
+        self.storage = MemoryBuckets()
+
+    def init_app(self, app):
+        """Read RATELIMIT_* settings from the app config."""
+
+        self.enabled = app.config.setdefault('RATELIMIT_ENABLED', True)
+        self.overrides = app.config.setdefault('RATELIMITS', {})
+        storage = app.config.setdefault(
+            'RATELIMIT_STORAGE', os.environ.get('RATELIMIT_STORAGE', 'memory'))
+        if storage.startswith('sqlite:///'):
+            self.storage = SQLiteBuckets(storage[len('sqlite:///'):])
+        elif storage == 'memory':
+            self.storage = MemoryBuckets()
+        else:
+            raise ValueError(f"unknown RATELIMIT_STORAGE {storage!r}")
+        app.extensions['ratelimit'] = self
+
+    def limit(self, rate, per='user', methods=('POST',)):
+        """Decorate a view to allow `rate` requests per user or per IP."""
+
+        if per not in ('user', 'ip'):
+            raise ValueError(f"per must be 'user' or 'ip', not {per!r}")
+        declared = [(per, rate)]
+        parse_rate(rate)
+
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if self.enabled and request.method in methods:
+                    endpoint = request.endpoint
+                    self.check(endpoint, self.overrides.get(endpoint, declared))
+                return view(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def check(self, endpoint, limits):
+        """Raise TooManyRequests if any of the (per, rate) `limits` is used up."""
+
+        now = time.time()
+        for per, rate in limits:
+            capacity, rate = parse_rate(rate)
+            user = g.get('user') if per == 'user' else None
+            who = f'user:{user.id}' if user else f'ip:{request.remote_addr}'
+            wait = self.storage.take(f'{endpoint}:{who}', capacity, rate, now)
+            if wait:
+                RATE_LIMITED.inc(endpoint=endpoint)
+                raise TooManyRequests(retry_after=math.ceil(wait))
+
+
+limiter = RateLimiter()
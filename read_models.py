@@ -0,0 +1,96 @@
+"""Slim read models for the message lists.
+
+Timelines, profiles, likes and search results only read a few columns of
+each message and its author. `message_views()` selects just those, with
+whether the viewer likes each message as one more column, and
+`to_views()` turns the rows into `MessageView`s: plain `__slots__`
+objects, not tracked by the session, with no lazy loads or change
+tracking behind them. A view has the same attribute names as a Message
+(`msg.user.username`), so templates read either.
+
+    query = message_views(g.user.id).filter(Message.user_id == user_id)
+    page = paginate_messages(query, convert=to_views)
+"""
+
+from sqlalchemy import and_, exists, false
+
+from models import db, Likes, Message, User
+
+
+class AuthorView:
+    """The author columns a message list shows."""
+
+    __slots__ = ('id', 'username', 'image_url')
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+    def __repr__(self):
+        return f"<AuthorView #{self.id}: {self.username}>"
+
+
+class MessageView:
+    """A message as a list shows it; `liked` is for the viewing user."""
+
+    __slots__ = ('id', 'text', 'timestamp', 'like_count', 'user', 'liked')
+
+    def __init__(self, id, text, timestamp, like_count, user, liked):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.like_count = like_count
+        self.user = user
+        self.liked = liked
+
+    def __repr__(self):
+        return f"<MessageView #{self.id}: {self.text!r}>"
+
+
+def message_views(viewer_id=None):
+    """A Query of the columns `to_views` needs, authors joined.
+
+    Filter and order it as a Message query. Without a viewer, `liked` is
+    always false.
+    """
+
+    if viewer_id is None:
+        liked = false()
+    else:
+        # Correlated on messages alone, so it stays right in queries that
+        # join likes themselves
+        liked = (exists().where(and_(Likes.message_id == Message.id,
+                                     Likes.user_id == viewer_id))
+                 .correlate(Message))
+
+    return (db.session.query(Message.id, Message.text, Message.timestamp,
+                             Message.like_count, User.id, User.username,
+                             User.image_url, liked.label('liked'))
+            .join(User, User.id == Message.user_id))
+
+
+def to_views(rows):
+    """MessageViews of `message_views()` rows; authors are shared, not copied."""
+
+    authors = {}
+    views = []
+    for (message_id, text, timestamp, like_count,
+         user_id, username, image_url, liked) in rows:
+        author = authors.get(user_id)
+        if author is None:
+            author = authors[user_id] = AuthorView(user_id, username, image_url)
+        views.append(MessageView(message_id, text, timestamp, like_count,
+                                 author, bool(liked)))
+    return views
+
+
+def views_by_ids(message_ids, viewer_id=None):
+    """MessageViews of `message_ids`, in that order; missing ids are skipped."""
+
+    if not message_ids:
+        return []
+
+    by_id = {view.id: view for view in to_views(
+        message_views(viewer_id).filter(Message.id.in_(message_ids)))}
+    return [by_id[message_id] for message_id in message_ids if message_id in by_id]
@@ -0,0 +1,178 @@
+"""Precomputed "who to follow" suggestions.
+
+`refresh()` loads `follows` into a sparse CSR adjacency matrix A, where
+A[u, v] = 1 when u follows v, and scores candidates for a batch of users
+with two sparse products:
+
+- friends of friends, A[u] @ A: how many of the people u follows follow v
+- co-followers, A.T[u] @ A: how many of u's followers also follow v
+
+Users u already follows, and u themself, are dropped, and the top
+RECOMMENDATIONS_TOP_K by score are stored in `suggestions`. Pages only
+ever read that table.
+
+Following or unfollowing someone queues a refresh of the follower alone
+(see tasks.py), computed from the follows of their neighbourhood rather
+than the whole graph. Everyone else picks the change up at the next full
+refresh: `flask refresh-suggestions`.
+"""
+
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import delete, exists, insert, select, union
+
+import counters
+from models import db, Follows, Suggestion, User
+
+
+class Recommender:
+    """Computes and serves precomputed follow suggestions."""
+
+    def __init__(self):
+        self.top_k = 10
+        self.co_follower_weight = 0.5
+        self.batch_size = 1000
+        self.neighbourhood = 5000
+
+    def init_app(self, app):
+        """Read RECOMMENDATIONS_* settings from the app config."""
+
+        self.top_k = app.config.setdefault('RECOMMENDATIONS_TOP_K', 10)
+        self.co_follower_weight = app.config.setdefault(
+            'RECOMMENDATIONS_CO_FOLLOWER_WEIGHT', 0.5)
+        self.batch_size = app.config.setdefault('RECOMMENDATIONS_BATCH_SIZE', 1000)
+        self.neighbourhood = app.config.setdefault(
+            'RECOMMENDATIONS_NEIGHBOURHOOD', 5000)
+        app.extensions['recommendations'] = self
+
+    ##########################################################################
+    # Reads
+
+    def for_user(self, user_id, limit=None):
+        """[(user, mutuals)] suggested for `user_id`, best first.
+
+        Users followed since the last refresh are left out.
+        """
+
+        followed = exists().where(Follows.user_following_id == user_id,
+                                  Follows.user_being_followed_id == User.id)
+        return db.session.execute(
+            select(User, Suggestion.mutuals)
+            .join(Suggestion, Suggestion.suggested_id == User.id)
+            .where(Suggestion.user_id == user_id, ~followed)
+            .order_by(Suggestion.score.desc(), User.id)
+            .limit(limit or self.top_k)).all()
+
+    ##########################################################################
+    # Writes
+
+    def refresh(self, user_ids=None):
+        """Recompute the suggestions of `user_ids`, or of everyone."""
+
+        started = datetime.utcnow()
+        if user_ids is None:
+            adjacency, ids = self._graph(select(Follows.user_following_id,
+                                                Follows.user_being_followed_id))
+            targets = np.arange(len(ids))
+        else:
+            adjacency, ids = self._graph(self._neighbourhood_follows(user_ids))
+            wanted = np.unique(np.asarray(user_ids, dtype=np.int64))
+            positions = np.searchsorted(ids, wanted)
+            found = positions < len(ids)
+            found[found] &= ids[positions[found]] == wanted[found]
+            targets = positions[found]
+
+            # Users with no follows at all have nothing to suggest
+            self._replace(wanted[~found].tolist(), [])
+
+        followers = adjacency.T.tocsr()
+        for start in range(0, len(targets), self.batch_size):
+            batch = targets[start:start + self.batch_size]
+            rows = self.top(adjacency, followers, batch)
+            self._replace(ids[batch].tolist(),
+                          [dict(user_id=int(ids[user]), suggested_id=int(ids[other]),
+                                score=float(score), mutuals=int(mutuals),
+                                computed_at=started)
+                           for user, other, score, mutuals in rows])
+
+        if user_ids is None:
+            db.session.execute(
+                delete(Suggestion).where(Suggestion.computed_at < started))
+            db.session.commit()
+
+    def top(self, adjacency, followers, batch):
+        """(user, suggested, score, mutuals) index rows, best `top_k` per user.
+
+        `adjacency` is the CSR follow matrix, `followers` its transpose in
+        CSR form, and `batch` the row indexes to score.
+        """
+
+        following = adjacency[batch]
+        friends_of_friends = following @ adjacency
+        scores = (friends_of_friends
+                  + self.co_follower_weight * (followers[batch] @ adjacency))
+        scores = (scores - scores.multiply(following)).tocoo()
+
+        rows, cols, data = scores.row, scores.col, scores.data
+        keep = (data > 0) & (cols != batch[rows])
+        rows, cols, data = rows[keep], cols[keep], data[keep]
+
+        # Best first within each user, then the first top_k of each run
+        order = np.lexsort((cols, -data, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+        best = rank < self.top_k
+        rows, cols, data = rows[best], cols[best], data[best]
+
+        mutuals = np.asarray(friends_of_friends[rows, cols]).ravel()
+        return zip(batch[rows], cols, data, mutuals)
+
+    def _graph(self, edges):
+        """(CSR adjacency, sorted user ids) from a select of follow pairs."""
+
+        chunks = [np.array(partition, dtype=np.int64).reshape(-1, 2)
+                  for partition in db.session.execute(
+                      edges.execution_options(yield_per=100_000)).partitions()]
+        pairs = np.concatenate(chunks) if chunks else np.empty((0, 2), np.int64)
+
+        ids, index = np.unique(pairs.ravel(), return_inverse=True)
+        index = index.reshape(-1, 2)
+        adjacency = sparse.csr_matrix(
+            (np.ones(len(index), dtype=np.float32), (index[:, 0], index[:, 1])),
+            shape=(len(ids), len(ids)))
+        return adjacency, ids
+
+    def _neighbourhood_follows(self, user_ids):
+        """Select of the follows needed to score `user_ids`.
+
+        That is every follow by the users, by the people they follow, and
+        by up to RECOMMENDATIONS_NEIGHBOURHOOD of their followers.
+        """
+
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id.in_(user_ids)))
+        followers = (select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id.in_(user_ids))
+                     .limit(self.neighbourhood).subquery())
+        sources = union(select(User.id).where(User.id.in_(user_ids)),
+                        followed, select(followers.c.user_following_id))
+        return (select(Follows.user_following_id, Follows.user_being_followed_id)
+                .where(Follows.user_following_id.in_(sources)))
+
+    def _replace(self, user_ids, rows):
+        """Swap the stored suggestions of `user_ids` for `rows`, and commit."""
+
+        if not user_ids:
+            return
+
+        db.session.execute(delete(Suggestion).where(Suggestion.user_id.in_(user_ids)))
+        if rows:
+            db.session.execute(insert(Suggestion), rows)
+        # Their profile sidebars changed
+        counters.adjust(user_ids)
+        db.session.commit()
+
+
+recommendations = Recommender()
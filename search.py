@@ -0,0 +1,582 @@
+"""Username and message search for Warbler.
+
+On Postgres, usernames are searched through pg_trgm trigram indexes (or,
+without the extension, by indexed prefix only) and message text through a
+`tsvector` GIN index. On SQLite (development and tests) in-process indexes
+are loaded on first use and kept current from committed inserts, updates
+and deletes.
+"""
+
+import calendar
+import logging
+import math
+import re
+import threading
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+from sqlalchemy import (Float, cast, event, func, literal_column, select, text,
+                        tuple_)
+from sqlalchemy.orm import Session
+
+from models import db, Message, User
+
+logger = logging.getLogger('warbler.search')
+
+##############################################################################
+# Username search
+
+# Like pg_trgm.similarity_threshold: weaker matches are dropped unless the
+# query is a substring of the username
+SIMILARITY_THRESHOLD = 0.3
+
+
+def trigrams(value):
+    """Set of trigrams of `value`, padded the way pg_trgm pads words."""
+
+    grams = set()
+    for word in value.lower().split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NgramIndex:
+    """In-process trigram index of short strings, keyed by id.
+
+    Supports ranked fuzzy search and prefix lookups.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._gram_counts = {}
+        self._postings = defaultdict(set)
+        self._sorted = []
+
+    def __len__(self):
+        return len(self._values)
+
+    def add(self, key, value):
+        """Index `value` under `key`, replacing what was there."""
+
+        with self._lock:
+            self._remove(key)
+            grams = trigrams(value)
+            self._values[key] = value
+            self._gram_counts[key] = len(grams)
+            for gram in grams:
+                self._postings[gram].add(key)
+            insort(self._sorted, (value.lower(), key))
+
+    def remove(self, key):
+        """Forget `key`, if indexed."""
+
+        with self._lock:
+            self._remove(key)
+
+    def search(self, query, limit):
+        """Up to `limit` keys matching `query`, best first.
+
+        Prefix matches rank first, then other substring matches, then
+        fuzzy matches by trigram similarity.
+        """
+
+        query_grams = trigrams(query)
+        needle = query.lower().strip()
+        if not query_grams:
+            return []
+
+        with self._lock:
+            shared = Counter()
+            for gram in query_grams:
+                shared.update(self._postings.get(gram, ()))
+
+            scored = []
+            for key, common in shared.items():
+                value = self._values[key].lower()
+                similarity = common / (len(query_grams)
+                                       + self._gram_counts[key] - common)
+                if value.startswith(needle):
+                    rank = 2
+                elif needle in value:
+                    rank = 1
+                elif similarity >= SIMILARITY_THRESHOLD:
+                    rank = 0
+                else:
+                    continue
+                scored.append((-rank, -similarity, value, key))
+
+        scored.sort()
+        return [key for *_, key in scored[:limit]]
+
+    def prefix(self, prefix, limit):
+        """Up to `limit` keys whose value starts with `prefix`, alphabetically."""
+
+        prefix = prefix.lower()
+        with self._lock:
+            start = bisect_left(self._sorted, (prefix,))
+            keys = []
+            for value, key in self._sorted[start:]:
+                if not value.startswith(prefix) or len(keys) == limit:
+                    break
+                keys.append(key)
+        return keys
+
+    def _remove(self, key):
+        value = self._values.pop(key, None)
+        if value is None:
+            return
+
+        del self._gram_counts[key]
+        for gram in trigrams(value):
+            self._postings[gram].discard(key)
+            if not self._postings[gram]:
+                del self._postings[gram]
+        self._sorted.remove((value.lower(), key))
+
+
+class _PrefixBackend:
+    """Postgres without pg_trgm: usernames starting with the query.
+
+    Uses the `lower(username) text_pattern_ops` index, which needs no
+    extension, so it stays an index range scan however many users there
+    are.
+    """
+
+    INDEXES = (
+        "CREATE INDEX IF NOT EXISTS ix_users_username_prefix "
+        "ON users (lower(username) text_pattern_ops)",
+    )
+
+    def search(self, query, limit):
+        return self.prefix(query.strip(), limit)
+
+    def prefix(self, prefix, limit):
+        username = func.lower(User.username)
+
+        rows = db.session.execute(
+            select(User.id)
+            .where(username.startswith(prefix.lower(), autoescape=True))
+            .order_by(username)
+            .limit(limit))
+        return [user_id for (user_id,) in rows]
+
+
+class _TrigramBackend(_PrefixBackend):
+    """Search with pg_trgm operators and the indexes in INDEXES."""
+
+    INDEXES = (
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+        "ON users USING gin (lower(username) gin_trgm_ops)",
+        *_PrefixBackend.INDEXES,
+    )
+
+    def search(self, query, limit):
+        needle = query.lower().strip()
+        username = func.lower(User.username)
+        similarity = func.similarity(username, needle)
+
+        rows = db.session.execute(
+            select(User.id)
+            .where(username.op('%')(needle)
+                   | username.contains(needle, autoescape=True))
+            .order_by(username.startswith(needle, autoescape=True).desc(),
+                      username.contains(needle, autoescape=True).desc(),
+                      similarity.desc(),
+                      username)
+            .limit(limit))
+        return [user_id for (user_id,) in rows]
+
+
+class _MemoryBackend:
+    """Search an in-process NgramIndex, loaded from `users` on first use.
+
+    Only for SQLite: every process holds every username.
+    """
+
+    def __init__(self):
+        self.index = NgramIndex()
+        self._loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            for user_id, username in db.session.execute(
+                    select(User.id, User.username)):
+                self.index.add(user_id, username)
+            self._loaded = True
+
+    def search(self, query, limit):
+        self._load()
+        return self.index.search(query, limit)
+
+    def prefix(self, prefix, limit):
+        self._load()
+        return self.index.prefix(prefix, limit)
+
+    def apply(self, changes):
+        """Apply committed (user_id, username-or-None) changes."""
+
+        if not self._loaded:
+            return
+
+        for user_id, username in changes:
+            if username is None:
+                self.index.remove(user_id)
+            else:
+                self.index.add(user_id, username)
+
+
+class UserSearch:
+    """Ranked username search and autocomplete."""
+
+    def __init__(self):
+        self.limit = 50
+        self._backend = None
+
+    def init_app(self, app):
+        """Read USER_SEARCH_* settings from the app config."""
+
+        self.limit = app.config.setdefault('USER_SEARCH_LIMIT', 50)
+        app.extensions['user_search'] = self
+
+    @property
+    def backend(self):
+        """The backend for this database.
+
+        pg_trgm on Postgres, or indexed prefix search where the extension
+        is missing; the in-process index on SQLite.
+        """
+
+        if self._backend is None:
+            if db.engine.dialect.name != 'postgresql':
+                self._backend = _MemoryBackend()
+            elif _has_pg_trgm():
+                self._backend = _TrigramBackend()
+            else:
+                logger.warning("pg_trgm is not installed; username search "
+                               "matches prefixes only (see create-search-indexes)")
+                self._backend = _PrefixBackend()
+        return self._backend
+
+    def search(self, query, limit=None):
+        """Ids of users whose username best matches `query`, best first."""
+
+        return self.backend.search(query, limit or self.limit)
+
+    def autocomplete(self, prefix, limit=10):
+        """Ids of users whose username starts with `prefix`."""
+
+        return self.backend.prefix(prefix, limit)
+
+    def create_indexes(self):
+        """Install pg_trgm and the username indexes (Postgres only)."""
+
+        if db.engine.dialect.name != 'postgresql':
+            return
+
+        for statement in _TrigramBackend.INDEXES:
+            db.session.execute(text(statement))
+        db.session.commit()
+        self._backend = None
+
+    def load(self, user_ids):
+        """Users for `user_ids`, in the same order."""
+
+        by_id = {user.id: user
+                 for user in User.query.filter(User.id.in_(user_ids))}
+        return [by_id[user_id] for user_id in user_ids if user_id in by_id]
+
+
+def _has_pg_trgm():
+    """Is the pg_trgm extension installed in this database?"""
+
+    installed = db.session.execute(
+        text("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"))
+    return installed.first() is not None
+
+
+user_search = UserSearch()
+
+
+##############################################################################
+# Message full-text search
+
+STOP_WORDS = frozenset("""
+    a about after all also an and any are as at be been but by can could do
+    for from had has have he her his how i if in into is it its just me my no
+    not of on or our out she so than that the their them then there these
+    they this to too up us was we were what when which who will with would
+    you your
+""".split())
+
+TOKEN_RE = re.compile(r"[#@]?[a-z0-9']+")
+
+
+def tokenize(value):
+    """Lowercased words, hashtags and mentions of `value`, minus stop-words."""
+
+    tokens = (token.strip("'") for token in TOKEN_RE.findall(value.lower()))
+    return [token for token in tokens if token and token not in STOP_WORDS]
+
+
+def epoch(timestamp):
+    """Seconds since the epoch of a naive UTC datetime."""
+
+    return calendar.timegm(timestamp.utctimetuple()) + timestamp.microsecond / 1e6
+
+
+class InvertedIndex:
+    """In-process inverted index of short documents, keyed by id.
+
+    A document matches when it holds every query token. Results are ordered
+    by a rank key, log(tf-idf score) + age bonus, where the age bonus grows
+    by log(2) every `half_life` seconds: a message scores as well as one
+    half_life older that matches twice as strongly. The key does not change
+    as time passes, so it can be paged on.
+    """
+
+    def __init__(self, half_life):
+        self.half_life = half_life
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)
+        self._docs = {}
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, doc_id, value, timestamp):
+        """Index `value`, written at `timestamp`, under `doc_id`."""
+
+        tokens = Counter(tokenize(value))
+        with self._lock:
+            self._remove(doc_id)
+            self._docs[doc_id] = (epoch(timestamp), sum(tokens.values()),
+                                  tuple(tokens))
+            for token, count in tokens.items():
+                self._postings[token][doc_id] = count
+
+    def remove(self, doc_id):
+        """Forget `doc_id`, if indexed."""
+
+        with self._lock:
+            self._remove(doc_id)
+
+    def search(self, query, limit, before=None):
+        """Up to `limit` (rank_key, doc_id) pairs matching `query`, best first.
+
+        `before` is an optional (rank_key, doc_id) to continue after.
+        """
+
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+
+        with self._lock:
+            postings = sorted((self._postings.get(token, {}) for token in tokens),
+                              key=len)
+            if not postings[0]:
+                return []
+
+            total = len(self._docs)
+            idf = [math.log(1 + total / len(posting)) for posting in postings]
+
+            results = []
+            for doc_id in postings[0]:
+                if not all(doc_id in posting for posting in postings[1:]):
+                    continue
+                seconds, length, _ = self._docs[doc_id]
+                score = sum(posting[doc_id] * weight
+                            for posting, weight in zip(postings, idf))
+                rank = (math.log(score / math.sqrt(length))
+                        + seconds * math.log(2) / self.half_life)
+                if before is None or (rank, doc_id) < before:
+                    results.append((rank, doc_id))
+
+        results.sort(reverse=True)
+        return results[:limit]
+
+    def _remove(self, doc_id):
+        doc = self._docs.pop(doc_id, None)
+        if doc is None:
+            return
+
+        for token in doc[2]:
+            posting = self._postings[token]
+            posting.pop(doc_id, None)
+            if not posting:
+                del self._postings[token]
+
+
+class _TextSearchBackend:
+    """Search with Postgres full-text search and the index in INDEXES.
+
+    Matches come from the GIN-indexed `search_vector` column (see
+    models.py). Only the newest `candidates` of them are ranked, so a
+    common word costs a bounded sort rather than one over every message
+    that contains it; with the recency half-life, older matches would
+    rarely rank anyway.
+    """
+
+    INDEXES = (
+        "CREATE INDEX IF NOT EXISTS ix_messages_search_vector "
+        "ON messages USING gin (search_vector)",
+    )
+
+    def __init__(self, half_life, candidates):
+        self.half_life = half_life
+        self.candidates = candidates
+
+    def search(self, query, limit, before=None):
+        vector = literal_column('messages.search_vector')
+        ts_query = func.plainto_tsquery('english', query)
+
+        newest = (select(Message.id, Message.timestamp,
+                         vector.label('search_vector'))
+                  .where(vector.op('@@')(ts_query))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(self.candidates)
+                  .cte('newest'))
+        seconds = cast(func.extract('epoch', newest.c.timestamp), Float)
+        rank = (func.ln(func.greatest(
+                    func.ts_rank(newest.c.search_vector, ts_query), 1e-9))
+                + seconds * (math.log(2) / self.half_life))
+
+        statement = (select(rank, newest.c.id)
+                     .order_by(rank.desc(), newest.c.id.desc())
+                     .limit(limit))
+        if before:
+            statement = statement.where(tuple_(rank, newest.c.id) < before)
+
+        return [tuple(row) for row in db.session.execute(statement)]
+
+    def reindex(self):
+        for statement in self.INDEXES:
+            db.session.execute(text(statement))
+        db.session.execute(text("REINDEX INDEX ix_messages_search_vector"))
+        db.session.commit()
+
+
+class _MessageMemoryBackend:
+    """Search an in-process InvertedIndex, loaded from `messages` on first use."""
+
+    def __init__(self, half_life):
+        self.index = InvertedIndex(half_life)
+        self._loaded = False
+
+    def search(self, query, limit, before=None):
+        if not self._loaded:
+            self.reindex()
+        return self.index.search(query, limit, before)
+
+    def reindex(self, batch_size=10000):
+        self.index = InvertedIndex(self.index.half_life)
+        rows = db.session.execute(
+            select(Message.id, Message.text, Message.timestamp)
+            .execution_options(yield_per=batch_size))
+        for message_id, value, timestamp in rows:
+            self.index.add(message_id, value, timestamp)
+        self._loaded = True
+
+    def apply(self, changes):
+        """Apply committed (message_id, text-or-None, timestamp) changes."""
+
+        if not self._loaded:
+            return
+
+        for message_id, value, timestamp in changes:
+            if value is None:
+                self.index.remove(message_id)
+            else:
+                self.index.add(message_id, value, timestamp)
+
+
+class MessageSearch:
+    """Ranked full-text search over message text."""
+
+    def __init__(self):
+        self.half_life = 48 * 3600
+        self.candidates = 1000
+        self._backend = None
+
+    def init_app(self, app):
+        """Read MESSAGE_SEARCH_* settings from the app config."""
+
+        hours = app.config.setdefault('MESSAGE_SEARCH_HALF_LIFE_HOURS', 48)
+        self.half_life = hours * 3600
+        self.candidates = app.config.setdefault('MESSAGE_SEARCH_CANDIDATES', 1000)
+        app.extensions['message_search'] = self
+
+    @property
+    def backend(self):
+        """Postgres full-text search when available, else the in-process index."""
+
+        if self._backend is None:
+            if db.engine.dialect.name == 'postgresql':
+                self._backend = _TextSearchBackend(self.half_life,
+                                                   self.candidates)
+            else:
+                self._backend = _MessageMemoryBackend(self.half_life)
+        return self._backend
+
+    def search(self, query, limit, before=None):
+        """Up to `limit` (rank_key, message_id) pairs for `query`, best first."""
+
+        return self.backend.search(query, limit, before)
+
+    def reindex(self):
+        """Rebuild the message index from the `messages` table."""
+
+        self.backend.reindex()
+
+
+message_search = MessageSearch()
+
+
+##############################################################################
+# Keep the in-process indexes in step with committed changes
+
+
+def _pending(target, name):
+    """List of changes for index `name` waiting on the target's session."""
+
+    return Session.object_session(target).info.setdefault(name, [])
+
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_update')
+def _user_saved(mapper, connection, user):
+    _pending(user, 'user_search').append((user.id, user.username))
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, user):
+    _pending(user, 'user_search').append((user.id, None))
+
+
+@event.listens_for(Message, 'after_insert')
+@event.listens_for(Message, 'after_update')
+def _message_saved(mapper, connection, message):
+    _pending(message, 'message_search').append(
+        (message.id, message.text, message.timestamp))
+
+
+@event.listens_for(Message, 'after_delete')
+def _message_deleted(mapper, connection, message):
+    _pending(message, 'message_search').append((message.id, None, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    for name, search in (('user_search', user_search),
+                         ('message_search', message_search)):
+        changes = session.info.pop(name, None)
+        if changes and hasattr(search._backend, 'apply'):
+            search._backend.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('user_search', None)
+    session.info.pop('message_search', None)
@@ -0,0 +1,129 @@
+"""Heavy writes that run off the request path, as jobs (see jobs.py)."""
+
+from datetime import datetime
+
+from sqlalchemy import delete, func, select, update
+
+import counters
+from jobs import jobs
+from models import db, Follows, Likes, Message, User
+from recommendations import recommendations
+from timeline import timelines
+from user_cache import invalidate_on_commit
+
+
+@jobs.task('fan_out')
+def fan_out(message_id):
+    """Push a new message into its author's followers' timelines."""
+
+    message = db.session.get(Message, message_id)
+    if message is not None:
+        timelines.push(message)
+
+
+@jobs.task('backfill_timeline')
+def backfill_timeline(follower_id, followed_id):
+    """Backfill a newly followed user's messages into the follower's timeline."""
+
+    if db.session.get(Follows, (followed_id, follower_id)) is not None:
+        timelines.follow(follower_id, followed_id)
+
+
+@jobs.task('refresh_suggestions')
+def refresh_suggestions(user_ids=None):
+    """Recompute "who to follow" for `user_ids`, or for everyone."""
+
+    recommendations.refresh(user_ids)
+
+
+@jobs.task('reconcile_counters')
+def reconcile_counters():
+    counters.reconcile()
+
+
+@jobs.task('delete_user')
+def delete_user(user_id):
+    """Delete a user and everything of theirs, JOBS_BATCH_SIZE rows at a time.
+
+    Each batch commits on its own and adjusts the counters of exactly the
+    rows it deleted, so a job that fails part-way is safely run again.
+    """
+
+    steps = [_unfollow_batch, _unfollowed_batch, _unlike_batch, _messages_batch]
+    for step in steps:
+        while step(user_id, jobs.batch_size):
+            db.session.commit()
+
+    user = db.session.get(User, user_id)
+    if user is not None:
+        db.session.delete(user)
+
+
+def _unfollow_batch(user_id, size):
+    """Drop a batch of the user's follows; returns how many."""
+
+    followed = db.session.execute(
+        select(Follows.user_being_followed_id)
+        .where(Follows.user_following_id == user_id).limit(size)).scalars().all()
+    if followed:
+        db.session.execute(delete(Follows).where(
+            Follows.user_following_id == user_id,
+            Follows.user_being_followed_id.in_(followed)))
+        counters.adjust(followed, followers_count=-1)
+    return len(followed)
+
+
+def _unfollowed_batch(user_id, size):
+    """Drop a batch of the follows of the user; returns how many."""
+
+    followers = db.session.execute(
+        select(Follows.user_following_id)
+        .where(Follows.user_being_followed_id == user_id).limit(size)).scalars().all()
+    if followers:
+        db.session.execute(delete(Follows).where(
+            Follows.user_being_followed_id == user_id,
+            Follows.user_following_id.in_(followers)))
+        counters.adjust(followers, following_count=-1)
+    return len(followers)
+
+
+def _unlike_batch(user_id, size):
+    """Drop a batch of the user's likes; returns how many."""
+
+    liked = db.session.execute(
+        select(Likes.message_id)
+        .where(Likes.user_id == user_id).limit(size)).scalars().all()
+    if liked:
+        db.session.execute(delete(Likes).where(Likes.user_id == user_id,
+                                               Likes.message_id.in_(liked)))
+        db.session.execute(update(Message).where(Message.id.in_(liked))
+                           .values(like_count=Message.like_count - 1))
+    return len(liked)
+
+
+def _messages_batch(user_id, size):
+    """Delete a batch of the user's messages and their likes; returns how many."""
+
+    message_ids = db.session.execute(
+        select(Message.id)
+        .where(Message.user_id == user_id).limit(size)).scalars().all()
+    if not message_ids:
+        return 0
+
+    liked = (select(func.count())
+             .where(Likes.message_id.in_(message_ids))
+             .where(Likes.user_id == User.id)
+             .scalar_subquery())
+    likers = select(Likes.user_id).where(Likes.message_id.in_(message_ids))
+    db.session.execute(update(User)
+                       .where(User.id.in_(likers))
+                       .values(likes_count=User.likes_count - liked,
+                               updated_at=datetime.utcnow()))
+    invalidate_on_commit()
+
+    # Timeline entries go with the messages (ON DELETE CASCADE)
+    db.session.execute(delete(Likes).where(Likes.message_id.in_(message_ids)))
+    db.session.execute(delete(Message).where(Message.id.in_(message_ids)))
+    db.session.info.setdefault('message_search', []).extend(
+        (message_id, None, None) for message_id in message_ids)
+    return len(message_ids)
@@ -0,0 +1,93 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app
+from assets import assets, build
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinting, precompression and serving of static files."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.addCleanup(setattr, assets, 'manifest', assets.manifest)
+        self.addCleanup(setattr, assets, 'directory', assets.directory)
+        assets.directory = self.directory
+        assets.manifest = build(app.static_folder, self.directory,
+                                report=lambda line: None)
+
+        self.client = app.test_client()
+
+    def test_build(self):
+        """Are files hashed, text precompressed and stylesheet URLs rewritten?"""
+
+        hashed = assets.manifest['stylesheets/style.css']
+        self.assertRegex(hashed, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        path = os.path.join(self.directory, hashed)
+        with open(path, 'rb') as f:
+            css = f.read()
+        with open(path + '.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), css)
+
+        self.assertNotIn(b'/static/images/', css)
+        self.assertIn(f"/assets/{assets.manifest['images/nav-bg.png']}".encode(), css)
+
+        # Images are already compressed
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, assets.manifest['images/nav-bg.png']) + '.gz'))
+
+    def test_serve(self):
+        """Is a built asset sent precompressed, with immutable caching?"""
+
+        url = assets.url('/static/stylesheets/style.css')
+        self.assertTrue(url.startswith('/assets/stylesheets/style.'))
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('max-age=31536000', resp.headers['Cache-Control'])
+
+        resp = self.client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'.navbar', resp.data)
+
+        self.assertEqual(self.client.get('/assets/../app.py').status_code, 404)
+
+    def test_unbuilt(self):
+        """Without a manifest, are static URLs cache-busted by content hash?"""
+
+        assets.manifest = {}
+        self.assertRegex(assets.url('stylesheets/style.css'),
+                         r'^/static/stylesheets/style\.css\?v=[0-9a-f]{12}$')
+        self.assertEqual(assets.url('https://example.com/me.png'),
+                         'https://example.com/me.png')
+        self.assertIsNone(assets.url(None))
@@ -0,0 +1,89 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bulk_load.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app
+from bulk_load import CHECKPOINT, load
+
+
+class BulkLoadTestCase(TestCase):
+    """Test chunked loading and resuming from a checkpoint."""
+
+    def setUp(self):
+        """Write a small set of CSVs."""
+
+        self.directory = tempfile.mkdtemp()
+        self.write('users.csv', ['email,username,password'] + [
+            f'u{n}@test.com,user{n},HASHED_PASSWORD' for n in range(5)])
+        self.write('messages.csv', ['text,timestamp,user_id'] + [
+            f'hello {n},2017-01-21 11:04:53.522807,{n % 2 + 1}'
+            for n in range(3)])
+        self.write('follows.csv', ['user_being_followed_id,user_following_id',
+                                   '1,2', '1,3'])
+
+    def tearDown(self):
+        db.session.rollback()
+        shutil.rmtree(self.directory)
+
+    def write(self, name, lines):
+        with open(os.path.join(self.directory, name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_load(self):
+        """Are all rows loaded, ids sequential and counters reconciled?"""
+
+        total = load(self.directory, chunk_size=2, report=lambda line: None)
+        self.assertEqual(total, 10)
+
+        self.assertEqual([u.id for u in User.query.order_by(User.id)],
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(db.session.get(User, 1).followers_count, 2)
+        self.assertEqual(db.session.get(User, 1).messages_count, 2)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.directory, CHECKPOINT)))
+
+        u = User.signup("new", "new@test.com", "password", None)
+        db.session.commit()
+        self.assertEqual(u.id, 6)
+
+    def test_resume(self):
+        """Does a failed load resume after the rows it committed?"""
+
+        self.write('follows.csv', ['user_being_followed_id,user_following_id',
+                                   '1,2', '1,oops'])
+        with self.assertRaises(Exception):
+            load(self.directory, chunk_size=1, report=lambda line: None)
+        db.session.rollback()
+        self.assertEqual(Follows.query.count(), 1)
+
+        self.write('follows.csv', ['user_being_followed_id,user_following_id',
+                                   '1,2', '1,3'])
+        total = load(self.directory, chunk_size=1, report=lambda line: None)
+        self.assertEqual(total, 1 + 3)
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 3)
+        self.assertEqual(Follows.query.count(), 2)
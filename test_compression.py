@@ -0,0 +1,112 @@
+"""Response compression tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+import os
+from unittest import TestCase
+
+import brotli
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from compression import compression
+
+db.create_all()
+
+
+class CompressionTestCase(TestCase):
+    """Test negotiation, thresholds and streamed compression."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        self.user = User.signup("squeezed", "squeezed@test.com", "password", None)
+        db.session.flush()
+        for n in range(20):
+            db.session.add(Message(text=f"warble number {n}", user_id=self.user.id))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_buffered(self):
+        """Is a page gzipped or brotli'd as accepted, and still revalidated?"""
+
+        plain = self.client.get('/')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        resp = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(int(resp.headers['Content-Length']), len(resp.data))
+        self.assertEqual(gzip.decompress(resp.data), plain.data)
+        self.assertIn('compress;', ', '.join(resp.headers.getlist('Server-Timing')))
+
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        resp = self.client.get('/', headers={'Accept-Encoding': 'gzip',
+                                             'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get('/', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.data), plain.data)
+
+    def test_skipped(self):
+        """Are small bodies, HEAD requests and disabled compression left alone?"""
+
+        resp = self.client.get('/users/autocomplete?q=squ',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'squeezed', resp.data)
+
+        resp = self.client.head('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+        compression.enabled = False
+        self.addCleanup(setattr, compression, 'enabled', True)
+        resp = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_streamed(self):
+        """Is a streamed page compressed in several flushed pieces?"""
+
+        self.addCleanup(setattr, compression, 'flush_size', compression.flush_size)
+        compression.flush_size = 1024
+
+        for message in Message.query.all():
+            db.session.add(Likes(user_id=self.user.id, message_id=message.id))
+        db.session.commit()
+        plain = self.client.get(f'/users/{self.user.id}/likes').data
+
+        resp = self.client.get(f'/users/{self.user.id}/likes',
+                               headers={'Accept-Encoding': 'gzip'}, buffered=False)
+        self.assertIsNone(resp.content_length)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        chunks = [chunk for chunk in resp.response if chunk]
+        resp.close()
+
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(gzip.decompress(b''.join(chunks)), plain)
+        self.assertIn(b'warble number 19', plain)
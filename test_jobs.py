@@ -0,0 +1,169 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Follows, Job, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from counters import reconcile
+from jobs import jobs
+from metrics import JOB_RESULTS
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+calls = []
+
+
+@jobs.task('test_flaky')
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError("try again")
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing, retries and the heavy writes moved to jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        calls.clear()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def make_due(self):
+        db.session.execute(db.update(Job).values(run_at=datetime.utcnow()))
+        db.session.commit()
+
+    def test_idempotency_key(self):
+        """Is a job queued twice under one key stored once?"""
+
+        jobs.enqueue('test_flaky', key='once', fail_times=0)
+        jobs.enqueue('test_flaky', key='once', fail_times=0)
+        db.session.commit()
+
+        self.assertEqual(Job.query.count(), 1)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(calls, [0])
+
+    def test_retry_then_fail(self):
+        """Are failing jobs retried with backoff, then given up on?"""
+
+        done = JOB_RESULTS.values.get(('test_flaky', 'done'), 0)
+        jobs.enqueue('test_flaky', fail_times=1)
+        db.session.commit()
+
+        self.assertEqual(jobs.run_pending(), 1)
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn("try again", job.last_error)
+
+        self.make_due()
+        jobs.run_pending()
+        self.assertEqual(Job.query.one().status, 'done')
+        self.assertEqual(JOB_RESULTS.values[('test_flaky', 'done')], done + 1)
+
+        calls.clear()
+        jobs.enqueue('test_flaky', fail_times=99)
+        db.session.commit()
+        for attempt in range(jobs.max_attempts):
+            self.make_due()
+            jobs.run_pending()
+        job = Job.query.filter_by(status='failed').one()
+        self.assertEqual(job.attempts, jobs.max_attempts)
+        self.assertEqual(jobs.backlog()[0], {'failed': 1})
+
+    def test_expired_lease(self):
+        """Is a job left running by a dead worker claimed again?"""
+
+        jobs.enqueue('test_flaky', fail_times=0)
+        db.session.commit()
+        job = Job.query.one()
+        job.status = 'running'
+        job.locked_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(jobs.run_pending(), 0)
+
+        job.locked_at = datetime.utcnow() - timedelta(seconds=jobs.lease + 1)
+        db.session.commit()
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(Job.query.one().status, 'done')
+
+    def test_delete_user(self):
+        """Does deleting a user remove their rows in batches and fix counters?"""
+
+        users = [User.signup(f"user{n}", f"user{n}@test.com", "password", None)
+                 for n in range(4)]
+        db.session.commit()
+        doomed, others = users[0], users[1:]
+
+        for other in others:
+            db.session.add(Follows(user_being_followed_id=other.id,
+                                   user_following_id=doomed.id))
+            db.session.add(Follows(user_being_followed_id=doomed.id,
+                                   user_following_id=other.id))
+            mine = Message(text="doomed", user_id=doomed.id)
+            theirs = Message(text="kept", user_id=other.id)
+            db.session.add_all([mine, theirs])
+            db.session.flush()
+            db.session.add(Likes(user_id=other.id, message_id=mine.id))
+            db.session.add(Likes(user_id=doomed.id, message_id=theirs.id))
+        reconcile()
+        db.session.commit()
+        doomed_id = doomed.id
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = doomed_id
+
+        # Queued elsewhere, so not for the request to run
+        jobs.enqueue('test_flaky', fail_times=0)
+        db.session.commit()
+
+        jobs.batch_size = 2
+        try:
+            resp = self.client.post('/users/delete')
+        finally:
+            jobs.batch_size = app.config['JOBS_BATCH_SIZE']
+
+        self.assertEqual(resp.status_code, 302)
+        db.session.expire_all()
+        self.assertIsNone(db.session.get(User, doomed_id))
+        self.assertEqual(Message.query.filter_by(user_id=doomed_id).count(), 0)
+        self.assertEqual(Job.query.filter_by(kind='delete_user').one().status, 'done')
+        self.assertEqual(Job.query.filter_by(kind='test_flaky').one().status, 'queued')
+        self.assertEqual(calls, [])
+
+        for other in others:
+            other = db.session.get(User, other.id)
+            self.assertEqual((other.followers_count, other.following_count,
+                              other.likes_count), (0, 0, 0))
+            self.assertEqual(other.messages[0].like_count, 0)
@@ -17,6 +17,9 @@ from models import db, User, Message, Follows, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
 
 # Now we can import app
 
@@ -17,6 +17,9 @@ from models import db, connect_db, Message, User
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
 
 # Now we can import app
 
@@ -112,3 +115,19 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.first()
             self.assertIsNone(msg)
+
+    def test_search_messages(self):
+        """Can messages be searched by text, as HTML and as JSON?"""
+        for text in ['Warblers sing at dawn', 'Nothing to see here']:
+            db.session.add(Message(text=text, user_id=self.testuser.id))
+        db.session.commit()
+
+        with app.test_client() as client:
+            html = client.get('/messages/search?q=dawn').get_data(as_text=True)
+            self.assertIn('Warblers sing at dawn', html)
+            self.assertNotIn('Nothing to see here', html)
+
+            resp = client.get('/api/messages/search?q=dawn')
+            self.assertEqual([msg['text'] for msg in resp.json['messages']],
+                             ['Warblers sing at dawn'])
+            self.assertIsNone(resp.json['next'])
@@ -0,0 +1,111 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import json
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app
+from metrics import Counter, Gauge, Histogram, Registry, percentile
+
+db.create_all()
+
+# A pid that cannot belong to a running process
+DEAD_PID = 2 ** 22 + 1
+
+
+class MetricsTestCase(TestCase):
+    """Test exposition and combining values across processes."""
+
+    def setUp(self):
+        self.registry = Registry()
+        self.requests = self.registry.register(Counter(
+            'requests_total', 'Requests.', ('endpoint',)))
+        self.latency = self.registry.register(Histogram(
+            'latency_seconds', 'Latency.', buckets=(.1, 1)))
+        self.workers = self.registry.register(Gauge('workers', 'Workers.'))
+
+    def test_exposition(self):
+        """Are counters and cumulative histogram buckets exposed?"""
+
+        self.requests.inc(endpoint='homepage')
+        self.requests.inc(endpoint='homepage')
+        self.latency.observe(.05)
+        self.latency.observe(.5)
+        self.latency.observe(5)
+
+        text = self.registry.exposition()
+        self.assertIn('# TYPE requests_total counter', text)
+        self.assertIn('requests_total{endpoint="homepage"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count 3', text)
+
+    def test_percentile(self):
+        """Is the nearest-rank percentile used for p50/p99 summaries?"""
+
+        samples = list(range(1, 101))
+        self.assertEqual(percentile(samples, 50), 50)
+        self.assertEqual(percentile(samples, 99), 99)
+        self.assertEqual(percentile([3, 1, 2], 100), 3)
+        # n * p / 100 not a whole number: the rank rounds up
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 50), 3)
+        self.assertEqual(percentile(list(range(1, 151)), 99), 149)
+        self.assertEqual(percentile([5, 1], 1), 1)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_multiprocess(self):
+        """Are other processes' files summed, and dead processes' gauges dropped?"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.registry.directory = directory
+
+        with open(os.path.join(directory, f'{DEAD_PID}.json'), 'w') as f:
+            json.dump({'requests_total': [[['homepage'], 5]],
+                       'latency_seconds': [[[], [1, 0, 0, .05, 1]]],
+                       'workers': [[[], 1]]}, f)
+
+        self.requests.inc(endpoint='homepage')
+        self.latency.observe(.5)
+        self.workers.set(1)
+
+        text = self.registry.exposition()
+        self.assertIn('requests_total{endpoint="homepage"} 6', text)
+        self.assertIn('latency_seconds_bucket{le="1"} 2', text)
+        self.assertIn('workers 1', text)
+        self.assertTrue(os.path.exists(
+            os.path.join(directory, f'{os.getpid()}.json')))
+
+    def test_metrics_endpoint(self):
+        """Does /metrics count requests by endpoint?"""
+
+        client = app.test_client()
+        client.get('/login')
+        resp = client.get('/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('warbler_requests_total{endpoint="login",method="GET",'
+                      'status="200"}', resp.get_data(as_text=True))
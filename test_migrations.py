@@ -0,0 +1,108 @@
+"""Migration and query plan tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import inspect, select, text
+
+from models import db, User, Message, Likes
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from counters import reconcile
+import migrations
+import query_plans
+
+POSTGRES = db.engine.dialect.name == 'postgresql'
+
+
+@skipUnless(POSTGRES, "migrations and plans are checked on Postgres")
+class MigrationTestCase(TestCase):
+    """Test applying migrations to fresh and old schemas."""
+
+    def setUp(self):
+        """Start from an empty database."""
+
+        db.session.commit()
+        db.drop_all()
+        migrations.schema_migrations.drop(db.engine, checkfirst=True)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_fresh_database(self):
+        """Are all migrations applied once, and the schema complete?"""
+
+        versions = [version for version, _ in migrations.available()]
+        self.assertEqual(migrations.upgrade(report=lambda line: None), versions)
+        self.assertEqual(migrations.upgrade(report=lambda line: None), [])
+
+        indexes = {index['name'] for index in inspect(db.engine).get_indexes('messages')}
+        self.assertIn('ix_messages_user_timeline', indexes)
+        self.assertIn('ix_messages_search_vector', indexes)
+        self.assertNotIn('ix_messages_text_fts', indexes)
+
+    def test_old_likes_table(self):
+        """Are old surrogate-key likes rebuilt with a composite key?"""
+
+        migrations.upgrade(report=lambda line: None)
+        u = User(email="u@test.com", username="u", password="HASHED_PASSWORD")
+        db.session.add(u)
+        db.session.flush()
+        m = Message(text="hi", user_id=u.id)
+        db.session.add(m)
+        db.session.flush()
+        db.session.execute(text("DROP TABLE likes"))
+        db.session.execute(text("""
+            CREATE TABLE likes (
+                id SERIAL PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users ON DELETE CASCADE,
+                message_id INTEGER NOT NULL UNIQUE
+                    REFERENCES messages ON DELETE CASCADE)
+        """))
+        db.session.execute(text("INSERT INTO likes (user_id, message_id) "
+                                "VALUES (:u, :m)"), dict(u=u.id, m=m.id))
+        db.session.execute(migrations.schema_migrations.delete().where(
+            migrations.schema_migrations.c.version == '0003_likes_composite_key'))
+        db.session.commit()
+
+        self.assertEqual(migrations.upgrade(report=lambda line: None),
+                         ['0003_likes_composite_key'])
+        self.assertEqual(inspect(db.engine).get_pk_constraint('likes')
+                         ['constrained_columns'], ['user_id', 'message_id'])
+        self.assertEqual(db.session.execute(select(Likes.user_id)).scalars().all(),
+                         [u.id])
+
+    def test_no_sequential_scans(self):
+        """Do the hot routes' queries all have an index to use?"""
+
+        migrations.upgrade(report=lambda line: None)
+        users = [User(email=f"u{n}@test.com", username=f"u{n}",
+                      password="HASHED_PASSWORD") for n in range(3)]
+        db.session.add_all(users)
+        db.session.flush()
+        users[0].following.extend(users[1:])
+        db.session.add_all([Message(text=f"hi {n}", user_id=users[n % 3].id)
+                            for n in range(6)])
+        db.session.flush()
+        reconcile()
+        db.session.commit()
+
+        self.assertEqual(query_plans.check(app, CURR_USER_KEY), [])
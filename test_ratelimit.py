@@ -0,0 +1,95 @@
+"""Rate limiter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_ratelimit.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, Follows, Job, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from ratelimit import MemoryBuckets, SQLiteBuckets, limiter
+
+db.create_all()
+
+
+class RateLimitTestCase(TestCase):
+    """Test token buckets and the 429s they cause."""
+
+    def setUp(self):
+        Job.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        self.users = [User.signup(f"limited{n}", f"limited{n}@test.com",
+                                  "password", None) for n in range(2)]
+        db.session.flush()
+        self.message = Message(text="like me", user_id=self.users[0].id)
+        db.session.add(self.message)
+        db.session.commit()
+
+        self.addCleanup(setattr, limiter, 'overrides', limiter.overrides)
+        self.addCleanup(setattr, limiter, 'storage', limiter.storage)
+        limiter.storage = MemoryBuckets()
+        limiter.overrides = {'add_like': [('user', '3/minute')]}
+
+    def like(self, user):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+        return client.post(f'/users/add_like/{self.message.id}')
+
+    def test_per_user_limit(self):
+        """Is a user refused with 429 and Retry-After once their bucket is empty?"""
+
+        statuses = [self.like(self.users[0]).status_code for _ in range(3)]
+        self.assertEqual(statuses, [302, 302, 302])
+
+        resp = self.like(self.users[0])
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], '20')
+
+        # Other users have buckets of their own
+        self.assertEqual(self.like(self.users[1]).status_code, 302)
+
+    def test_refill(self):
+        """Does a bucket refill at its rate, up to its capacity?"""
+
+        buckets = MemoryBuckets()
+        for _ in range(3):
+            self.assertEqual(buckets.take('k', 3, 1.0, now=100.0), 0)
+        self.assertAlmostEqual(buckets.take('k', 3, 1.0, now=100.0), 1.0)
+        self.assertEqual(buckets.take('k', 3, 1.0, now=101.0), 0)
+        self.assertAlmostEqual(buckets.take('k', 3, 1.0, now=101.5), 0.5)
+
+    def test_sqlite_shared(self):
+        """Do two workers' SQLite backends share one bucket?"""
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'buckets.db')
+        first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+
+        self.assertEqual(first.take('k', 2, 1.0, now=100.0), 0)
+        self.assertEqual(second.take('k', 2, 1.0, now=100.0), 0)
+        self.assertAlmostEqual(first.take('k', 2, 1.0, now=100.0), 1.0)
+        self.assertEqual(second.take('k', 2, 1.0, now=101.0), 0)
@@ -0,0 +1,103 @@
+"""Read model tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_read_models.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Follows, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from read_models import MessageView, message_views, to_views, views_by_ids
+
+db.create_all()
+
+
+class ReadModelTestCase(TestCase):
+    """Test message views and the pages built from them."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        self.viewer, self.author = [
+            User.signup(name, f"{name}@test.com", "password", None)
+            for name in ("viewer", "author")]
+        db.session.flush()
+        self.messages = [Message(text=f"read me {n}", user_id=self.author.id)
+                         for n in range(3)]
+        db.session.add_all(self.messages)
+        db.session.flush()
+
+        # The author likes everything, the viewer only the first message
+        db.session.add_all([Likes(user_id=self.author.id, message_id=msg.id)
+                            for msg in self.messages])
+        db.session.add(Likes(user_id=self.viewer.id, message_id=self.messages[0].id))
+        db.session.commit()
+
+    def test_views(self):
+        """Do views carry the columns, the viewer's likes and shared authors?"""
+
+        views = to_views(message_views(self.viewer.id)
+                         .filter(Message.user_id == self.author.id)
+                         .order_by(Message.id))
+        self.assertTrue(all(isinstance(view, MessageView) for view in views))
+        self.assertEqual([view.text for view in views],
+                         ["read me 0", "read me 1", "read me 2"])
+        self.assertEqual([view.liked for view in views], [True, False, False])
+        self.assertEqual(views[0].user.username, "author")
+        self.assertIs(views[0].user, views[1].user)
+        self.assertFalse(hasattr(views[0], '__dict__'))
+
+        ids = [self.messages[2].id, self.messages[0].id, -1]
+        self.assertEqual([view.id for view in views_by_ids(ids)], ids[:2])
+        self.assertFalse(any(view.liked for view in views_by_ids(ids)))
+
+    def test_likes_page(self):
+        """Does another user's likes page show the viewer's own likes?"""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer.id
+
+        html = client.get(f'/users/{self.author.id}/likes').get_data(as_text=True)
+        self.assertEqual(html.count('btn-primary'), 1)
+        self.assertEqual(html.count('btn-secondary'), 2)
+
+    def test_likes_pages(self):
+        """Does a streamed likes page continue from its cursor without repeats?"""
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.viewer.id
+
+        app.config['PAGE_SIZE'] = 2
+        self.addCleanup(app.config.update, PAGE_SIZE=100)
+
+        html = client.get(f'/users/{self.author.id}/likes').get_data(as_text=True)
+        self.assertIn('read me 2', html)
+        self.assertIn('read me 1', html)
+        self.assertNotIn('read me 0', html)
+
+        next_url = html.split('data-fragment-url="')[1].split('"')[0]
+        html = client.get(next_url.replace('&amp;', '&')).get_data(as_text=True)
+        self.assertIn('read me 0', html)
+        self.assertNotIn('read me 1', html)
+        self.assertNotIn('read me 2', html)
@@ -0,0 +1,119 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import os
+import random
+from unittest import TestCase
+
+from models import db, Follows, Job, Likes, Message, Suggestion, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from recommendations import recommendations
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationsTestCase(TestCase):
+    """Test scoring, storage and serving of follow suggestions."""
+
+    def setUp(self):
+        """Users 0..5; 0 follows 1 and 2, who both follow 3; 2 follows 4."""
+
+        Job.query.delete()
+        Suggestion.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        self.users = [User.signup(f"user{n}", f"user{n}@test.com", "password", None)
+                      for n in range(6)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+        for follower, followed in [(0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (5, 0)]:
+            self.follow(follower, followed)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def follow(self, follower, followed):
+        db.session.add(Follows(user_following_id=self.ids[follower],
+                               user_being_followed_id=self.ids[followed]))
+
+    def suggested(self, n):
+        return [(user.id, mutuals) for user, mutuals
+                in recommendations.for_user(self.ids[n])]
+
+    def test_refresh(self):
+        """Are friends of friends ranked by how many people you follow follow them?"""
+
+        recommendations.refresh()
+
+        self.assertEqual(self.suggested(0), [(self.ids[3], 2), (self.ids[4], 1)])
+        # 5 follows 0, and shares no one else
+        self.assertEqual(self.suggested(5), [(self.ids[1], 1), (self.ids[2], 1)])
+
+    def test_matches_brute_force(self):
+        """Do the sparse products agree with counting paths one by one?"""
+
+        rng = random.Random(1)
+        pairs = {(rng.randrange(6), rng.randrange(6)) for _ in range(20)}
+        Follows.query.delete()
+        for follower, followed in pairs:
+            if follower != followed:
+                self.follow(follower, followed)
+        db.session.commit()
+        recommendations.refresh()
+
+        following = {n: {b for a, b in pairs if a == n and a != b} for n in range(6)}
+        followers = {n: {a for a, b in pairs if b == n and a != b} for n in range(6)}
+        weight = recommendations.co_follower_weight
+        for n in range(6):
+            expected = {}
+            for other in set(range(6)) - following[n] - {n}:
+                mutuals = sum(other in following[f] for f in following[n])
+                score = mutuals + weight * sum(other in following[f]
+                                               for f in followers[n])
+                if score:
+                    expected[self.ids[other]] = score
+            stored = {row.suggested_id: row.score for row
+                      in Suggestion.query.filter_by(user_id=self.ids[n])}
+            self.assertEqual(stored, expected)
+
+    def test_follow_refreshes(self):
+        """Does following someone refresh the follower's suggestions?"""
+
+        recommendations.refresh()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.ids[0]
+
+        self.client.post(f'/users/follow/{self.ids[3]}')
+        db.session.expire_all()
+        self.assertEqual(self.suggested(0), [(self.ids[4], 1)])
+
+        resp = self.client.get('/users/suggestions')
+        self.assertEqual(resp.json['users'][0]['username'], 'user4')
+
+        resp = self.client.get(f'/users/{self.ids[0]}')
+        self.assertIn('Who to follow', resp.get_data(as_text=True))
+        resp = self.client.get(f'/users/{self.ids[1]}')
+        self.assertNotIn('Who to follow', resp.get_data(as_text=True))
@@ -0,0 +1,91 @@
+"""Search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from search import InvertedIndex, NgramIndex, tokenize, trigrams
+
+
+class NgramIndexTestCase(TestCase):
+    """Test the in-process trigram index used without pg_trgm."""
+
+    def setUp(self):
+        self.index = NgramIndex()
+        for key, username in enumerate(['alice', 'malice', 'alicia', 'bob', 'Alfred']):
+            self.index.add(key, username)
+
+    def test_trigrams(self):
+        """Are words padded like pg_trgm pads them?"""
+
+        self.assertEqual(trigrams('Cat'), {'  c', ' ca', 'cat', 'at '})
+
+    def test_search_ranking(self):
+        """Do prefix matches beat substring matches, which beat fuzzy ones?"""
+
+        self.assertEqual(self.index.search('alice', 10), [0, 1, 2])
+        self.assertEqual(self.index.search('bobb', 10), [3])
+        self.assertEqual(self.index.search('zzz', 10), [])
+        self.assertEqual(len(self.index.search('ali', 1)), 1)
+
+    def test_prefix(self):
+        """Does prefix lookup ignore case and respect the limit?"""
+
+        self.assertEqual(self.index.prefix('al', 10), [4, 0, 2])
+        self.assertEqual(self.index.prefix('AL', 2), [4, 0])
+
+    def test_update_and_remove(self):
+        """Are renamed and removed keys reindexed?"""
+
+        self.index.add(3, 'robert')
+        self.assertEqual(self.index.search('bob', 10), [])
+        self.assertEqual(self.index.prefix('rob', 10), [3])
+
+        self.index.remove(0)
+        self.assertNotIn(0, self.index.search('alice', 10))
+        self.assertEqual(len(self.index), 4)
+
+
+class InvertedIndexTestCase(TestCase):
+    """Test the in-process message index used off Postgres."""
+
+    def setUp(self):
+        self.index = InvertedIndex(half_life=3600)
+        self.now = datetime(2024, 1, 1, 12)
+
+    def test_tokenize(self):
+        """Are stop-words dropped and hashtags kept?"""
+
+        self.assertEqual(tokenize("The #Flask app is GREAT, isn't it?"),
+                         ['#flask', 'app', 'great', "isn't"])
+
+    def test_search_matches_all_tokens(self):
+        """Must a document hold every query token?"""
+
+        self.index.add(1, "hello world", self.now)
+        self.index.add(2, "hello there", self.now)
+
+        self.assertEqual([doc for _, doc in self.index.search("hello", 10)],
+                         [2, 1])
+        self.assertEqual([doc for _, doc in self.index.search("hello world", 10)],
+                         [1])
+        self.assertEqual(self.index.search("the", 10), [])
+
+    def test_recency_and_paging(self):
+        """Do newer messages rank higher, and does `before` continue a page?"""
+
+        for doc, hours in [(1, 0), (2, 5), (3, 2)]:
+            self.index.add(doc, "warble", self.now + timedelta(hours=hours))
+
+        first = self.index.search("warble", 2)
+        self.assertEqual([doc for _, doc in first], [2, 3])
+        rest = self.index.search("warble", 2, before=first[-1])
+        self.assertEqual([doc for _, doc in rest], [1])
+
+        self.index.remove(2)
+        self.assertEqual([doc for _, doc in self.index.search("warble", 10)],
+                         [3, 1])
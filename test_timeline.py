@@ -0,0 +1,170 @@
+"""Timeline store tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import select
+
+from models import db, User, Message, Follows, Timeline, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from counters import reconcile
+from instrumentation import instrumentation
+from timeline import timelines
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineStoreTestCase(TestCase):
+    """Test fan-out, backfill and pruning of home timelines."""
+
+    def setUp(self):
+        """Create two users, the second following the first."""
+
+        TimelineEntry.query.delete()
+        Timeline.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.author = User(email="author@test.com", username="author",
+                           password="HASHED_PASSWORD")
+        self.reader = User(email="reader@test.com", username="reader",
+                           password="HASHED_PASSWORD")
+        db.session.add_all([self.author, self.reader])
+        db.session.commit()
+
+        self.reader.following.append(self.author)
+        reconcile()
+        db.session.commit()
+
+        timelines.enabled = True
+        self.fanout_limit = timelines.fanout_limit
+
+    def tearDown(self):
+        timelines.enabled = False
+        timelines.fanout_limit = self.fanout_limit
+        db.session.rollback()
+
+    def post(self, text):
+        msg = Message(text=text, user_id=self.author.id)
+        db.session.add(msg)
+        db.session.flush()
+        timelines.push(msg)
+        db.session.commit()
+        return msg
+
+    def test_build_and_push(self):
+        """Is a built feed kept current by fan-out?"""
+
+        old = self.post("old")
+        self.assertEqual(timelines.message_ids(self.reader.id, 10), [old.id])
+
+        new = self.post("new")
+        self.assertEqual(TimelineEntry.query.filter_by(
+            user_id=self.reader.id, message_id=new.id).count(), 1)
+        self.assertEqual(timelines.message_ids(self.reader.id, 10),
+                         [new.id, old.id])
+
+    def test_push_trims_feeds(self):
+        """Does fan-out trim feeds only once they are TIMELINE_TRIM_SLACK over?"""
+
+        self.addCleanup(setattr, timelines, 'max_length', timelines.max_length)
+        self.addCleanup(setattr, timelines, 'trim_slack', timelines.trim_slack)
+        timelines.max_length, timelines.trim_slack = 2, 1
+        timelines.message_ids(self.reader.id, 10)
+        timelines.message_ids(self.author.id, 10)
+        db.session.commit()
+
+        with instrumentation.watch() as statements:
+            posted = [self.post(f"warble {n}").id for n in range(3)]
+        self.assertFalse([sql for sql in statements if sql.startswith('DELETE')])
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.reader.id).count(), 3)
+
+        posted.append(self.post("warble 3").id)
+        for user_id in (self.reader.id, self.author.id):
+            self.assertEqual(timelines.message_ids(user_id, 10), posted[:1:-1])
+            self.assertEqual(TimelineEntry.query.filter_by(user_id=user_id).count(), 2)
+            self.assertEqual(db.session.get(Timeline, user_id).length, 2)
+
+    def test_unfollow_and_follow(self):
+        """Does unfollowing prune the feed and following backfill it?"""
+
+        msg = self.post("hello")
+        timelines.message_ids(self.reader.id, 10)
+
+        self.reader.following.remove(self.author)
+        timelines.unfollow(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertEqual(timelines.message_ids(self.reader.id, 10), [])
+
+        self.reader.following.append(self.author)
+        db.session.flush()
+        timelines.follow(self.reader.id, self.author.id)
+        db.session.commit()
+        self.assertEqual(timelines.message_ids(self.reader.id, 10), [msg.id])
+
+    def test_remove_message(self):
+        """Is a deleted message pruned from feeds?"""
+
+        msg = self.post("bye")
+        timelines.message_ids(self.reader.id, 10)
+
+        timelines.remove_message(msg.id)
+        db.session.delete(msg)
+        db.session.commit()
+        self.assertEqual(timelines.message_ids(self.reader.id, 10), [])
+
+    def test_celebrity_merged_at_read(self):
+        """Are authors over the fan-out limit merged when the feed is read?"""
+
+        timelines.fanout_limit = 0
+        timelines.message_ids(self.reader.id, 10)
+
+        msg = self.post("famous")
+        self.assertEqual(TimelineEntry.query.filter_by(
+            user_id=self.reader.id).count(), 0)
+        self.assertEqual(timelines.message_ids(self.reader.id, 10), [msg.id])
+
+    def test_home_page_keeps_built_feed(self):
+        """Is a feed built by the home page committed, and then fanned out to?"""
+
+        old = self.post("old")
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.reader.id
+        self.assertIn("old", client.get('/').get_data(as_text=True))
+
+        def feed():
+            with db.engine.connect() as conn:
+                return conn.execute(
+                    select(TimelineEntry.message_id)
+                    .where(TimelineEntry.user_id == self.reader.id)
+                    .order_by(TimelineEntry.message_id)).scalars().all()
+
+        self.assertEqual(feed(), [old.id])
+
+        new = self.post("new")
+        self.assertEqual(feed(), [old.id, new.id])
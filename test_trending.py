@@ -0,0 +1,140 @@
+"""Trending hashtags and top warbles tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+import re
+import threading
+import time
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, Follows, Job, Likes, Message, User
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+from trending import SlidingCounter, Trending, trending
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class SlidingCounterTestCase(TestCase):
+    """Test the windowed count-min sketch and its top keys."""
+
+    def test_top_and_expiry(self):
+        """Are the heaviest keys ranked, and forgotten once the window passes?"""
+
+        counter = SlidingCounter(60, 6, top_k=2, width=64)
+        for key, times in [('a', 5), ('b', 3), ('c', 1)]:
+            for _ in range(times):
+                counter.add(key)
+
+        self.assertEqual(counter.top, [('a', 5), ('b', 3)])
+        self.assertGreaterEqual(counter.estimate('c'), 1)
+
+        counter.add('old', 10, at=time.time() - 120)
+        self.assertEqual(counter.estimate('old'), 0)
+
+        counter.advance(time.time() + 61)
+        self.assertEqual(counter.top, [])
+        self.assertEqual(counter.estimate('a'), 0)
+
+
+class TrendingTestCase(TestCase):
+    """Test recording through the routes and replaying from the database."""
+
+    def setUp(self):
+        Job.query.delete()
+        Likes.query.delete()
+        Follows.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        self.user = User.signup("trender", "trender@test.com", "password", None)
+        db.session.commit()
+        trending.reset()
+        trending.rebuild()
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_routes_and_rebuild(self):
+        """Do new messages and likes trend, and does a replay agree?"""
+
+        for text in ("#Flask is #fun", "more #flask", "no tags"):
+            self.client.post('/messages/new', data={'text': text})
+        liked = Message.query.filter_by(text="no tags").one()
+        self.client.post(f'/users/add_like/{liked.id}')
+
+        panel = trending.panel()
+        self.assertEqual(panel['1h']['hashtags'], [('flask', 2), ('fun', 1)])
+        self.assertEqual([(message['id'], likes) for message, likes
+                          in panel['24h']['messages']], [(liked.id, 1)])
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn('#flask', html)
+        self.assertIn('no tags', html)
+
+        # The hashtag link finds the messages with that tag
+        link = re.search(r'href="([^"]*)">#flask<', html).group(1)
+        self.assertEqual(link, '/messages/search?q=%23flask')
+        found = self.client.get(link).get_data(as_text=True)
+        self.assertIn('#Flask is #fun', found)
+        self.assertIn('more #flask', found)
+
+        trending.rebuild()
+        self.assertEqual(trending.panel(), panel)
+
+        self.client.post(f'/users/add_like/{liked.id}')
+        self.assertEqual(trending.panel()['24h']['messages'], [])
+
+    def test_background_resync(self):
+        """Is a due replay run off the request, serving the old counts meanwhile?"""
+
+        self.client.post('/messages/new', data={'text': "#early"})
+        started, release = threading.Event(), threading.Event()
+
+        def slow_counters():
+            # Hold the replay once it has read the database
+            if threading.current_thread().name == 'trending-replay':
+                started.set()
+                release.wait(5)
+            return Trending._counters(trending)
+
+        trending._counters = slow_counters
+        self.addCleanup(vars(trending).pop, '_counters')
+        trending._synced -= trending.resync_interval + 1
+
+        trending.version()
+        self.assertFalse(started.wait(0.2))
+
+        self.assertEqual(trending.panel()['1h']['hashtags'], [('early', 1)])
+        self.assertTrue(started.wait(5))
+        self.assertEqual(trending.panel()['1h']['hashtags'], [('early', 1)])
+
+        # Recorded while the replay runs, as a route does after its commit
+        trending.record_message(Message(text="#during", timestamp=datetime.utcnow()))
+
+        release.set()
+        for _ in range(100):
+            if not trending._replaying:
+                break
+            time.sleep(0.05)
+        self.assertEqual(sorted(trending.panel()['1h']['hashtags']),
+                         [('during', 1), ('early', 1)])
@@ -9,6 +9,7 @@ import os
 from unittest import TestCase
 
 from models import db, User, Message, Follows
+from hashing import passwords
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -17,6 +18,9 @@ from models import db, User, Message, Follows
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
 
 # Now we can import app
 
@@ -165,3 +169,34 @@ class UserModelTestCase(TestCase):
 
         self.assertFalse(wrong_password_user)
 
+    def test_followed_user_ids(self):
+        """Does followed_user_ids return just the followed users among the ids?"""
+        users = [User(email=f"user{i}@test.com", username=f"user{i}",
+                      password="HASHED_PASSWORD") for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+
+        users[0].following.append(users[1])
+        db.session.commit()
+
+        ids = [user.id for user in users]
+        self.assertEqual(users[0].followed_user_ids(ids), {users[1].id})
+        self.assertEqual(users[1].followed_user_ids(ids), set())
+        self.assertEqual(users[0].followed_user_ids([]), set())
+
+    def test_authenticate_rehashes_weak_password(self):
+        """Does a successful login upgrade a hash made at a lower cost?"""
+        rounds = passwords.rounds
+        try:
+            passwords.rounds = 4
+            user = User.signup(username='user1', email='user1@test.com',
+                               password='password', image_url=None)
+            db.session.commit()
+            self.assertTrue(user.password.startswith('$2b$04$'))
+
+            passwords.rounds = 5
+            self.assertEqual(User.authenticate('user1', 'password'), user)
+            self.assertTrue(user.password.startswith('$2b$05$'))
+            self.assertEqual(User.authenticate('user1', 'password'), user)
+        finally:
+            passwords.rounds = rounds
@@ -5,9 +5,17 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import json
 import os
+import re
+import threading
+import time
+from contextlib import nullcontext
 from unittest import TestCase
 
+from sqlalchemy import insert, text
+from sqlalchemy.exc import DBAPIError
+
 from models import db, connect_db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
@@ -17,10 +25,17 @@ from models import db, connect_db, Message, User, Likes
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
+# ...and to run background jobs in the request that queued them
+os.environ['JOBS_MODE'] = "inline"
+
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from counters import reconcile
+from instrumentation import assert_max_queries
+from search import _PrefixBackend, user_search
+from user_cache import user_cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -66,6 +81,8 @@ class UserViewTestCase(TestCase):
             user2.following.append(self.testuser)
             db.session.add(user2)
             db.session.commit()
+            reconcile()
+            db.session.commit()
 
             resp = c.get(f'/users/{user2.id}', follow_redirects=True)
             html = resp.get_data(as_text=True) 
@@ -205,4 +222,328 @@ class UserViewTestCase(TestCase):
 
             resp = c.post(f"/users/add_like/{message.id}", follow_redirects=True)
 
-            self.assertEqual(resp.status_code, 200)
\ No newline at end of file
+            self.assertEqual(resp.status_code, 200)
+    def test_users_show_pagination(self):
+        '''Does the profile page continue from its "load more" cursor?'''
+        app.config['PAGE_SIZE'] = 2
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                for text in ['first', 'second', 'third']:
+                    db.session.add(Message(text=text, user_id=self.testuser.id))
+                    db.session.commit()
+
+                resp = c.get(f'/users/{self.testuser.id}')
+                html = resp.get_data(as_text=True)
+                self.assertIn('third', html)
+                self.assertIn('second', html)
+                self.assertNotIn('first', html)
+
+                next_url = html.split('data-fragment-url="')[1].split('"')[0]
+                resp = c.get(next_url.replace('&amp;', '&'))
+                html = resp.get_data(as_text=True)
+                self.assertIn('first', html)
+                self.assertNotIn('second', html)
+                self.assertNotIn('Load more', html)
+
+                resp = c.get(f'/users/{self.testuser.id}?before=not-a-cursor')
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            app.config['PAGE_SIZE'] = 100
+
+    def test_followers_streamed(self):
+        '''Is a streamed followers page complete, with follow state and a cursor?'''
+        app.config.update(PAGE_SIZE=3, STREAM_BATCH_SIZE=2)
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                followers = [User(username=f"follower{n}", email=f"follower{n}@test.com",
+                                  password="testuser") for n in range(4)]
+                self.testuser.followers.extend(followers)
+                self.testuser.following.append(followers[1])
+                db.session.commit()
+
+                resp = c.get(f'/users/{self.testuser.id}/followers')
+                self.assertIsNone(resp.content_length)
+                html = resp.get_data(as_text=True)
+                for n in (3, 2, 1):
+                    self.assertIn(f'@follower{n}', html)
+                self.assertNotIn('@follower0', html)
+                self.assertIn(f'/users/stop-following/{followers[1].id}', html)
+                self.assertIn(f'/users/follow/{followers[2].id}', html)
+
+                next_url = html.split('data-fragment-url="')[1].split('"')[0]
+                html = c.get(next_url.replace('&amp;', '&')).get_data(as_text=True)
+                self.assertIn('@follower0', html)
+                for n in (3, 2, 1):
+                    self.assertNotIn(f'@follower{n}', html)
+                self.assertNotIn('Load more', html)
+
+                app.config['STREAM_LISTS'] = False
+                resp = c.get(f'/users/{self.testuser.id}/followers')
+                self.assertIsNotNone(resp.content_length)
+                self.assertIn('@follower3', resp.get_data(as_text=True))
+        finally:
+            app.config.update(PAGE_SIZE=100, STREAM_BATCH_SIZE=500, STREAM_LISTS=True)
+
+    def test_streamed_request_log(self):
+        '''Is a streamed page logged once its body is sent, with every query?'''
+        followers = [User(username=f"follower{n}", email=f"follower{n}@test.com",
+                          password="testuser") for n in range(4)]
+        self.testuser.followers.extend(followers)
+        db.session.commit()
+
+        app.config.update(PAGE_SIZE=3, STREAM_BATCH_SIZE=2)
+        self.addCleanup(app.config.update, PAGE_SIZE=100, STREAM_BATCH_SIZE=500)
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with self.assertLogs('warbler.requests', 'INFO') as logs, \
+                    assert_max_queries(100) as statements:
+                resp = c.get(f'/users/{self.testuser.id}/followers')
+                self.assertEqual(logs.output, [])
+                resp.get_data()
+                resp.close()
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertTrue(line['streamed'])
+        self.assertEqual(line['queries'], len(statements))
+        self.assertGreater(line['render_ms'], 0)
+
+    def test_users_streamed_pages(self):
+        '''Does a streamed list longer than a page continue without repeats?'''
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            db.session.add_all([User(username=f"many{n}", email=f"many{n}@test.com",
+                                     password="testuser") for n in range(105)])
+            db.session.commit()
+
+            html = c.get('/users').get_data(as_text=True)
+            first = set(re.findall(r'@(many\d+|testuser)<', html))
+            self.assertEqual(len(first), 100)
+
+            next_url = html.split('data-fragment-url="')[1].split('"')[0]
+            html = c.get(next_url.replace('&amp;', '&')).get_data(as_text=True)
+            second = set(re.findall(r'@(many\d+|testuser)<', html))
+            self.assertEqual(len(second), 6)
+            self.assertFalse(first & second)
+            self.assertNotIn('Load more', html)
+
+    def test_counters(self):
+        '''Do the follow, like and message routes keep the counters current?'''
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            user2 = User(username="testuser2",
+                         email="test2@test.com",
+                         password="testuser")
+            db.session.add(user2)
+            db.session.commit()
+            user2_id = user2.id
+
+            c.post(f'/users/follow/{user2_id}')
+            c.post("/messages/new", data={"text": "Hello"})
+            message = Message.query.one()
+            c.post(f"/users/add_like/{message.id}")
+
+            testuser = db.session.get(User, self.testuser.id)
+            user2 = db.session.get(User, user2_id)
+            self.assertEqual((testuser.messages_count, testuser.following_count,
+                              testuser.likes_count), (1, 1, 1))
+            self.assertEqual(user2.followers_count, 1)
+
+            c.post(f'/messages/{message.id}/delete')
+            c.post(f'/users/stop-following/{user2_id}')
+
+            db.session.expire_all()
+            self.assertEqual((testuser.messages_count, testuser.following_count,
+                              testuser.likes_count), (0, 0, 0))
+            self.assertEqual(user2.followers_count, 0)
+
+    def add_search_users(self):
+        for username in ['alice', 'malice', 'bob']:
+            db.session.add(User(username=username,
+                                email=f"{username}@test.com",
+                                password="testuser"))
+        db.session.commit()
+
+    def test_list_users_search(self):
+        '''Does /users?q= rank matches and /users/autocomplete complete prefixes?'''
+        self.add_search_users()
+        try:
+            user_search.create_indexes()
+        except DBAPIError:
+            db.session.rollback()
+            self.skipTest("fuzzy username search needs pg_trgm on Postgres")
+
+        with self.client as c:
+            html = c.get('/users?q=alice').get_data(as_text=True)
+            self.assertIn('@alice', html)
+            self.assertIn('@malice', html)
+            self.assertNotIn('@bob', html)
+            self.assertLess(html.index('@alice'), html.index('@malice'))
+
+            resp = c.get('/users/autocomplete?q=ali')
+            self.assertEqual([user['username'] for user in resp.json['users']],
+                             ['alice'])
+
+    def test_list_users_search_prefix_only(self):
+        '''Without pg_trgm, does /users?q= fall back to prefix matches?'''
+        self.add_search_users()
+        self.addCleanup(setattr, user_search, '_backend', None)
+        user_search._backend = _PrefixBackend()
+
+        with self.client as c:
+            html = c.get('/users?q=Ali').get_data(as_text=True)
+            self.assertIn('@alice', html)
+            self.assertNotIn('@malice', html)
+
+    def test_current_user_cache(self):
+        '''Is the logged-in user served from the cache until they change?'''
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get('/')
+            hits = user_cache.hits
+            c.get('/')
+            self.assertEqual(user_cache.hits, hits + 1)
+
+            c.post("/messages/new", data={"text": "Hello"})
+            self.assertIsNone(user_cache._lookup(self.testuser.id))
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn(f'<ahref="/users/{self.testuser.id}">1</a>',
+                          html.replace(' ', '').replace('\n', ''))
+
+    def test_conditional_get(self):
+        '''Does a page revalidate with its ETag until its data changes?'''
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get('/')
+            etag = resp.headers['ETag']
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+            resp = c.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b'')
+
+            c.post("/messages/new", data={"text": "Hello"})
+            resp = c.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+            resp = c.get('/static/stylesheets/style.css')
+            self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=300')
+            static_etag = resp.headers['ETag']
+            resp.close()
+            resp = c.get('/static/stylesheets/style.css',
+                         headers={'If-None-Match': static_etag})
+            self.assertEqual(resp.status_code, 304)
+
+            resp = c.get('/static/stylesheets/style.css?v=1a2b3c4d5e6f')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            resp.close()
+
+    def test_query_counts(self):
+        '''Do timeline and profile pages run a fixed number of queries?'''
+        authors = [User.signup(f"author{n}", f"author{n}@test.com",
+                               "password", None) for n in range(5)]
+        db.session.flush()
+        for author in authors:
+            self.testuser.following.append(author)
+            db.session.add(Message(text="hi", user_id=author.id))
+        db.session.commit()
+        reconcile()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            with assert_max_queries(5):
+                resp = c.get('/')
+            self.assertIn('db;dur=', resp.headers['Server-Timing'])
+
+            with assert_max_queries(5):
+                c.get(f'/users/{authors[0].id}')
+
+    def test_toggle_like(self):
+        '''Can several users like a message, and does a second click unlike it?'''
+        other = User.signup("other", "other@test.com", "password", None)
+        message = Message(text="likeable", user_id=self.testuser.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id, other_id = message.id, other.id
+
+        # Off Postgres the toggle takes a statement per table it touches
+        postgres = db.engine.dialect.name == 'postgresql'
+        for user_id in (self.testuser.id, other_id):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = user_id
+                with assert_max_queries(2) if postgres else nullcontext():
+                    c.post(f"/users/add_like/{message_id}")
+
+        db.session.expire_all()
+        self.assertEqual(Likes.query.filter_by(message_id=message_id).count(), 2)
+        self.assertEqual(db.session.get(Message, message_id).like_count, 2)
+        self.assertEqual(db.session.get(User, other_id).likes_count, 1)
+
+        with self.client as c:
+            c.post(f"/users/add_like/{message_id}")
+            self.assertEqual(c.post("/users/add_like/999999").status_code, 404)
+
+        db.session.expire_all()
+        self.assertEqual(db.session.get(Message, message_id).like_count, 1)
+        self.assertEqual(db.session.get(User, other_id).likes_count, 0)
+
+    def test_toggle_like_lost_race(self):
+        '''Does a like that loses a race to the same user's other click change nothing?'''
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest("SQLite serializes the two clicks")
+
+        message = Message(text="likeable", user_id=self.testuser.id)
+        db.session.add(message)
+        db.session.commit()
+        message_id, user_id = message.id, self.testuser.id
+
+        # The other click's like, not committed yet
+        other_click = db.engine.connect()
+        self.addCleanup(other_click.close)
+        transaction = other_click.begin()
+        other_click.execute(insert(Likes).values(user_id=user_id,
+                                                 message_id=message_id))
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        responses = []
+        request = threading.Thread(target=lambda: responses.append(
+            client.post(f"/users/add_like/{message_id}")))
+        request.start()
+
+        # Wait for the request's insert to block on the other click's like
+        with db.engine.connect() as conn:
+            for _ in range(100):
+                if conn.execute(text("SELECT count(*) FROM pg_stat_activity "
+                                     "WHERE wait_event_type = 'Lock'")).scalar():
+                    break
+                time.sleep(0.05)
+        transaction.commit()
+        request.join()
+
+        self.assertEqual(responses[0].status_code, 302)
+        db.session.expire_all()
+        self.assertEqual(Likes.query.filter_by(message_id=message_id).count(), 1)
+        self.assertEqual(db.session.get(Message, message_id).like_count, 0)
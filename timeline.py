@@ -0,0 +1,281 @@
+"""Materialized home timelines for Warbler.
+
+When enabled, every new message is pushed ("fanned out") into a
+`timeline_entries` row for each follower whose timeline has been built, so
+the homepage reads one indexed range instead of merging everyone the user
+follows at request time.
+
+Authors with more than TIMELINE_FANOUT_LIMIT followers are not fanned out;
+their messages are merged into the feed when it is read.
+
+Each feed keeps its newest TIMELINE_MAX_LENGTH entries. Fan-out counts
+the entries it adds in `timelines.length` and trims a feed only once it
+is TIMELINE_TRIM_SLACK entries over, so most messages trim nothing.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import (delete, func, insert, literal, or_, select, tuple_,
+                        update)
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import db, Follows, Message, Timeline, TimelineEntry, User
+
+
+class TimelineStore:
+    """Fan-out-on-write store of precomputed home timelines.
+
+    All methods work in the caller's session and never commit, so a feed
+    change lands in the same transaction as the write that caused it. A
+    read that builds a feed (see `ensure_built`) has to commit it, or the
+    next read builds it again and fan-out never reaches it.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.max_length = 800
+        self.fanout_limit = 10000
+        self.trim_slack = 50
+
+    def init_app(self, app):
+        """Read TIMELINE_* settings from the app config."""
+
+        self.enabled = app.config.setdefault('TIMELINE_STORE_ENABLED', False)
+        self.max_length = app.config.setdefault('TIMELINE_MAX_LENGTH', 800)
+        self.fanout_limit = app.config.setdefault('TIMELINE_FANOUT_LIMIT', 10000)
+        self.trim_slack = app.config.setdefault('TIMELINE_TRIM_SLACK', 50)
+        app.extensions['timeline'] = self
+
+    ##########################################################################
+    # Writes
+
+    def push(self, message):
+        """Add a freshly flushed message to its author's and followers' feeds."""
+
+        if not self.enabled:
+            return
+
+        built = select(Timeline.user_id)
+        entry = (literal(message.id), literal(message.user_id),
+                 literal(message.timestamp))
+
+        own_feed = (select(Timeline.user_id, *entry)
+                    .where(Timeline.user_id == message.user_id))
+        self._insert(own_feed)
+
+        if self._is_celebrity(message.user_id):
+            self._grown(Timeline.user_id == message.user_id)
+            return
+
+        followers = (select(Follows.user_following_id)
+                     .where(Follows.user_being_followed_id == message.user_id))
+        follower_feeds = (select(Follows.user_following_id, *entry)
+                          .where(Follows.user_being_followed_id == message.user_id)
+                          .where(Follows.user_following_id.in_(built)))
+        self._insert(follower_feeds)
+        self._grown(or_(Timeline.user_id == message.user_id,
+                        Timeline.user_id.in_(followers)))
+
+    def follow(self, follower_id, followed_id):
+        """Backfill the followed user's recent messages into the follower's feed."""
+
+        if not self.enabled or not self.is_materialized(follower_id):
+            return
+
+        already = (select(TimelineEntry.message_id)
+                   .where(TimelineEntry.user_id == follower_id))
+        recent = (select(literal(follower_id), Message.id, Message.user_id,
+                         Message.timestamp)
+                  .where(Message.user_id == followed_id)
+                  .where(Message.id.not_in(already))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(self.max_length))
+        self._insert(recent)
+        self.trim([follower_id])
+
+    def unfollow(self, follower_id, followed_id):
+        """Prune the unfollowed user's messages from the follower's feed."""
+
+        if not self.enabled:
+            return
+
+        db.session.execute(
+            delete(TimelineEntry)
+            .where(TimelineEntry.user_id == follower_id)
+            .where(TimelineEntry.author_id == followed_id))
+
+    def remove_message(self, message_id):
+        """Prune a deleted message from every feed that holds it."""
+
+        if not self.enabled:
+            return
+
+        db.session.execute(
+            delete(TimelineEntry).where(TimelineEntry.message_id == message_id))
+
+    def build(self, user_id):
+        """(Re)build a user's feed from their own and followed users' messages."""
+
+        db.session.execute(
+            delete(TimelineEntry).where(TimelineEntry.user_id == user_id))
+
+        followed = (select(Follows.user_being_followed_id)
+                    .where(Follows.user_following_id == user_id))
+        recent = (select(literal(user_id), Message.id, Message.user_id,
+                         Message.timestamp)
+                  .where(or_(Message.user_id == user_id,
+                             Message.user_id.in_(followed)))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(self.max_length))
+        self._insert(recent)
+
+        # Two first visits can build the same feed at once
+        now = datetime.utcnow()
+        statement = self._insert_statement(Timeline).values(user_id=user_id,
+                                                            built_at=now)
+        if hasattr(statement, 'on_conflict_do_update'):
+            statement = statement.on_conflict_do_update(
+                index_elements=['user_id'], set_=dict(built_at=now))
+        db.session.execute(statement)
+        self._recount([user_id])
+
+    def ensure_built(self, user_id):
+        """Build a user's feed unless it is; True if it was built just now."""
+
+        if not self.enabled or self.is_materialized(user_id):
+            return False
+
+        self.build(user_id)
+        return True
+
+    def trim(self, user_ids):
+        """Drop the entries beyond `max_length` from the feeds of `user_ids`.
+
+        All of their feeds are trimmed in one statement, which ranks every
+        entry of each, so pass only the feeds that are over.
+        """
+
+        ranked = (select(TimelineEntry.user_id, TimelineEntry.message_id,
+                         func.row_number().over(
+                             partition_by=TimelineEntry.user_id,
+                             order_by=(TimelineEntry.timestamp.desc(),
+                                       TimelineEntry.message_id.desc()))
+                         .label('position'))
+                  .where(TimelineEntry.user_id.in_(user_ids))
+                  .subquery())
+        overflow = (select(ranked.c.user_id, ranked.c.message_id)
+                    .where(ranked.c.position > self.max_length))
+
+        db.session.execute(
+            delete(TimelineEntry)
+            .where(tuple_(TimelineEntry.user_id, TimelineEntry.message_id)
+                   .in_(overflow)))
+        self._recount(user_ids)
+
+    ##########################################################################
+    # Reads
+
+    def is_materialized(self, user_id):
+        """Has this user's feed been built?"""
+
+        return db.session.get(Timeline, user_id) is not None
+
+    def message_ids(self, user_id, limit, before=None):
+        """Ids of the newest `limit` messages on a user's home timeline.
+
+        `before` is an optional (timestamp, id) key to continue after.
+        Returns None when the store is disabled, so callers can fall back to
+        building the timeline at read time.
+        """
+
+        if not self.enabled:
+            return None
+
+        self.ensure_built(user_id)
+
+        feed = (select(TimelineEntry.timestamp, TimelineEntry.message_id)
+                .where(TimelineEntry.user_id == user_id)
+                .order_by(TimelineEntry.timestamp.desc(),
+                          TimelineEntry.message_id.desc())
+                .limit(limit))
+        merged = (select(Message.timestamp, Message.id)
+                  .where(Message.user_id.in_(self._celebrities_followed(user_id)))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(limit))
+
+        if before:
+            feed = feed.where(tuple_(TimelineEntry.timestamp,
+                                     TimelineEntry.message_id) < before)
+            merged = merged.where(tuple_(Message.timestamp, Message.id) < before)
+
+        feed = db.session.execute(feed).all()
+        merged = db.session.execute(merged).all()
+
+        rows = sorted(set(feed) | set(merged), reverse=True)[:limit]
+        return [message_id for _, message_id in rows]
+
+    ##########################################################################
+    # Helpers
+
+    def _insert(self, rows):
+        """Insert (user_id, message_id, author_id, timestamp) rows from a select.
+
+        Rows already in a feed are skipped, since a fan-out job and a
+        backfill can race to add the same message.
+        """
+
+        statement = self._insert_statement(TimelineEntry).from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'], rows)
+        if hasattr(statement, 'on_conflict_do_nothing'):
+            statement = statement.on_conflict_do_nothing()
+        db.session.execute(statement)
+
+    def _grown(self, feeds):
+        """Count a new entry in each feed matching `feeds` (a condition on
+        Timeline), and trim those now TIMELINE_TRIM_SLACK entries over.
+        """
+
+        db.session.execute(update(Timeline).where(feeds)
+                           .values(length=Timeline.length + 1))
+        over = db.session.execute(
+            select(Timeline.user_id)
+            .where(feeds)
+            .where(Timeline.length > self.max_length + self.trim_slack)
+        ).scalars().all()
+        if over:
+            self.trim(over)
+
+    def _recount(self, user_ids):
+        """Set the length of the feeds of `user_ids` from their entries."""
+
+        entries = (select(func.count())
+                   .where(TimelineEntry.user_id == Timeline.user_id)
+                   .scalar_subquery())
+        db.session.execute(update(Timeline)
+                           .where(Timeline.user_id.in_(user_ids))
+                           .values(length=entries))
+
+    def _insert_statement(self, model):
+        """An INSERT into `model`, with ON CONFLICT where the dialect has it."""
+
+        dialect = db.session.get_bind().dialect.name
+        return {'postgresql': postgresql.insert,
+                'sqlite': sqlite.insert}.get(dialect, insert)(model)
+
+    def _is_celebrity(self, user_id):
+        """Does this user have too many followers to fan out to?"""
+
+        followers_count = db.session.execute(
+            select(User.followers_count).where(User.id == user_id)).scalar()
+        return followers_count > self.fanout_limit
+
+    def _celebrities_followed(self, user_id):
+        """Select the ids of users followed by `user_id` that are not fanned out."""
+
+        return (select(Follows.user_being_followed_id)
+                .join(User, User.id == Follows.user_being_followed_id)
+                .where(Follows.user_following_id == user_id)
+                .where(User.followers_count > self.fanout_limit))
+
+
+timelines = TimelineStore()
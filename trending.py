@@ -0,0 +1,352 @@
+"""Trending hashtags and top warbles over sliding windows.
+
+Each window in TRENDING_WINDOWS (1h and 24h by default) counts hashtags
+and likes in a ring of time buckets. Every bucket holds a count-min
+sketch, a fixed-size table of counters that over-estimates a key's count
+by a bounded amount whatever the number of distinct keys. The window's
+counts are the running sum of its live buckets, less each bucket as it
+expires. A bounded set of candidate keys, the heaviest seen, gives the
+top TRENDING_TOP_K, which is kept sorted so reading the panel is O(K).
+
+Routes record new messages and likes after they commit. The counts live
+in each process and cover that process's writes, so every process replays
+the last window from the database on first use and then every
+TRENDING_RESYNC_INTERVAL seconds. The replay runs in a background thread;
+requests keep reading the current counts, and writes recorded while it
+runs are applied to the replayed counts before they take over. `likes`
+has no timestamps, so a replay dates each like at its message's
+timestamp.
+"""
+
+import hashlib
+import heapq
+import logging
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from models import db, Message, User
+
+logger = logging.getLogger('warbler.trending')
+
+HASHTAG = re.compile(r'(?<![\w#])#(\w{1,50})')
+
+WINDOWS = {'1h': (3600, 60), '24h': (86400, 96)}
+
+
+class SlidingCounter:
+    """Approximate counts over the last `window` seconds, and the top keys."""
+
+    def __init__(self, window, buckets, top_k=10, width=1024, depth=4,
+                 capacity=None):
+        self.window = window
+        self.buckets = buckets
+        self.bucket_seconds = window / buckets
+        self.top_k = top_k
+        self.width = width
+        self.depth = depth
+        self.capacity = capacity or 20 * top_k
+        self.sketches = np.zeros((buckets, depth, width), dtype=np.int32)
+        self.total = np.zeros((depth, width), dtype=np.int64)
+        self.current = int(time.time() // self.bucket_seconds)
+        self.candidates = {}
+        self.top = []
+        self._rows = np.arange(depth)
+
+    def add(self, key, amount=1, at=None):
+        """Count `amount` for `key` at unix time `at` (default now)."""
+
+        now = time.time()
+        self.advance(now)
+        bucket = int((now if at is None else min(at, now)) // self.bucket_seconds)
+        if bucket <= self.current - self.buckets:
+            return
+
+        cols = self._columns(key)
+        self.sketches[bucket % self.buckets, self._rows, cols] += amount
+        self.total[self._rows, cols] += amount
+
+        estimate = int(self.total[self._rows, cols].min())
+        self.candidates[key] = estimate
+        if len(self.candidates) > 2 * self.capacity:
+            self.candidates = dict(heapq.nlargest(
+                self.capacity, self.candidates.items(), key=lambda item: item[1]))
+            self._rank()
+
+        floor = self.top[-1][1] if len(self.top) == self.top_k else 0
+        if estimate > floor or any(top_key == key for top_key, _ in self.top):
+            self._rank()
+
+    def estimate(self, key):
+        return int(self.total[self._rows, self._columns(key)].min())
+
+    def advance(self, now=None):
+        """Expire the buckets that have slid out of the window."""
+
+        bucket = int((time.time() if now is None else now) // self.bucket_seconds)
+        if bucket <= self.current:
+            return
+
+        for step in range(1, min(bucket - self.current, self.buckets) + 1):
+            slot = (self.current + step) % self.buckets
+            self.total -= self.sketches[slot]
+            self.sketches[slot] = 0
+        self.current = bucket
+
+        self.candidates = {key: self.estimate(key) for key in self.candidates}
+        self._rank()
+
+    def discard(self, key):
+        self.candidates.pop(key, None)
+        self._rank()
+
+    def _rank(self):
+        best = heapq.nlargest(self.top_k, self.candidates.items(),
+                              key=lambda item: item[1])
+        self.top = [(key, count) for key, count in best if count > 0]
+
+    def _columns(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=4 * self.depth)
+        return np.frombuffer(digest.digest(), dtype=np.uint32) % self.width
+
+
+class Trending:
+    """Per-process trending hashtags and most-liked messages."""
+
+    def __init__(self):
+        self.enabled = True
+        self.top_k = 10
+        self.windows = WINDOWS
+        self.resync_interval = 300
+        self.hashtags = {}
+        self.messages = {}
+        self.details = {}
+        self._synced = None
+        self._replaying = False
+        self._pending = None
+        self._app = None
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        """Read TRENDING_* settings from the app config."""
+
+        self.enabled = app.config.setdefault('TRENDING_ENABLED', True)
+        self.top_k = app.config.setdefault('TRENDING_TOP_K', 10)
+        self.windows = app.config.setdefault('TRENDING_WINDOWS', WINDOWS)
+        self.resync_interval = app.config.setdefault(
+            'TRENDING_RESYNC_INTERVAL', 300)
+        self._app = app
+        self.reset()
+        app.add_template_global(self.panel, 'trending')
+        app.extensions['trending'] = self
+
+    def reset(self):
+        with self._lock:
+            self.hashtags, self.messages = self._counters(), self._counters()
+            self.details = {}
+            self._synced = None
+
+    ##########################################################################
+    # Writes
+
+    def record_message(self, message):
+        """Count a committed message's hashtags."""
+
+        if not self.enabled:
+            return
+
+        text, timestamp = message.text, message.timestamp
+        with self._lock:
+            _count_tags(self.hashtags, text, timestamp)
+            self._defer(lambda hashtags, messages:
+                        _count_tags(hashtags, text, timestamp))
+
+    def record_like(self, message_id, delta):
+        """Count a committed like (+1) or unlike (-1) of a message."""
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            _count_like(self.messages, message_id, delta)
+            self._defer(lambda hashtags, messages:
+                        _count_like(messages, message_id, delta))
+
+    def forget_message(self, message_id):
+        with self._lock:
+            _forget(self.messages, message_id)
+            self.details.pop(message_id, None)
+            self._defer(lambda hashtags, messages: _forget(messages, message_id))
+
+    def rebuild(self):
+        """Replay the longest window's messages and likes from the database.
+
+        The replay fills fresh counters, which then replace the live ones,
+        plus the writes recorded since it started reading.
+        """
+
+        since = datetime.utcnow() - timedelta(
+            seconds=max(window for window, _ in self.windows.values()))
+        with self._lock:
+            self._pending = []
+        try:
+            rows = db.session.execute(
+                select(Message.id, Message.text, Message.timestamp,
+                       Message.like_count, User.id, User.username)
+                .join(User, User.id == Message.user_id)
+                .where(Message.timestamp >= since)
+                .execution_options(yield_per=10_000))
+
+            hashtags, messages, details = self._counters(), self._counters(), {}
+            for message_id, text, timestamp, like_count, user_id, username in rows:
+                _count_tags(hashtags, text, timestamp)
+                if like_count:
+                    at = _unix(timestamp)
+                    for counter in messages.values():
+                        counter.add(message_id, like_count, at)
+                    details[message_id] = _details(message_id, text, user_id, username)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            for apply in self._pending or ():
+                apply(hashtags, messages)
+            self._pending = None
+
+            wanted = {key for counter in messages.values()
+                      for key in counter.candidates}
+            self.hashtags, self.messages = hashtags, messages
+            self.details = {key: value for key, value in details.items()
+                            if key in wanted}
+            self._synced = time.monotonic()
+
+    ##########################################################################
+    # Reads
+
+    def panel(self):
+        """{window: {'hashtags': [(tag, count)], 'messages': [(message, likes)]}}."""
+
+        if not self.enabled:
+            return {}
+
+        self.sync()
+        with self._lock:
+            for counter in (*self.hashtags.values(), *self.messages.values()):
+                counter.advance()
+            missing = {key for counter in self.messages.values()
+                       for key, _ in counter.top if key not in self.details}
+            if missing:
+                self._load_details(missing)
+
+            return {name: dict(
+                hashtags=list(self.hashtags[name].top),
+                messages=[(self.details[key], count)
+                          for key, count in self.messages[name].top
+                          if key in self.details])
+                    for name in self.windows}
+
+    def version(self):
+        """A value that changes whenever the panel does, for ETags.
+
+        Reads the counters as they are: no replay and no database access.
+        """
+
+        if not self.enabled:
+            return None
+
+        with self._lock:
+            tops = []
+            for name in sorted(self.windows):
+                for counter in (self.hashtags[name], self.messages[name]):
+                    counter.advance()
+                    tops.append(counter.top)
+            return hashlib.sha1(repr(tops).encode()).hexdigest()
+
+    def sync(self):
+        """Start a background replay if this process hasn't had one lately.
+
+        Returns at once; the current counts are served until it finishes.
+        """
+
+        with self._lock:
+            if self._replaying or (
+                    self._synced is not None and
+                    time.monotonic() - self._synced <= self.resync_interval):
+                return
+            self._replaying = True
+
+        threading.Thread(target=self._replay, daemon=True,
+                         name='trending-replay').start()
+
+    ##########################################################################
+    # Helpers
+
+    def _replay(self):
+        try:
+            with self._app.app_context():
+                self.rebuild()
+        except Exception:
+            logger.exception("trending replay failed")
+        finally:
+            with self._lock:
+                self._replaying = False
+                self._pending = None
+                # Not retried before the interval, even after a failure
+                self._synced = time.monotonic()
+
+    def _defer(self, apply):
+        """Repeat a write on the counters of a replay in progress."""
+
+        if self._pending is not None:
+            self._pending.append(apply)
+
+    def _counters(self):
+        return {name: SlidingCounter(*spec, top_k=self.top_k)
+                for name, spec in self.windows.items()}
+
+    def _load_details(self, message_ids):
+        rows = db.session.execute(
+            select(Message.id, Message.text, User.id, User.username)
+            .join(User, User.id == Message.user_id)
+            .where(Message.id.in_(message_ids)))
+        for row in rows:
+            self.details[row[0]] = _details(*row)
+        # Deleted messages
+        for message_id in set(message_ids) - set(self.details):
+            _forget(self.messages, message_id)
+
+
+def _count_tags(counters, text, timestamp):
+    at = _unix(timestamp)
+    for tag in {tag.lower() for tag in HASHTAG.findall(text or '')}:
+        for counter in counters.values():
+            counter.add(tag, 1, at)
+
+
+def _count_like(counters, message_id, delta):
+    for counter in counters.values():
+        counter.add(message_id, delta)
+
+
+def _forget(counters, message_id):
+    for counter in counters.values():
+        counter.discard(message_id)
+
+
+def _details(message_id, text, user_id, username):
+    return dict(id=message_id, text=text, user_id=user_id, username=username)
+
+
+def _unix(timestamp):
+    """Unix time of a naive UTC datetime, as the models store them."""
+
+    return (timestamp - datetime(1970, 1, 1)).total_seconds()
+
+
+trending = Trending()
@@ -0,0 +1,122 @@
+"""Per-process cache of logged-in user snapshots.
+
+`add_user_to_g()` runs before every request; with this cache it rebuilds
+the current user from a snapshot of their columns instead of querying for
+them. Snapshots are dropped when the user is edited or deleted (committed
+ORM changes) or when their counters change (counters.adjust), and expire
+after USER_CACHE_TTL seconds, which bounds how stale another worker
+process's copy can be.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+
+from models import db, User
+
+
+class UserCache:
+    """LRU cache, with a TTL, of User column snapshots keyed by id."""
+
+    def __init__(self):
+        self.enabled = True
+        self.max_size = 1024
+        self.ttl = 30
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._snapshots = OrderedDict()
+
+    def init_app(self, app):
+        """Read USER_CACHE_* settings from the app config."""
+
+        self.enabled = app.config.setdefault('USER_CACHE_ENABLED', True)
+        self.max_size = app.config.setdefault('USER_CACHE_SIZE', 1024)
+        self.ttl = app.config.setdefault('USER_CACHE_TTL', 30)
+        app.extensions['user_cache'] = self
+
+    def get(self, user_id):
+        """The user with `user_id`, attached to the session, or None.
+
+        A cached snapshot is merged into the session without a query;
+        otherwise the user is loaded and snapshotted.
+        """
+
+        snapshot = self._lookup(user_id) if self.enabled else None
+
+        if snapshot is None:
+            user = db.session.get(User, user_id)
+            if user is not None and self.enabled:
+                self._store(user)
+            return user
+
+        user = User(**snapshot)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def invalidate(self, user_id=None):
+        """Drop the snapshot for `user_id`, or every snapshot if None."""
+
+        with self._lock:
+            if user_id is None:
+                self._snapshots.clear()
+            else:
+                self._snapshots.pop(user_id, None)
+
+    def _lookup(self, user_id):
+        with self._lock:
+            entry = self._snapshots.get(user_id)
+            if entry and entry[0] > time.monotonic():
+                self._snapshots.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+
+            self._snapshots.pop(user_id, None)
+            self.misses += 1
+            return None
+
+    def _store(self, user):
+        # The password hash stays out of the cache; it loads on access
+        snapshot = {column.key: getattr(user, column.key)
+                    for column in inspect(User).column_attrs
+                    if column.key != 'password'}
+
+        with self._lock:
+            self._snapshots[user.id] = (time.monotonic() + self.ttl, snapshot)
+            self._snapshots.move_to_end(user.id)
+            while len(self._snapshots) > self.max_size:
+                self._snapshots.popitem(last=False)
+
+
+user_cache = UserCache()
+
+
+def invalidate_on_commit(user_id=None):
+    """Drop a snapshot now and again once the current transaction commits.
+
+    The second drop catches a snapshot re-cached from pre-commit data.
+    """
+
+    user_cache.invalidate(user_id)
+    db.session.info.setdefault('user_cache', set()).add(user_id)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _user_changed(mapper, connection, user):
+    user_cache.invalidate(user.id)
+    Session.object_session(user).info.setdefault('user_cache', set()).add(user.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_committed(session):
+    for user_id in session.info.pop('user_cache', ()):
+        user_cache.invalidate(user_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('user_cache', None)